@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for quaint check against a full parse.
+
+Usage: python3 bench/check.py [--lines N] [--repeat R]
+
+Generates a source file of (at least) N lines (default: 5000) with the
+same snippet as bench/hl.py, then times parser.parse (down to Canon),
+parser.parse2 and parser.check on it, taking the best of R runs
+(default: 3) for each.
+"""
+
+import optparse
+import time
+
+from hl import snippet
+
+def best(label, thunk, repeat):
+    times = []
+    for i in range(repeat):
+        t = time.time()
+        thunk()
+        times.append(time.time() - t)
+    print("%-32s %8.3fs" % (label, min(times)))
+    return min(times)
+
+if __name__ == "__main__":
+
+    oparser = optparse.OptionParser(usage = __doc__)
+    oparser.add_option("--lines", type="int", dest="lines", default=5000,
+                       help="Number of lines of the generated file.")
+    oparser.add_option("--repeat", type="int", dest="repeat", default=3,
+                       help="Number of runs for each measure.")
+    options, args = oparser.parse_args()
+
+    from quaint import parser, decode
+
+    reps = options.lines // snippet.count("\n") + 1
+    source = decode(snippet * reps)
+    print("%i lines, %i characters" % (source.count("\n"), len(source)))
+
+    errors = parser.check(source)
+    assert not errors, errors
+
+    full = best("parse", lambda: parser.parse(source), options.repeat)
+    best("parse2", lambda: parser.parse2(source), options.repeat)
+    check = best("check", lambda: parser.check(source), options.repeat)
+    print("%-32s %8.2fx" % ("speedup", full / check))
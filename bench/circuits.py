@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for the optimization passes of CircuitMaker.
+
+Usage: python3 bench/circuits.py [--random N] [--depth D] [--seed S]
+
+Makes circuits on the inputs x and y out of a few programs, along with
+N (default: 100) random expressions of depth D (default: 5) built out
+of arithmetic, ifs, guarded divisions, applications of small lambdas
+and repeated subexpressions, generated from the seed S (default: 1).
+The circuits are made without passes, then with
+evaluate.circuit_passes, and the total number of gates and edges after
+each pass is printed, along with the time taken.
+"""
+
+import optparse
+import random
+import time
+
+programs = [
+    ("square", """
+(lambda [t]: t * t + 3 * t + 1)[x + y] * (lambda [t]: t * t + 3 * t + 1)[x - y]
+"""),
+    ("abs", """
+(if (x < 0): (0 - x) ~ else: x) + (if (y < 0): (0 - y) ~ else: y) + (if (x < 0): (0 - x) ~ else: x) * 2
+"""),
+    ("expand", """
+(x - y) * (x - y) + (x + y) * (x + y) + 2 * (x - y) * (x + y) + 2 * 2 * 2
+"""),
+    ]
+
+
+def generate(rnd, depth, variables):
+    if depth == 0 or rnd.random() < 0.2:
+        return rnd.choice(variables + ['1', '2', '3'])
+    c = rnd.random()
+    if c < 0.15:
+        return "(if (%s < %s): %s ~ else: %s)" % tuple(generate(rnd, depth - 1, variables)
+                                                   for i in range(4))
+    elif c < 0.3:
+        return "(lambda [a, b]: %s)[%s, %s]" % (generate(rnd, depth - 1, ['a', 'b']),
+                                                generate(rnd, depth - 1, variables),
+                                                generate(rnd, depth - 1, variables))
+    elif c < 0.4:
+        sub = generate(rnd, depth - 1, variables)
+        return "(%s %s %s)" % (sub, rnd.choice("+*"), sub)
+    elif c < 0.5:
+        # Division is guarded, so only the branch that is taken may
+        # divide by zero
+        a, b, d = (generate(rnd, depth - 1, variables) for i in range(3))
+        return "(if (%s == 0): %s ~ else: %s / %s)" % (d, a, b, d)
+    return "(%s %s %s)" % (generate(rnd, depth - 1, variables),
+                           rnd.choice("+-*"),
+                           generate(rnd, depth - 1, variables))
+
+if __name__ == "__main__":
+
+    oparser = optparse.OptionParser(usage = __doc__)
+    oparser.add_option("--random", type="int", dest="random", default=100,
+                       help="Number of random expressions.")
+    oparser.add_option("--depth", type="int", dest="depth", default=5,
+                       help="Depth of the random expressions.")
+    oparser.add_option("--seed", type="int", dest="seed", default=1,
+                       help="Seed of the random expressions.")
+    options, args = oparser.parse_args()
+
+    from quaint import decode
+    from quaint.interpret.lower import lower
+    from quaint.interpret.evaluate import CircuitMaker, circuit_passes
+    from quaint.interpret.simulate import function_gates
+
+    rnd = random.Random(options.seed)
+    sources = [code for name, code in programs]
+    sources += [generate(rnd, options.depth, ['x', 'y']) for i in range(options.random)]
+    trees = [lower(decode(code)) for code in sources]
+    print("%i programs" % len(trees))
+
+    gate_specs = function_gates()
+    totals = {}
+    for passes in [[], circuit_passes]:
+        t = time.time()
+        for tree in trees:
+            maker = CircuitMaker(['x', 'y'], gate_specs, passes = passes)
+            maker.create('main', tree)
+            if passes:
+                for stage, gates, edges in maker.report:
+                    g, e = totals.get(stage, (0, 0))
+                    totals[stage] = (g + gates, e + edges)
+        print("%-32s %8.4fs" % ("%i passes" % len(passes), time.time() - t))
+
+    print("%-32s %8s %8s" % ("", "gates", "edges"))
+    for stage in ['initial'] + circuit_passes:
+        print("%-32s %8i %8i" % ((stage,) + totals[stage]))
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for quaint hl on a large generated source file.
+
+Usage: python3 bench/hl.py [--lines N] [--keep FILE]
+
+Generates a source file of (at least) N lines (default: 10000) by
+repeating a snippet that exercises most of the syntax, then times
+each stage of "quaint hl": decoding, parsing, collecting the
+highlights with ASTHighlighter, and producing the output with
+format.highlight (as a string and streamed to a file), for both the
+terminal and the HTML formats. The same is done with TokenHighlighter
+(no parsing). Finally, the whole "quaint hl file out.html" command is
+timed in a subprocess, with and without -t.
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+snippet = r"""
+pure fact[n]:
+   if n == 0: 1
+   else: n * fact[n - 1]
+
+x <- [1, 2, 3]
+z = .symbol
+s = "hello $name and $(f[x]) ``esc``"
+t = <<nested <<string>> $x>>
+c = 'a
+n = 16rFF + 2r1010.1 + .5
+f = lambda [a, b]: a + b
+if x < y: a
+elif x > y: b
+else: c
+a `union` b `in` c
+q -> r => s
+m ~ n
+"""
+
+def timed(label, thunk):
+    t = time.time()
+    rval = thunk()
+    print("%-32s %8.3fs" % (label, time.time() - t))
+    return rval
+
+if __name__ == "__main__":
+
+    oparser = optparse.OptionParser(usage = __doc__)
+    oparser.add_option("--lines", type="int", dest="lines", default=10000,
+                       help="Number of lines of the generated file.")
+    oparser.add_option("--keep", dest="keep", default=None,
+                       help="Write the generated file there and keep it.")
+    options, args = oparser.parse_args()
+
+    from quaint import parser, decode
+    from quaint.format import \
+        ASTHighlighter, TokenHighlighter, HTMLFormat, TermColorFormat, highlight
+
+    reps = options.lines // snippet.count("\n") + 1
+    encoded = snippet * reps
+    print("%i lines, %i characters" % (encoded.count("\n"), len(encoded)))
+
+    source = timed("decode", lambda: decode(encoded))
+    tree = timed("parse2", lambda: parser.parse2(source))
+
+    for name, format in [("term", TermColorFormat(True)),
+                         ("html", HTMLFormat(True))]:
+        hl = ASTHighlighter(format)
+        specs = timed("collect highlights (%s)" % name, lambda: hl.collect(tree))
+        print("%-32s %8i" % ("  specifications", len(specs)))
+        timed("format.highlight (%s)" % name, lambda: highlight(specs, format, 3))
+        with open(os.devnull, "w") as sink:
+            timed("format.highlight (%s, to file)" % name,
+                  lambda: highlight(specs, format, 3, sink))
+
+    tokens = timed("tokens", lambda: list(parser.tokens(source)))
+    print("%-32s %8i" % ("  tokens", len(tokens)))
+    for name, format in [("term", TermColorFormat(True)),
+                         ("html", HTMLFormat(True))]:
+        hl = TokenHighlighter(format)
+        specs = timed("collect tokens (%s)" % name, lambda: hl.collect(source))
+        with open(os.devnull, "w") as sink:
+            timed("token highlight (%s, to file)" % name,
+                  lambda: hl.highlight(source, sink))
+
+    path = options.keep or tempfile.mktemp(suffix = ".q")
+    with open(path, "w") as f:
+        f.write(encoded)
+    out = tempfile.mktemp(suffix = ".html")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin", "quaint")
+    try:
+        timed("quaint hl (subprocess)",
+              lambda: subprocess.check_call([sys.executable, script, "hl", path, out]))
+        timed("quaint hl -t (subprocess)",
+              lambda: subprocess.check_call([sys.executable, script, "hl", "-t", path, out]))
+    finally:
+        if not options.keep:
+            os.remove(path)
+        if os.path.exists(out):
+            os.remove(out)
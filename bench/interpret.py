@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for the closure-compiling evaluator and the Python backend.
+
+Usage: python3 bench/interpret.py [--repeat R] [--scale S]
+
+Runs a few programs (recursive fib, folds and maps over tables, string
+building, dispatch on an if with 100 branches, an if with 3000
+branches that are not turned into a switch) through parse,
+StaticExpr, ConstantFold, SwitchTable and ClosureCompiler, and times
+compilation and execution, taking the best of R runs (default: 3).
+Execution is also timed without SwitchTable. The same is done with
+PythonCompiler, along with compiling a reparsed copy of the program,
+which hits the cache of code objects. For comparison, the same trees
+are also run by a naive tree walker that dispatches on each node and
+looks variables up in dictionaries, which is what evaluating without
+compiling costs. S (default: 1) multiplies the size of the problems.
+"""
+
+import optparse
+import time
+
+# The branches of an if with 100 cases, like those of generated code
+dispatch = "".join("~ elif (x == %i): %i " % (i, 3 * i) for i in range(1, 100))
+
+# The branches of an if with 3000 ranges, which SwitchTable leaves
+# alone, to check that long chains compile
+chain = "".join("~ elif (x < %i): %i " % (i, i - 1) for i in range(2, 3000))
+
+programs = [
+    ("fib", """
+fib = lambda [n]: (if (n < 2): n ~ else: fib[n - 1] + fib[n - 2])
+fib[%(fib)s]
+"""),
+    ("tables", """
+square = lambda [x]: x * x
+odd = lambda [x]: x %% 2 == 1
+total = lambda [t]: fold[lambda [acc, x]: acc + x, 0, t]
+loop = lambda [i, acc]: (if (i == 0): acc ~ else: loop[i - 1, acc + total[map[square, filter[odd, range[0, 100]]]]])
+loop[%(tables)s, 0]
+"""),
+    ("strings", """
+line = lambda [i]: "item $i of $n: $(i * i)"
+build = lambda [i, acc]: (if (i == 0): acc ~ else: build[i - 1, acc ++ [line[i]]])
+n = %(strings)s
+len[join[", ", build[n, []]]]
+"""),
+    ("dispatch", """
+code = lambda [x]: (if (x == 0): 0 """ + dispatch + """~ else: -1)
+loop = lambda [i, acc]: (if (i == 0): acc ~ else: loop[i - 1, acc + code[i %% 100]])
+loop[%(dispatch)s, 0]
+"""),
+    ("chain", """
+rank = lambda [x]: (if (x < 1): 0 """ + chain + """~ else: -1)
+loop = lambda [i, acc]: (if (i == 0): acc ~ else: loop[i - 1, acc + rank[i * 7 %% 3000]])
+loop[%(chain)s, 0]
+"""),
+    ]
+
+sizes = dict(fib = 20, tables = 200, strings = 400, dispatch = 1000, chain = 200)
+
+
+class TreeWalker:
+    """
+    Reference evaluator: dispatches on the command of each node, every
+    time it is evaluated, with dictionaries for environments.
+    """
+
+    def __init__(self, builtins):
+        self.globals = dict(builtins)
+
+    def run(self, node):
+        return self.eval(node, self.globals)
+
+    def eval(self, node, env):
+        return getattr(self, "eval_" + node.all[1])(node, env)
+
+    def lookup(self, name, env):
+        while name not in env:
+            env = env["__parent__"]
+        return env[name]
+
+    def eval_symbol(self, node, env):
+        return self.lookup(node.all[2], env)
+
+    def eval_value(self, node, env):
+        return node.all[2]
+
+    def eval_void(self, node, env):
+        return None
+
+    def eval_quote(self, node, env):
+        return node.all[2]
+
+    def eval_apply(self, node, env):
+        name = assignment_target(node)
+        if name is not None:
+            env[name] = rval = self.eval(node.all[3].all[3], env)
+            return rval
+        fn, arg = node.all[2:]
+        if arg.all[1] == 'table':
+            args = [self.eval(x, env) for x in arg.all[2:]]
+        else:
+            args = [self.eval(arg, env)]
+        return self.eval(fn, env)(*args)
+
+    def eval_begin(self, node, env):
+        rval = None
+        for x in node.all[2:]:
+            rval = self.eval(x, env)
+        return rval
+
+    def eval_table(self, node, env):
+        return tuple(self.eval(x, env) for x in node.all[2:])
+
+    def eval_if(self, node, env):
+        condition, iftrue, iffalse = node.all[2:]
+        return self.eval(iftrue if self.eval(condition, env) else iffalse, env)
+
+    def eval_switch(self, node, env):
+        subject, default, *cases = node.all[2:]
+        value = self.eval(subject, env)
+        for case in cases:
+            if case.all[2].all[2] == value:
+                return self.eval(case.all[3], env)
+        return self.eval(default, env)
+
+    def eval_lambda(self, node, env):
+        parameters, body = node.all[2:]
+        def function(*args):
+            frame = dict(zip(parameters, args))
+            frame["__parent__"] = env
+            return self.eval(body, frame)
+        return function
+
+
+def best(label, thunk, repeat):
+    times = []
+    for i in range(repeat):
+        t = time.time()
+        rval = thunk()
+        times.append(time.time() - t)
+    print("%-32s %8.4fs" % (label, min(times)))
+    return min(times), rval
+
+if __name__ == "__main__":
+
+    oparser = optparse.OptionParser(usage = __doc__)
+    oparser.add_option("--repeat", type="int", dest="repeat", default=3,
+                       help="Number of runs for each measure.")
+    oparser.add_option("--scale", type="int", dest="scale", default=1,
+                       help="Multiplies the size of the problems.")
+    options, args = oparser.parse_args()
+
+    import sys
+    sys.setrecursionlimit(100000)
+
+    from quaint import parser, decode
+    from quaint.interpret.evaluate import \
+        StaticExpr, ConstantFold, SwitchTable, static_operators
+    from quaint.interpret.closures import \
+        ClosureCompiler, standard_builtins, assignment_target
+    from quaint.interpret.pybackend import PythonCompiler
+
+    params = {name: size * options.scale for name, size in sizes.items()}
+    if options.scale > 1:
+        # fib is exponential
+        params['fib'] = sizes['fib'] + options.scale
+
+    def prepare(code, switch = True):
+        tree = StaticExpr(static_operators).visit(parser.parse(decode(code)))
+        tree = ConstantFold().fold(tree)
+        return SwitchTable().tabulate(tree) if switch else tree
+
+    for name, code in programs:
+        print(name)
+        tree = prepare(code % params)
+        compiling, run = best("  compile", lambda: ClosureCompiler().compile(tree),
+                              options.repeat)
+        running, result = best("  run (closures)", run, options.repeat)
+        plain = ClosureCompiler().compile(prepare(code % params, switch = False))
+        best("  run (closures, no switch)", plain, options.repeat)
+        walking, expected = best("  run (tree walker)",
+                                 lambda: TreeWalker(standard_builtins).run(tree),
+                                 options.repeat)
+        assert result == expected, (result, expected)
+        print("%-32s %8.1fx" % ("  speedup", walking / running))
+
+        compiler = PythonCompiler()
+        best("  compile (python)",
+             lambda: PythonCompiler(table = compiler.table).compile(tree),
+             options.repeat)
+        copy = prepare(code % params)
+        best("  compile (python, cached)", lambda: compiler.compile(copy),
+             options.repeat)
+        python, result = best("  run (python)", lambda: PythonCompiler().run(tree),
+                              options.repeat)
+        assert result == expected, (result, expected)
+        print("%-32s %8.1fx" % ("  speedup", walking / python))
@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for the fused lowering pass.
+
+Usage: python3 bench/lower.py [--lines N] [--repeat R]
+
+Generates a source file of (at least) N lines (default: 2000) out of
+the programs of bench/interpret.py, parses it to a phase 1 tree, then
+lowers that tree with Convert2, Convert3 and StaticExpr, and with
+Lower, taking the best of R runs (default: 3) for each. Both results
+are checked to be the same.
+"""
+
+import optparse
+import time
+
+from interpret import programs, sizes
+
+def best(label, thunk, repeat):
+    times = []
+    for i in range(repeat):
+        t = time.time()
+        rval = thunk()
+        times.append(time.time() - t)
+    print("%-40s %8.3fs" % (label, min(times)))
+    return min(times), rval
+
+if __name__ == "__main__":
+
+    oparser = optparse.OptionParser(usage = __doc__)
+    oparser.add_option("--lines", type="int", dest="lines", default=2000,
+                       help="Number of lines of the generated file.")
+    oparser.add_option("--repeat", type="int", dest="repeat", default=3,
+                       help="Number of runs for each measure.")
+    options, args = oparser.parse_args()
+
+    from quaint import parser, decode
+    from quaint.parse import ast
+    from quaint.parse.generic.parse import Convert2, Convert3
+    from quaint.interpret.evaluate import StaticExpr, static_operators
+    from quaint.interpret.lower import Lower
+
+    snippet = "".join(code % sizes for name, code in programs)
+    reps = options.lines // snippet.count("\n") + 1
+    source = decode(snippet * reps)
+    print("%i lines, %i characters" % (source.count("\n"), len(source)))
+
+    tree = parser.parse1(source)
+
+    def three_passes():
+        e = Convert2().visit(ast.Bracketed(tree.location, "P", tree))
+        e = Convert3().visit(e)
+        return StaticExpr(static_operators).visit(e)
+
+    separate, expected = best("Convert2 + Convert3 + StaticExpr",
+                              three_passes, options.repeat)
+    fused, result = best("Lower", lambda: Lower().lower(tree), options.repeat)
+    assert str(result) == str(expected)
+    print("%-40s %8.1fx" % ("speedup", separate / fused))
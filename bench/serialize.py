@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for the binary serialization of syntax trees.
+
+Usage: python3 bench/serialize.py [--lines N] [--repeat R]
+
+Generates a source file of (at least) N lines (default: 2000) with the
+same snippet as bench/hl.py, then for the phase 1, phase 2 and Canon
+trees, times parsing, serialize.dumps and serialize.loads, taking the
+best of R runs (default: 3) for each, and prints the size of the
+serialized data and how much faster loading is than parsing.
+"""
+
+import optparse
+import time
+
+from hl import snippet
+
+def best(label, thunk, repeat):
+    times = []
+    for i in range(repeat):
+        t = time.time()
+        rval = thunk()
+        times.append(time.time() - t)
+    print("%-32s %8.3fs" % (label, min(times)))
+    return min(times), rval
+
+if __name__ == "__main__":
+
+    oparser = optparse.OptionParser(usage = __doc__)
+    oparser.add_option("--lines", type="int", dest="lines", default=2000,
+                       help="Number of lines of the generated file.")
+    oparser.add_option("--repeat", type="int", dest="repeat", default=3,
+                       help="Number of runs for each measure.")
+    options, args = oparser.parse_args()
+
+    from quaint import parser, decode
+    from quaint.parse import serialize
+
+    reps = options.lines // snippet.count("\n") + 1
+    source = decode(snippet * reps)
+    print("%i lines, %i characters" % (source.count("\n"), len(source)))
+
+    for name, parse in [("parse1", parser.parse1),
+                        ("parse2", parser.parse2),
+                        ("parse (Canon)", parser.parse)]:
+        parsing, tree = best(name, lambda: parse(source), options.repeat)
+        dumping, data = best("  dumps", lambda: serialize.dumps(tree), options.repeat)
+        loading, _ = best("  loads", lambda: serialize.loads(data), options.repeat)
+        print("%-32s %8i bytes" % ("  size", len(data)))
+        print("%-32s %8.1fx" % ("  loads vs parse", parsing / loading))
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for the circuit simulator.
+
+Usage: python3 bench/simulate.py [--random N] [--vectors V] [--repeat R]
+
+Makes circuits out of the programs of bench/circuits.py, along with N
+(default: 100) random expressions, both without passes and with
+evaluate.circuit_passes, and compiles them with simulate.Circuit. Each
+circuit is then given V (default: 1000) input vectors, one at a time
+(Circuit.run), all at once (Circuit.run_batch), and as a stream in
+which only one input changes from one vector to the next
+(Simulation.update). The best of R runs (default: 3) is taken for
+each, and the throughput is given in input vectors per second, over
+all the circuits. The results are checked against ClosureCompiler.
+"""
+
+import optparse
+import random
+import time
+
+from circuits import programs, generate
+
+def best(label, thunk, repeat, count):
+    times = []
+    for i in range(repeat):
+        t = time.time()
+        rval = thunk()
+        times.append(time.time() - t)
+    print("%-32s %8.4fs %12.0f/s" % (label, min(times), count / min(times)))
+    return min(times), rval
+
+if __name__ == "__main__":
+
+    oparser = optparse.OptionParser(usage = __doc__)
+    oparser.add_option("--random", type="int", dest="random", default=100,
+                       help="Number of random expressions.")
+    oparser.add_option("--depth", type="int", dest="depth", default=5,
+                       help="Depth of the random expressions.")
+    oparser.add_option("--seed", type="int", dest="seed", default=1,
+                       help="Seed of the random expressions and vectors.")
+    oparser.add_option("--vectors", type="int", dest="vectors", default=1000,
+                       help="Number of input vectors.")
+    oparser.add_option("--repeat", type="int", dest="repeat", default=3,
+                       help="Number of runs for each measure.")
+    options, args = oparser.parse_args()
+
+    from quaint import decode
+    from quaint.interpret.lower import lower
+    from quaint.interpret.evaluate import CircuitMaker, circuit_passes
+    from quaint.interpret.closures import evaluate, standard_builtins
+    from quaint.interpret.simulate import Circuit, Simulation, function_gates
+
+    rnd = random.Random(options.seed)
+    sources = [code for name, code in programs]
+    sources += [generate(rnd, options.depth, ['x', 'y']) for i in range(options.random)]
+    trees = [lower(decode(code)) for code in sources]
+
+    vectors = [(rnd.randint(-20, 20), rnd.randint(-20, 20))
+               for i in range(options.vectors)]
+    stream = [(i % 41 - 20, 7) for i in range(options.vectors)]
+    count = len(trees) * options.vectors
+    print("%i circuits, %i vectors" % (len(trees), options.vectors))
+
+    gates = function_gates()
+    expected = [[evaluate(tree, dict(standard_builtins, x = x, y = y))
+                 for x, y in vectors[:10]]
+                for tree in trees]
+
+    for passes in [[], circuit_passes]:
+        print("%i passes" % len(passes))
+        circuits = []
+        for tree in trees:
+            maker = CircuitMaker(['x', 'y'], gates, passes = passes)
+            maker.create('main', tree)
+            circuits.append(Circuit(maker))
+        print("%-32s %8i" % ("  gates", sum(c.gates for c in circuits)))
+
+        single, results = best("  run",
+                               lambda: [[c.run(v) for v in vectors] for c in circuits],
+                               options.repeat, count)
+        assert [r[:10] for r in results] == expected
+        batch, results2 = best("  run_batch",
+                               lambda: [c.run_batch(vectors) for c in circuits],
+                               options.repeat, count)
+        assert results2 == results
+        print("%-32s %8.1fx" % ("  speedup", single / batch))
+
+        def run_stream():
+            simulations = [Simulation(c) for c in circuits]
+            results = [[s.update(v) for v in stream] for s in simulations]
+            return results, sum(s.evaluated for s in simulations)
+        events, (results3, evaluated) = best("  stream (events)", run_stream,
+                                             options.repeat, count)
+        assert results3 == [[c.run(v) for v in stream] for c in circuits]
+        plain, _ = best("  stream (run)",
+                        lambda: [[c.run(v) for v in stream] for c in circuits],
+                        options.repeat, count)
+        print("%-32s %8.1f" % ("  gates evaluated per vector",
+                               evaluated / options.vectors))
+        print("%-32s %8.1fx" % ("  speedup", plain / events))
@@ -11,5 +11,10 @@ from .errors import \
     rich_error
 
 from .codehl import \
-    ASTHighlighter
+    ASTHighlighter, TokenHighlighter, \
+    html_highlight_style
+
+from .site import \
+    HTMLPages, \
+    highlight_tree
 
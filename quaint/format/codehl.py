@@ -1,47 +1,62 @@
 
 from .format import highlight, TermColorFormat, HTMLFormat
-from ..parse.generic import ast
+from ..parse.generic import ast, line_index, Location
+from ..parse.standard import parser as standard_parser
 
 
-__all__ = ['ASTHighlighter']
+__all__ = ['ASTHighlighter', 'TokenHighlighter', 'html_highlight_style']
 
 
+whitespace_operators = (ast.Infix("_"), ast.Infix("__"))
+
 def is_whitespace(x):
     return (isinstance(x, ast.OpApply)
-            and x.operator in (ast.Infix("_"), ast.Infix("__")))
+            and x.operator in whitespace_operators)
 
 def not_whitespace(x):
     return not is_whitespace(x)
 
-def infix(name):
-    op = ast.Infix(name)
-    def chki(x):
-        return (isinstance(x, ast.OpApply)
-                and x.operator == op)
-    return chki
+class OperatorMatcher:
+    """
+    Matches the application of a specific operator.
+    """
+    def __init__(self, operator):
+        self.operator = operator
 
-def prefix(name):
-    op = ast.Prefix(name)
-    def chkpr(x):
+    def __call__(self, x):
         return (isinstance(x, ast.OpApply)
-                and x.operator == op)
-    return chkpr
+                and x.operator == self.operator)
 
-def postfix(name):
-    op = ast.Postfix(name)
-    def chkpo(x):
-        return (isinstance(x, ast.OpApply)
-                and x.operator == op)
-    return chkpo
 
-def mac(name):
-    def chkmac(x):
+class MacroMatcher:
+    """
+    Matches "name x: y", that is to say the application of ":" where
+    the left hand side starts with the given identifier.
+    """
+    operator = ast.Infix(":")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, x):
         return (isinstance(x, ast.OpApply)
-                and x.operator == ast.Infix(":")
+                and x.operator == self.operator
                 and is_whitespace(x.children[0])
                 and isinstance(x.children[0].children[0], ast.Identifier)
-                and x.children[0].children[0].id == name)
-    return chkmac
+                and x.children[0].children[0].id == self.name)
+
+
+def infix(name):
+    return OperatorMatcher(ast.Infix(name))
+
+def prefix(name):
+    return OperatorMatcher(ast.Prefix(name))
+
+def postfix(name):
+    return OperatorMatcher(ast.Postfix(name))
+
+def mac(name):
+    return MacroMatcher(name)
 
 
 # Each entry in the highlighters list contains a list of matchers
@@ -52,7 +67,9 @@ def mac(name):
 # matcher sequence [infix("+"), 1, ast.Identifier]). The second
 # element is a boolean indicating whether the highlight is final
 # (True), or if sub-expressions should be highlighted (False). The
-# last element is the format to highlight with.
+# last element is the format to highlight with. A matcher is either a
+# type (isinstance), a predicate, or a value (==). The first entry
+# that matches wins. See CompiledRules for how they are looked up.
 
 term_color_highlighters = (
 
@@ -180,12 +197,111 @@ html_highlighters = (
     )
 
 
+# Style for the classes used in html_highlighters, to be used along
+# with format.basic_html_style.
+html_highlight_style = """
+.operator {color: blue}
+.identifier {color: black}
+.numeral {color: magenta}
+.string {color: red}
+.string_vi {color: magenta}
+.sequence {color: black; font-weight: bold}
+.macro {color: black; font-weight: bold}
+.macro_operator {color: black; font-weight: bold}
+.definition {color: green; font-weight: bold}
+.symbol {color: brown}
+.comment {color: green; font-style: italic}
+.invalid {color: red; font-weight: bold}
+
+.default {color: grey; font-style: italic}
+"""
+
+
 default_highlighters = {
     TermColorFormat: term_color_highlighters,
     HTMLFormat: html_highlighters
     }
 
 
+class CompiledRules:
+    """
+    A list of highlighters (see above), organized so that matching a
+    state does not require trying every entry.
+
+    All matchers of an entry but the last apply to the ancestors of
+    the node being highlighted, so it is the last matcher that tells
+    apart most entries. The entries are therefore indexed by what the
+    last element of the state must look like: its type, and its
+    operator (for OpApply) or its value (for path indexes and "op").
+    The first time a given kind of element is seen, the entries that
+    may match it are collected, in order, along with a flag telling
+    whether the last matcher is already known to match (types,
+    operators and values) or must still be called (other predicates).
+    """
+
+    def __init__(self, highlighters):
+        self.highlighters = highlighters
+        self.rules = [(len(target_state),
+                       target_state[-1],
+                       target_state[-2::-1],
+                       final, format)
+                      for target_state, final, format in highlighters]
+        self.table = {}
+
+    @staticmethod
+    def key(this):
+        if isinstance(this, ast.OpApply):
+            return (type(this), this.operator)
+        elif isinstance(this, ast.ASTNode):
+            return (type(this), None)
+        else:
+            return (type(this), this)
+
+    def candidates(self, key):
+        try:
+            return self.table[key]
+        except KeyError:
+            pass
+        cls, extra = key
+        results = []
+        for rule in self.rules:
+            last = rule[1]
+            if isinstance(last, type):
+                if issubclass(cls, last):
+                    results.append((rule, True))
+            elif isinstance(last, OperatorMatcher):
+                if issubclass(cls, ast.OpApply) and extra == last.operator:
+                    results.append((rule, True))
+            elif isinstance(last, MacroMatcher):
+                if issubclass(cls, ast.OpApply) and extra == last.operator:
+                    results.append((rule, False))
+            elif hasattr(last, '__call__'):
+                results.append((rule, False))
+            elif not issubclass(cls, ast.ASTNode) and extra == last:
+                results.append((rule, True))
+        self.table[key] = results
+        return results
+
+
+_default_rules = {}
+
+def compile_highlighters(highlighters, format_type = None):
+    """
+    Returns the CompiledRules for the given highlighters. If they are
+    the default highlighters of format_type, they are compiled once and
+    then shared by all highlighters for that format. Other
+    highlighters are compiled for each call, the caller keeping the
+    result for as long as it uses them.
+    """
+    if format_type is None or default_highlighters.get(format_type) is not highlighters:
+        return CompiledRules(highlighters)
+    try:
+        return _default_rules[format_type]
+    except KeyError:
+        rules = _default_rules[format_type] = CompiledRules(highlighters)
+        return rules
+
+
 class ASTHighlighter(ast.ASTVisitor):
 
     def __init__(self, format, highlighters = None):
@@ -193,28 +309,154 @@ class ASTHighlighter(ast.ASTVisitor):
         if highlighters is None:
             highlighters = default_highlighters[type(format)]
         self.highlighters = highlighters
-
-    def highlight(self, expr):
+        self.rules = compile_highlighters(highlighters, type(format))
+        self.memo = {}
+        self.window = None
+        self.cached_tree = None
+        self.line_cache = {}
+
+    def collect(self, expr, window = None):
+        """
+        Returns the list of (location, attribute) pairs to highlight
+        expr with.
+
+        window: (default: None) a (start, end) range of positions in
+            the source. If given, subtrees that lie entirely outside
+            of it are not visited.
+        """
         self.stack = []
-        self.visit(expr, [])
-        return highlight(self.stack, self.format, 3)
+        self.memo = {}
+        self.window = window
+        try:
+            self.visit(expr, [])
+        finally:
+            self.memo = {}
+            self.window = None
+        return self.stack
+
+    def collect_lines(self, expr, first, last):
+        """
+        Returns the (location, attribute) pairs needed to highlight
+        lines first to last (inclusive) of the source of expr.
+
+        The pairs are kept by line, so that asking again for some of
+        the same lines (e.g. when scrolling) only visits the tree for
+        the lines that were not seen before. The cache is dropped when
+        a different tree is given; a tree that is modified in place
+        must be given as a new object.
+        """
+        source = expr.location.source
+        index = line_index(source)
+        first = min(max(first, 1), index.nlines)
+        last = max(min(last, index.nlines), first)
+
+        if self.cached_tree is not expr:
+            self.cached_tree = expr
+            self.line_cache = {}
+        cache = self.line_cache
+
+        missing = [i for i in range(first, last + 1) if i not in cache]
+        if missing:
+            a, b = missing[0], missing[-1]
+            for i in range(a, b + 1):
+                cache[i] = []
+            window = (max(index.line_start(a) - 1, 0), index.line_start(b + 1))
+            for specification in self.collect(expr, window):
+                start, end = specification[0].span
+                # Also file it under the lines before and after when it
+                # touches the newlines around them: it splits their
+                # segments as well (see format.highlight).
+                l1 = index.line_of(max(start - 1, 0))
+                l2 = index.line_of(end + 1)
+                for i in range(max(l1, a), min(l2, b) + 1):
+                    cache[i].append(specification)
+
+        # A location that spans lines collected at different times is
+        # in the cache more than once, so duplicates are recognized by
+        # location rather than by pair.
+        results = []
+        seen = set()
+        for i in range(first, last + 1):
+            for specification in cache[i]:
+                key = (id(specification[0]), specification[1])
+                if key not in seen:
+                    seen.add(key)
+                    results.append(specification)
+        if not results:
+            # Nothing to highlight on these lines, but format.highlight
+            # needs a location to know the source. This one is just
+            # before the window, so it does not show.
+            position = max(index.line_start(first) - 1, 0)
+            results.append((Location(source, (position, position), None), None))
+        return results
+
+    def highlight(self, expr, sink = None, lines = None):
+        """
+        Highlights expr with self.format, with 3 lines of context.
+
+        sink: (default: None) if given, the output is written there
+            instead of being returned (see format.highlight).
+
+        lines: (default: None) a (first, last) pair of line numbers
+            (inclusive). If given, only these lines are highlighted,
+            and only the parts of the tree that cover them are
+            visited. Results are cached between calls on the same
+            tree (see collect_lines).
+        """
+        if lines is None:
+            return highlight(self.collect(expr), self.format, 3, sink)
+        first, last = lines
+        return highlight(self.collect_lines(expr, first, last), self.format,
+                         sink = sink, lines = lines)
+
+    def visit(self, node, state):
+        window = self.window
+        if window is not None:
+            location = getattr(node, 'location', None)
+            if location is not None:
+                start, end = location.span
+                lo, hi = window
+                if start == end:
+                    if not lo <= start <= hi:
+                        return
+                elif start >= hi or end <= lo:
+                    return
+        return super(ASTHighlighter, self).visit(node, state)
+
+    def test(self, target, this):
+        if isinstance(target, type):
+            return isinstance(this, target)
+        elif isinstance(target, OperatorMatcher):
+            return isinstance(this, ast.OpApply) and this.operator == target.operator
+        elif hasattr(target, '__call__'):
+            if not isinstance(this, ast.ASTNode):
+                return target(this) or this == target
+            # Nodes are tested against the same predicates for each of
+            # their descendants, so the results are kept for the
+            # duration of a collect().
+            key = (id(target), id(this))
+            try:
+                return self.memo[key]
+            except KeyError:
+                result = self.memo[key] = bool(target(this)) or this == target
+                return result
+        else:
+            return this == target
 
     def match_state(self, state):
         nstate = len(state)
-        for target_state, final, format in self.highlighters:
-            if len(target_state) > nstate:
+        test = self.test
+        for (length, last, rest, final, format), known in \
+                self.rules.candidates(CompiledRules.key(state[-1])):
+            if length > nstate:
                 continue
-            short_state = state[-len(target_state):]
-            # print(target_state, short_state, len(target_state), len(short_state), len(state))
-            for target, this in zip(target_state, short_state):
-                if isinstance(target, type):
-                    if isinstance(this, target):
-                        continue
-                elif hasattr(target, '__call__') and target(this):
-                    continue
-                elif this == target:
-                    continue
-                break
+            if not known and not test(last, state[-1]):
+                continue
+            i = nstate - 2
+            for target in rest:
+                if not test(target, state[i]):
+                    break
+                i -= 1
             else:
                 return (final, format)
         return None
@@ -229,38 +471,158 @@ class ASTHighlighter(ast.ASTVisitor):
             self.stack.append((location, format))
         return final
 
+    # The state is a single list shared by the whole traversal: each
+    # visitor pushes what it adds to the path and pops it before
+    # returning, so no path is ever copied.
+
     def visit_Identifier(self, node, state):
-        self.match_and_apply(node.location, state + [node])
+        state.append(node)
+        self.match_and_apply(node.location, state)
+        state.pop()
 
     def visit_Numeral(self, node, state):
-        self.match_and_apply(node.location, state + [node])
+        state.append(node)
+        self.match_and_apply(node.location, state)
+        state.pop()
 
     def visit_StringVI(self, node, state):
-        state = state + [node]
-        if not self.match_and_apply(node.location, state):
-            for i, item in enumerate(node.items):
-                self.visit(item, state + [i])
+        self.visit_items(node, node.items, state)
+
+    def visit_Void(self, node, state):
+        # e.g. what is left of a statement that could not be parsed
+        state.append(node)
+        self.match_and_apply(node.location, state)
+        state.pop()
 
     def visit_Operator(self, node, state):
         self.match_and_apply(node.location, state)
-    
+
     def visit_OpApply(self, node, state):
-        state = state + [node]
+        state.append(node)
         if not self.match_and_apply(node.location, state):
-            self.visit(node.operator, state + ["op"])
+            state.append("op")
+            self.visit(node.operator, state)
             for i, item in enumerate(node.children):
-                self.visit(item, state + [i])
+                state[-1] = i
+                self.visit(item, state)
+            state.pop()
+        state.pop()
 
     def visit__Seq(self, node, state):
-        state = state + [node]
+        self.visit_items(node, node.items, state)
+
+    def visit_items(self, node, items, state):
+        state.append(node)
         if not self.match_and_apply(node.location, state):
-            for i, item in enumerate(node.items):
-                self.visit(item, state + [i])
+            state.append(None)
+            for i, item in enumerate(items):
+                state[-1] = i
+                self.visit(item, state)
+            state.pop()
+        state.pop()
 
     def visit_ASTNode(self, node):
         raise Exception("This node type is not highlighted: %s" % type(node))
 
 
+# Attribute for each kind of token (see Tokenizer), for
+# TokenHighlighter. None means the token is not highlighted.
+
+term_color_token_attributes = dict(
+    identifier = "white*",
+    numeral = "cyan*",
+    string = "red*",
+    prefix = "blue*",
+    infix = "blue*",
+    postfix = "blue*",
+    bracket = "white*",
+    comment = "green",
+    indent = None,
+    invalid = "red!",
+    )
+
+html_token_attributes = dict(
+    identifier = "identifier",
+    numeral = "numeral",
+    string = "string",
+    prefix = "operator",
+    infix = "operator",
+    postfix = "operator",
+    bracket = "sequence",
+    comment = "comment",
+    indent = None,
+    invalid = "invalid",
+    )
+
+default_token_attributes = {
+    TermColorFormat: term_color_token_attributes,
+    HTMLFormat: html_token_attributes
+    }
+
+
+class TokenHighlighter:
+    """
+    Highlights source code from its tokens (see Parser.tokens) rather
+    than from its syntax tree. This is much faster than ASTHighlighter
+    and works on code that does not parse, but it only knows about
+    lexical categories, so that e.g. macros and definitions are not
+    told apart, and operator fixities are approximate.
+
+    format: the format to highlight with (TermColorFormat or
+        HTMLFormat, unless attributes is given).
+
+    parser: (default: the standard parser) the Parser whose tokens
+        are used.
+
+    attributes: (default: depends on format) a dictionary mapping
+        each kind of token to an attribute of the format.
+    """
+
+    def __init__(self, format, parser = None, attributes = None):
+        self.format = format
+        self.parser = standard_parser if parser is None else parser
+        if attributes is None:
+            attributes = default_token_attributes[type(format)]
+        self.attributes = attributes
+
+    def collect(self, code, end = None):
+        """
+        Returns the list of (location, attribute) pairs to highlight
+        code with, for the tokens that start before the end position
+        (default: all of them). Tokens are only read up to there.
+        """
+        attributes = self.attributes
+        results = []
+        for kind, start, stop in self.parser.tokens(code):
+            if end is not None and start >= end:
+                break
+            attribute = attributes.get(kind)
+            if attribute is not None:
+                results.append((Location(code, (start, stop), None), attribute))
+        return results
+
+    def highlight(self, code, sink = None, lines = None):
+        """
+        Highlights code (a string) with self.format. The whole code is
+        shown, or only the given (first, last) range of lines
+        (inclusive).
+
+        sink: (default: None) if given, the output is written there
+            instead of being returned (see format.highlight).
+        """
+        index = line_index(code)
+        if lines is None:
+            lines = (1, index.nlines)
+            specifications = self.collect(code)
+        else:
+            last = min(max(lines[1], 1), index.nlines)
+            specifications = self.collect(code, index.line_start(last + 1))
+        if not specifications:
+            # format.highlight needs a location to know the source
+            specifications.append((Location(code, (0, 0), None), None))
+        return highlight(specifications, self.format, sink = sink, lines = lines)
+
+
 
 
 
@@ -1,7 +1,9 @@
 
 import math
+from collections import deque
+from functools import lru_cache
 
-from ..parse.generic import pyparsing as P, linecol
+from ..parse.generic import pyparsing as P, line_index, Location
 from ..parse.standard import codec
 from functools import reduce
 from html.entities import codepoint2name as html_entities
@@ -21,8 +23,19 @@ __all__ = ['Format',
 class Format(object):
     """
     Base class for formats.
+
+    A format is a factory: calling it returns a fresh builder, which
+    highlight() feeds with new_line(i), add(text, attribute) and
+    end_line(), in that order, before calling get(). The builder
+    accumulates its output as a list of pieces which are joined once,
+    at the end. If it was given a sink (any object with a write
+    method, e.g. a file), the pieces are written to it in chunks as
+    they come, and get() returns None.
     """
 
+    # number of pieces to accumulate before writing them to the sink
+    chunk_size = 4096
+
     def __init__(self, lineno, encode = False):
         """
         lineno :: Boolean: do we show line numbers?
@@ -40,17 +53,48 @@ class Format(object):
         else:
             return text
 
+    def __call__(self, sink = None):
+        t = self.__class__(self.lineno, self.encode)
+        t.sink = sink
+        t.pieces = []
+        return t
+
+    def write(self, text):
+        pieces = self.pieces
+        pieces.append(text)
+        if self.sink is not None and len(pieces) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.pieces:
+            self.sink.write("".join(self.pieces))
+            self.pieces = []
+
+    def finish(self):
+        """
+        Returns the output, or writes what remains of it to the sink
+        and returns None.
+        """
+        if self.sink is None:
+            return "".join(self.pieces)
+        self.flush()
+        return None
+
 
 class TermFormat(Format):
     """
     Base class for printing highlighted source to a terminal.
+
+    The width of the line numbers column depends on the last line
+    number, so lines are kept until get() is called, and only then
+    written out.
     """
 
-    def __call__(self):
-        t = self.__class__(self.lineno, self.encode)
+    def __call__(self, sink = None):
+        t = super(TermFormat, self).__call__(sink)
         t.i = -1
         t.maxi = -1
-        t.current = ""
+        t.current = []
         t.lines = []
         return t
 
@@ -58,17 +102,31 @@ class TermFormat(Format):
         return text
 
     def new_line(self, i):
-        assert self.current == ""
+        assert not self.current
         self.i = i
         if i > self.maxi: self.maxi = i
 
     def end_line(self):
-        self.lines.append((self.i, self.current))
-        self.current = ""
+        self.lines.append((self.i, "".join(self.current)))
+        self.current = []
 
     def lead_length(self):
         return int(math.log(max(self.maxi, 1))/math.log(10)) + 2
 
+    def get(self):
+        lines = self.lines
+        if self.lineno:
+            lead_length = self.lead_length()
+            lines = [(("" if i is None else "%i:" % i).rjust(lead_length), line)
+                     for i, line in lines]
+        else:
+            lines = [("", line) for i, line in lines]
+        for j, (lead, line) in enumerate(lines):
+            if j: self.write("\n")
+            self.write(lead)
+            self.write(line)
+        return self.finish()
+
 
 class TermColorFormat(TermFormat):
     """
@@ -120,15 +178,7 @@ class TermColorFormat(TermFormat):
 
     def add(self, text, color):
         text = self.sanitize(text)
-        self.current += self.describe(text, color)
-
-    def get(self):
-        if self.lineno:
-            lead_length = self.lead_length()
-            return "\n".join(("%i:" % i).rjust(lead_length) + line
-                             for i, line in self.lines)
-        else:
-            return "\n".join(line for i, line in self.lines)
+        self.current.append(self.describe(text, color))
 
 
 class TermPlainFormat(TermFormat):
@@ -151,9 +201,9 @@ class TermPlainFormat(TermFormat):
         arrow symbol, \\union\\ instead of the union symbol, etc.)
     """
 
-    def __call__(self):
-        t = super(TermPlainFormat, self).__call__()
-        t.current_below = ""
+    def __call__(self, sink = None):
+        t = super(TermPlainFormat, self).__call__(sink)
+        t.current_below = []
         return t
 
     def describe(self, text, label):
@@ -164,22 +214,15 @@ class TermPlainFormat(TermFormat):
 
     def end_line(self):
         super(TermPlainFormat, self).end_line()
-        if self.current_below.strip():
-            self.lines.append((None, self.current_below))
-        self.current_below = ""
+        below = "".join(self.current_below)
+        if below.strip():
+            self.lines.append((None, below))
+        self.current_below = []
 
     def add(self, text, label):
         text = self.sanitize(text)
-        self.current += text
-        self.current_below += (label or " ") * len(text)
-
-    def get(self):
-        if self.lineno:
-            lead_length = self.lead_length()
-            return "\n".join(("" if i is None else "%i:" % i).rjust(lead_length) + line
-                             for i, line in self.lines)
-        else:
-            return "\n".join(line for i, line in self.lines)
+        self.current.append(text)
+        self.current_below.append((label or " ") * len(text))
 
 
 class HTMLFormat(Format):
@@ -217,35 +260,60 @@ class HTMLFormat(Format):
         quaint encoding.
         """
         text = super(HTMLFormat, self).sanitize(text)
-        # honestly this is pretty terrible, this functionality has got
-        # to be somewhere in a standard lib
-        return "".join(
-            (c if (ord(c) < 128 and c not in '&<>"')
-             else "&%s;" % (html_entities.get(ord(c), None) or ("#%i" % ord(c))))
-            for c in text)
-
-    def __call__(self):
-        t = self.__class__(self.lineno, self.encode)
-        t.text = "<table class=quaint_source>\n"
+        return escape_html(text)
+
+    def __call__(self, sink = None):
+        t = super(HTMLFormat, self).__call__(sink)
+        t.write("<table class=quaint_source>\n")
         return t
 
     def new_line(self, i):
-        self.text += "<tr class=sourcerow%i>" % (i % 2)
         if self.lineno:
-            self.text += "<td class=lineno>%i</td>" % i
-        self.text += "<td class=sourceline>"
+            self.write("<tr class=sourcerow%i><td class=lineno>%i</td><td class=sourceline>"
+                       % (i % 2, i))
+        else:
+            self.write("<tr class=sourcerow%i><td class=sourceline>" % (i % 2))
 
     def end_line(self):
-        self.text += "</td></tr>\n"
+        self.write("</td></tr>\n")
 
     def add(self, text, cls):
         text = self.sanitize(text)
         if not cls: cls = 'default'
-        self.text += "<span class=%(cls)s>%(text)s</span>" % locals()
+        self.write("<span class=%(cls)s>%(text)s</span>" % locals())
 
     def get(self):
-        self.text += "</table>\n"
-        return self.text
+        self.write("</table>\n")
+        return self.finish()
+
+
+class _HTMLEscapes(dict):
+    """
+    Translation table for str.translate, mapping each code point to
+    itself or to its html entity. Entries are computed the first time
+    a code point is seen.
+    """
+
+    def __missing__(self, point):
+        c = chr(point)
+        if point < 128 and c not in '&<>"':
+            value = c
+        else:
+            value = "&%s;" % (html_entities.get(point, None) or ("#%i" % point))
+        self[point] = value
+        return value
+
+_html_escapes = _HTMLEscapes()
+
+@lru_cache(maxsize = 4096)
+def escape_html(text):
+    """
+    Escapes all non-ASCII characters as well as the special
+    characters &<>" using html entities. The same short texts
+    (identifiers, operators, whitespace) come up over and over when
+    highlighting, so the results are cached.
+    """
+    return text.translate(_html_escapes)
 
 
 basic_html_style = """
@@ -382,7 +450,70 @@ td.sourceline {
 ### HIGHLIGHT ###
 #################
 
-def highlight(specifications, format, context = 0):
+def segment_spans(leftmost, rightmost, specifications):
+    """
+    Cuts [leftmost, rightmost) into a list of [start, end, spec]
+    segments, where spec is the (location, attribute) pair that covers
+    the segment, or [None, None] for the gaps. specifications must be
+    sorted by (start, -end).
+
+    Each specification splits the segment that contains its start in
+    two (or three, if it also ends inside it). Since the
+    specifications come sorted by start, that segment is always the
+    first one that has not been passed yet, so this is done as a sweep
+    over the sorted specifications: segments that lie before the
+    current start are moved to the output for good, and the remaining
+    ones wait in a deque, at the front of which all insertions happen.
+
+    Zero-length segments are kept (the formats still get an add() for
+    them), but never split.
+    """
+    done = []
+    pending = deque([[leftmost, rightmost, [None, None]]])
+    for new in specifications:
+        location, attribute = new
+        start, end = location.span
+        while pending:
+            other = pending[0]
+            start2, end2, _ = other
+            if start2 != end2 and start2 <= start < end2:
+                break
+            done.append(pending.popleft())
+        else:
+            # Past the end of everything: fill the gap and append.
+            pending.extend([[done[-1][1], start, [None, None]],
+                            [start, end, new]])
+            continue
+        pending.popleft()
+        done.append([start2, start, _])
+        if start2 <= end < end2:
+            pending.appendleft([end, end2, _])
+        pending.appendleft([start, end, new])
+    done.extend(pending)
+    return done
+
+def clip_specifications(specifications, leftmost, rightmost):
+    """
+    Restricts the (location, attribute) pairs in specifications to
+    the range [leftmost, rightmost). Pairs that lie outside of it are
+    dropped, the others are cut at its boundaries. Zero-length
+    locations are kept if they are in the range, boundaries included.
+    """
+    results = []
+    for location, attribute in specifications:
+        start, end = location.span
+        if start == end:
+            if leftmost <= start <= rightmost:
+                results.append((location, attribute))
+        elif start < rightmost and end > leftmost:
+            if start < leftmost or end > rightmost:
+                location = Location(location.source,
+                                    (max(start, leftmost), min(end, rightmost)),
+                                    None)
+            results.append((location, attribute))
+    return results
+
+def highlight(specifications, format, context = 0, sink = None, lines = None):
     """
     Returns a highlighted version of the excerpts contained in several
     locations. Each excerpt may be highlighted with different
@@ -394,16 +525,26 @@ def highlight(specifications, format, context = 0):
         location represents an excerpt in the source code that will be
         highlighted accordingly to the attribute given.
 
-    format: an function with no arguments returning a stateful object
-        which constructs the text. The object returned by format()
-        must respond to the following messages: add_line(lineno),
-        end_line(), add(text, attribute), get() (to get the result).
+    format: an function taking an optional sink and returning a
+        stateful object which constructs the text. The object returned
+        by format(sink) must respond to the following messages:
+        new_line(lineno), end_line(), add(text, attribute), get() (to
+        get the result).
 
     context: an integer >= 0. it is the number of lines that will be
         printed before the first excerpt, and after the end of the
         last excerpt (no lines will be printed before the beginning of
         the source and/or after the end).
 
+    sink: (default: None) an object with a write method, e.g. a file.
+        If given, the output is written there in chunks, as it is
+        produced, instead of being returned (highlight returns None).
+
+    lines: (default: None) a (first, last) pair of line numbers
+        (inclusive). If given, exactly these lines are shown (as far
+        as they exist) and context is ignored. Locations that cross
+        the boundaries are cut, and those outside are ignored.
+
     The attributes given in the specifications list have semantics
     that depend on the format. Common formats are TermColorFormat,
     TermPlainFormat and HTMLFormat.
@@ -430,49 +571,60 @@ def highlight(specifications, format, context = 0):
     assert all(loc1.source is l.source for l, _a in specifications[1:])
     source = loc1.source
 
-    leftmost = min(location.start for location, attribute in specifications)
-    rightmost = max(location.end for location, attribute in specifications)
-    (l1, col1), (l2, col2) = linecol(source, leftmost, rightmost, True)
+    index = line_index(source)
+
+    if lines is None:
+        leftmost = min(location.start for location, attribute in specifications)
+        rightmost = max(location.end for location, attribute in specifications)
+        (l1, col1), (l2, col2) = index.linecol(leftmost, rightmost, True)
+
+        # extend the window to whole lines, plus context
+        leftmost -= index.text_length(l1-context, l1-1) + col1 - 1 + context
+        rightmost += index.text_length(l2, l2+context) - col2 + context
+        leftmost = max(leftmost, 0)
+        i = max(l1 - context, 1)
+
+    else:
+        first, last = lines
+        first = min(max(first, 1), index.nlines)
+        last = max(min(last, index.nlines), first)
+        # The window includes the newlines around the lines, so that
+        # the locations are cut (and the segments split) exactly as
+        # they would be if the whole source was highlighted. What
+        # falls on the lines before and after is dropped below.
+        leftmost = max(index.line_start(first) - 1, 0)
+        rightmost = index.line_start(last + 1)
+        specifications = clip_specifications(specifications, leftmost, rightmost)
+        # stable, so the order above breaks ties between locations
+        # that were cut to the same extent
+        specifications.sort(key = lambda loc__a: (loc__a[0].start, -loc__a[0].end))
+
+        spans = segment_spans(leftmost, rightmost, specifications)
+        format = format(sink)
+        i = first if first == 1 else first - 1
+        if i == first:
+            format.new_line(i)
 
-    def insert_span(spans, new):
-#         rem = []
-        location, attribute = new
-        start, end = location.span
-#         print "BAH", start, end
-        for i, other in enumerate(spans):
-            start2, end2, _ = other
-            if start2 == end2:
-#                rem.append(i)
-                continue
-            if start2 <= start < end2:
-#                 print start2 <= end <= end2, (start, end), (start2, end2)
-                other[1] = start
-                spans.insert(i+1, [start, end, new])
-                if start2 <= end < end2:
-                    spans.insert(i+2, [end, end2, _])
-                break
-        else:
-            spans.append([end2, start, [None, None]])
-            spans.append([start, end, new])
-#         for j in reversed(rem):
-#             spans.pop(j)
-
-    # it's probably a bit of a waste of time to split lines, but whatever
-    lines = source.split('\n')
-    leftmost -= sum(map(len, lines[l1-1-context:l1-1])) + col1 - 1 + context
-    rightmost += sum(map(len, lines[l2-1:l2+context])) - col2 + context
-    leftmost = max(leftmost, 0)
-
-    spans = [[leftmost, rightmost, [None, None]]]
-    for spec in specifications:
-        insert_span(spans, spec)
-
-#     for a, b, c in spans:
-#         print a, b, repr(source[a:b])
-#     print "DONE"
-
-    i = max(l1 - context, 1)
-    format = format()
+        for start, end, (location, attribute) in spans:
+            these_lines = source[start:end].split('\n')
+            if first <= i <= last:
+                format.add(these_lines[0], attribute)
+            for line in these_lines[1:]:
+                if i == last:
+                    format.end_line()
+                    return format.get()
+                i += 1
+                if i == first:
+                    format.new_line(i)
+                else:
+                    format.end_line()
+                    format.new_line(i)
+                format.add(line, attribute)
+        format.end_line()
+        return format.get()
+
+    spans = segment_spans(leftmost, rightmost, specifications)
+    format = format(sink)
     format.new_line(i)
     i += 1
 
@@ -486,4 +638,3 @@ def highlight(specifications, format, context = 0):
             i += 1
     format.end_line()
     return format.get()
-
@@ -0,0 +1,137 @@
+
+import os
+
+from . import codehl, format
+from .codehl import ASTHighlighter, html_highlight_style
+from .format import HTMLFormat, basic_html_style, escape_html
+from ..parse.standard import parser, decode
+from ..tools.bulk import digest, walk_tree, write_atomic, process_tree, load_manifest
+
+
+__all__ = ['HTMLPages', 'highlight_tree']
+
+
+page_template = """<html>
+<head>
+  <title>%(title)s</title>
+  <link rel="stylesheet" type="text/css" href="%(stylesheet)s">
+</head>
+<body>
+%(body)s</body>
+</html>
+"""
+
+
+class HTMLPages(object):
+    """
+    Turns quaint source code into standalone HTML pages that link to a
+    shared style sheet. Instances are picklable, so that they can be
+    given to process_tree.
+
+    stylesheet :: str: (default: "quaint.css") path of the style
+        sheet, relative to the root of the site.
+
+    lineno :: Boolean: (default: True) do we show line numbers?
+
+    encode :: Boolean: (default: False) do we encode the source
+        with the quaint encoding?
+    """
+
+    def __init__(self, stylesheet = "quaint.css", lineno = True, encode = False):
+        self.stylesheet = stylesheet
+        self.lineno = lineno
+        self.encode = encode
+
+    def style(self):
+        """
+        Contents of the style sheet.
+        """
+        return basic_html_style + html_highlight_style
+
+    def key(self):
+        """
+        Describes everything besides the source that the pages depend
+        on: the settings, and the code of the highlighter and of the
+        formats, so that changing them invalidates the cached pages.
+        """
+        parts = [repr((self.stylesheet, self.lineno, self.encode)).encode("utf-8")]
+        for module in (codehl, format):
+            with open(module.__file__, "rb") as f:
+                parts.append(f.read())
+        return digest(b"\0".join(parts))
+
+    def __call__(self, text, path):
+        """
+        Returns the page for the source code in text. path is the
+        position of the source relative to the root of the site.
+        """
+        tree = parser.parse2(decode(text))
+        table = ASTHighlighter(HTMLFormat(self.lineno, self.encode)).highlight(tree)
+        depth = len(os.path.normpath(path).split(os.sep)) - 1
+        return page_template % dict(title = escape_html(path),
+                                    stylesheet = "../" * depth + self.stylesheet,
+                                    body = table)
+
+
+def index_page(paths, stylesheet):
+    items = "".join('<li><a href="%s">%s</a></li>\n'
+                    % (escape_html("/".join(link.split(os.sep))), escape_html(name))
+                    for name, link in paths)
+    return page_template % dict(title = "Index",
+                                stylesheet = stylesheet,
+                                body = "<ul>\n%s</ul>\n" % items)
+
+
+def highlight_tree(source, destination, jobs = None, force = False,
+                   pages = None, index = "index.html"):
+    """
+    Highlights every file under the source directory as an HTML page
+    under the destination directory, at the same relative path plus
+    ".html". Returns a BulkReport.
+
+    The style sheet is written once at the root of the destination,
+    along with an index page that links to all the pages (unless
+    index is None). Files whose source and settings are the same as
+    in the previous run are skipped (see process_tree). The pages made
+    by a previous run for sources that were since removed, or that
+    now fail to highlight, are deleted.
+
+    pages :: HTMLPages: (default: HTMLPages()) the page settings.
+    """
+    if pages is None:
+        pages = HTMLPages()
+
+    style = pages.style().encode("utf-8")
+    stylesheet = os.path.join(destination, pages.stylesheet)
+    try:
+        with open(stylesheet, "rb") as f:
+            same = f.read() == style
+    except OSError:
+        same = False
+    if not same:
+        write_atomic(stylesheet, style)
+
+    previous = load_manifest(destination)
+    report = process_tree(pages, source, destination, jobs = jobs, force = force,
+                          rename = lambda path: path + ".html",
+                          key = pages.key(), relative = True)
+    # The manifest only lists the sources that were highlighted
+    current = load_manifest(destination)
+    for rel in previous:
+        if rel not in current:
+            try:
+                os.remove(os.path.join(destination, rel + ".html"))
+            except OSError:
+                pass
+
+    if index is not None:
+        failed = set(path for path, message in report.errors)
+        entries = []
+        for path, _ in walk_tree(source, destination):
+            rel = os.path.relpath(path, source)
+            if rel not in failed:
+                entries.append((rel, rel + ".html"))
+        write_atomic(os.path.join(destination, index),
+                     index_page(entries, pages.stylesheet).encode("utf-8"))
+
+    return report
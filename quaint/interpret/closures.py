@@ -0,0 +1,466 @@
+
+import operator
+from functools import reduce
+
+from ..parse.generic.ast import Canon
+from ..tools.err import Exc
+
+
+__all__ = ['ClosureCompiler', 'standard_builtins', 'evaluate']
+
+
+# Evaluates Canon trees once they went through StaticExpr (see
+# evaluate.static_operators), so that they only contain the following
+# commands: symbol, value, void, apply, begin, table, if, lambda and
+# quote, as well as switch (see evaluate.SwitchTable).
+#
+# Each node is compiled once into a Python closure that takes the
+# current frame and returns the node's value. Variables are resolved
+# at compile time:
+#
+# * Parameters and locals of a lambda live in the frame of each call,
+#   a list: [parent frame, parameters..., locals...]. A variable of an
+#   enclosing lambda is found by following the parent frames, the
+#   number of hops being known at compile time.
+# * Everything else is a global, which lives in a list owned by the
+#   compiler, at an index given to its name the first time it is
+#   compiled.
+#
+# So running code involves no dispatch on the kind of node and no
+# dictionary lookup, only calls to closures and list indexing.
+#
+# The assignments "name = value" and "name ← value" bind name in the
+# enclosing lambda (as a local) or, at the top level, as a global. As
+# in Python, assigning a name anywhere in a lambda makes it local in
+# the whole lambda.
+#
+# Calling a function with the wrong number of arguments raises
+# eval/arity, or TypeError for functions of up to 2 parameters and no
+# locals, which are plain Python lambdas. Note that each call of a
+# quaint function uses a few Python frames, so deep recursion can hit
+# Python's recursion limit.
+
+assignment_operators = ('=', '←')
+
+
+class Unbound:
+    """
+    Value of a variable that was not assigned yet. Calling it raises
+    the same error as reading it, which spares calls to globals a
+    check.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def error(self):
+        return Exc('eval/unbound')("Unbound variable: {name}", name = self.name)
+
+    def __call__(self, *args):
+        raise self.error()
+
+    def __repr__(self):
+        return "<unbound %s>" % self.name
+
+
+###############
+### HELPERS ###
+###############
+
+def to_string(x):
+    if isinstance(x, float) and x.is_integer():
+        return str(int(x))
+    elif isinstance(x, str):
+        return x
+    elif isinstance(x, tuple):
+        return "[%s]" % ", ".join(map(to_string, x))
+    elif x is None:
+        return "void"
+    else:
+        return str(x)
+
+def minus(a, b):
+    # -x is applied to (void, x)
+    return -b if a is None else a - b
+
+def assignment_target(node):
+    # Returns the name assigned by node if it is an assignment, None
+    # otherwise.
+    if node.all[1] != 'apply':
+        return None
+    fn, arg = node.all[2:]
+    if (isinstance(fn, Canon) and fn.all[1] == 'symbol'
+        and fn.all[2] in assignment_operators
+        and isinstance(arg, Canon) and arg.all[1] == 'table'):
+        if (len(arg.all) != 4 or not isinstance(arg.all[2], Canon)
+            or arg.all[2].all[1] != 'symbol'):
+            raise Exc('compile/bad_assignment')(
+                "Only a variable can be assigned, in {node}", node = node)
+        return arg.all[2].all[2]
+    return None
+
+def assigned_names(body):
+    # Names assigned in body, not counting nested lambdas (and quotes),
+    # in order of appearance.
+    names = []
+    stack = [body]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, Canon) or node.all[1] in ('lambda', 'quote'):
+            continue
+        if node.all[1] == 'apply':
+            name = assignment_target(node)
+            if name is not None and name not in names:
+                names.append(name)
+        stack.extend(reversed(node.all[2:]))
+    return names
+
+
+standard_builtins = {
+    '+': operator.add,
+    '-': minus,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '//': operator.floordiv,
+    '%': operator.mod,
+    '^': operator.pow,
+    '<': operator.lt,
+    '>': operator.gt,
+    '=<': operator.le,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '/=': operator.ne,
+    '¬': lambda a, b: not b,
+    '∧': lambda a, b: a and b,
+    '∨': lambda a, b: a or b,
+    '∈': lambda a, b: a in b,
+    '∉': lambda a, b: a not in b,
+    '++': operator.add,
+    '__string_append': lambda *parts: "".join(parts),
+    '__string_convert': to_string,
+    'true': True,
+    'false': False,
+    'len': len,
+    'range': lambda a, b: tuple(range(int(a), int(b))),
+    'map': lambda f, t: tuple(map(f, t)),
+    'filter': lambda f, t: tuple(filter(f, t)),
+    'fold': lambda f, init, t: reduce(f, t, init),
+    'sum': sum,
+    'join': lambda sep, t: sep.join(map(to_string, t)),
+    'str': to_string,
+    'print': lambda *args: print(*map(to_string, args)),
+    }
+
+
+#############
+### SCOPE ###
+#############
+
+class Scope:
+    """
+    Variables of a lambda: its parameters, then its locals, each at
+    an index of the frame (index 0 is the parent frame).
+    """
+
+    def __init__(self, parent, parameters, locals):
+        self.parent = parent
+        self.slots = {}
+        for name in parameters:
+            self.slots[name] = len(self.slots) + 1
+        self.nparameters = len(self.slots)
+        for name in locals:
+            if name not in self.slots:
+                self.slots[name] = len(self.slots) + 1
+        self.locals = list(self.slots)[self.nparameters:]
+
+
+################
+### COMPILER ###
+################
+
+class ClosureCompiler:
+    """
+    Compiles Canon trees into Python closures (see above).
+
+    builtins: (default: standard_builtins) a dictionary of the
+        initial globals.
+
+    The globals persist from one compiled tree to the next, so that a
+    ClosureCompiler can be used like an interactive session.
+    """
+
+    def __init__(self, builtins = None):
+        self.names = {}
+        self.values = []
+        for name, value in (standard_builtins if builtins is None else builtins).items():
+            self.define(name, value)
+
+    def global_index(self, name):
+        try:
+            return self.names[name]
+        except KeyError:
+            i = self.names[name] = len(self.values)
+            self.values.append(Unbound(name))
+            return i
+
+    def define(self, name, value):
+        self.values[self.global_index(name)] = value
+
+    def lookup(self, name):
+        value = self.values[self.global_index(name)]
+        if isinstance(value, Unbound):
+            raise value.error()
+        return value
+
+    def resolve(self, name, scope):
+        # Returns (depth, index): the variable is at index in the frame
+        # depth levels up, or, if depth is None, at index in the
+        # globals.
+        depth = 0
+        while scope is not None:
+            i = scope.slots.get(name)
+            if i is not None:
+                return depth, i
+            scope = scope.parent
+            depth += 1
+        return None, self.global_index(name)
+
+    def compile(self, node):
+        """
+        Returns a function of no arguments that evaluates node.
+        """
+        fn = self.compile_node(node, None)
+        return lambda: fn(None)
+
+    def run(self, node):
+        return self.compile(node)()
+
+    def compile_node(self, node, scope):
+        if not isinstance(node, Canon):
+            raise Exc('compile/not_canon')("Cannot compile {node}", node = node)
+        command = node.all[1]
+        try:
+            method = getattr(self, 'compile_' + command)
+        except AttributeError:
+            raise Exc('compile/unknown_command')(
+                "Cannot compile {command} nodes (did StaticExpr run?)",
+                command = command)
+        return method(node, scope)
+
+    def compile_value(self, node, scope):
+        value = node.all[2]
+        return lambda frame: value
+
+    def compile_void(self, node, scope):
+        return lambda frame: None
+
+    def compile_quote(self, node, scope):
+        # A quoted symbol is its name, anything else is the node
+        quoted = node.all[2]
+        if isinstance(quoted, Canon) and quoted.all[1] == 'symbol':
+            quoted = quoted.all[2]
+        return lambda frame: quoted
+
+    def compile_symbol(self, node, scope):
+        name = node.all[2]
+        depth, i = self.resolve(name, scope)
+        if depth is None:
+            values = self.values
+            def get(frame):
+                value = values[i]
+                if value.__class__ is Unbound:
+                    raise value.error()
+                return value
+        elif i <= scope.nparameters and depth == 0:
+            # parameters are always bound
+            def get(frame):
+                return frame[i]
+        elif depth == 0:
+            def get(frame):
+                value = frame[i]
+                if value.__class__ is Unbound:
+                    raise value.error()
+                return value
+        elif depth == 1:
+            def get(frame):
+                value = frame[0][i]
+                if value.__class__ is Unbound:
+                    raise value.error()
+                return value
+        else:
+            def get(frame):
+                for _ in range(depth):
+                    frame = frame[0]
+                value = frame[i]
+                if value.__class__ is Unbound:
+                    raise value.error()
+                return value
+        return get
+
+    def compile_assignment(self, name, value, scope):
+        depth, i = self.resolve(name, scope)
+        if depth is None:
+            values = self.values
+            def assign(frame):
+                values[i] = rval = value(frame)
+                return rval
+        else:
+            # assigned names are locals of the innermost scope
+            def assign(frame):
+                frame[i] = rval = value(frame)
+                return rval
+        return assign
+
+    def compile_apply(self, node, scope):
+        fn, arg = node.all[2:]
+        name = assignment_target(node)
+        if name is not None:
+            return self.compile_assignment(
+                name, self.compile_node(arg.all[3], scope), scope)
+
+        if isinstance(arg, Canon) and arg.all[1] == 'table':
+            args = [self.compile_node(x, scope) for x in arg.all[2:]]
+        else:
+            args = [self.compile_node(arg, scope)]
+        n = len(args)
+
+        if fn.all[1] == 'symbol' and self.resolve(fn.all[2], scope)[0] is None:
+            # Calling a global: an Unbound raises when called, so the
+            # function can be fetched without a check.
+            values = self.values
+            i = self.global_index(fn.all[2])
+            if n == 0:
+                return lambda frame: values[i]()
+            elif n == 1:
+                a, = args
+                return lambda frame: values[i](a(frame))
+            elif n == 2:
+                a, b = args
+                return lambda frame: values[i](a(frame), b(frame))
+            elif n == 3:
+                a, b, c = args
+                return lambda frame: values[i](a(frame), b(frame), c(frame))
+            else:
+                return lambda frame: values[i](*[x(frame) for x in args])
+
+        f = self.compile_node(fn, scope)
+        if n == 0:
+            return lambda frame: f(frame)()
+        elif n == 1:
+            a, = args
+            return lambda frame: f(frame)(a(frame))
+        elif n == 2:
+            a, b = args
+            return lambda frame: f(frame)(a(frame), b(frame))
+        elif n == 3:
+            a, b, c = args
+            return lambda frame: f(frame)(a(frame), b(frame), c(frame))
+        else:
+            return lambda frame: f(frame)(*[x(frame) for x in args])
+
+    def compile_begin(self, node, scope):
+        statements = [self.compile_node(x, scope) for x in node.all[2:]]
+        n = len(statements)
+        if n == 0:
+            return lambda frame: None
+        elif n == 1:
+            return statements[0]
+        elif n == 2:
+            a, b = statements
+            def begin(frame):
+                a(frame)
+                return b(frame)
+            return begin
+        else:
+            first = statements[:-1]
+            last = statements[-1]
+            def begin(frame):
+                for statement in first:
+                    statement(frame)
+                return last(frame)
+            return begin
+
+    def compile_table(self, node, scope):
+        items = [self.compile_node(x, scope) for x in node.all[2:]]
+        n = len(items)
+        if n == 0:
+            return lambda frame: ()
+        elif n == 1:
+            a, = items
+            return lambda frame: (a(frame),)
+        elif n == 2:
+            a, b = items
+            return lambda frame: (a(frame), b(frame))
+        elif n == 3:
+            a, b, c = items
+            return lambda frame: (a(frame), b(frame), c(frame))
+        else:
+            return lambda frame: tuple([x(frame) for x in items])
+
+    def compile_if(self, node, scope):
+        # A chain of elifs is compiled in a loop, and its conditions
+        # are tried in a loop, so that long chains don't blow the
+        # stack.
+        branches = []
+        while isinstance(node, Canon) and node.all[1] == 'if':
+            condition, iftrue, node = node.all[2:]
+            branches.append((self.compile_node(condition, scope),
+                             self.compile_node(iftrue, scope)))
+        iffalse = self.compile_node(node, scope)
+        if len(branches) == 1:
+            (condition, iftrue), = branches
+            return lambda frame: iftrue(frame) if condition(frame) else iffalse(frame)
+        def choose(frame):
+            for condition, iftrue in branches:
+                if condition(frame):
+                    return iftrue(frame)
+            return iffalse(frame)
+        return choose
+
+    def compile_switch(self, node, scope):
+        # (switch subject default (table value body) ...), see
+        # evaluate.SwitchTable
+        subject, default, *cases = node.all[2:]
+        subject = self.compile_node(subject, scope)
+        default = self.compile_node(default, scope)
+        table = {}
+        for case in cases:
+            value, body = case.all[2:]
+            if value.all[2] not in table:
+                table[value.all[2]] = self.compile_node(body, scope)
+        get = table.get
+        return lambda frame: get(subject(frame), default)(frame)
+
+    def compile_lambda(self, node, scope):
+        parameters, body = node.all[2:]
+        inner = Scope(scope, parameters, assigned_names(body))
+        body = self.compile_node(body, inner)
+        n = inner.nparameters
+        padding = [Unbound(name) for name in inner.locals]
+
+        if not padding and n == 0:
+            def make(frame):
+                return lambda: body([frame])
+        elif not padding and n == 1:
+            def make(frame):
+                return lambda a: body([frame, a])
+        elif not padding and n == 2:
+            def make(frame):
+                return lambda a, b: body([frame, a, b])
+        else:
+            def make(frame):
+                def function(*args):
+                    if len(args) != n:
+                        raise Exc('eval/arity')(
+                            "Expected {n} arguments, got {m}", n = n, m = len(args))
+                    return body([frame, *args, *padding])
+                return function
+        return make
+
+
+def evaluate(node, builtins = None):
+    """
+    Evaluates the Canon tree node (see ClosureCompiler) and returns
+    its value.
+    """
+    return ClosureCompiler(builtins).run(node)
@@ -13,6 +13,8 @@ from colonel.tools.svg import Span
 
 from quaint.parse import parser, encode, decode
 from quaint.parse.generic.ast import Canon, CanonVisitor, CanonModifier, Meta
+from quaint.interpret.closures import standard_builtins, assignment_operators
+from quaint.interpret.lower import function_operators
 
 
 def oper_check(node):
@@ -43,19 +45,24 @@ def dotdot(node, visit):
     return new_value
 
 def tilde(node, visit):
-    oper, value = oper_check(node)
-    m1, *m2 = value.arguments[0].arguments
-    op1, v1 = oper_check(m1)
-    assert (op1.arguments[0] in [':', '~'])
-    new_value = m1
-    synt = v1.arguments[0]
-    synt.arguments = synt.arguments + list(m2)
+    # (a: b) ~ (c: d) ~ (e: f) is nested to the left. We walk down the
+    # chain in a loop, gathering the clauses c: d and e: f, which are
+    # appended to the arguments of (a: b).
+    groups = []
+    while True:
+        oper, value = oper_check(node)
+        m1, *m2 = value.arguments[0].arguments
+        groups.append(m2)
+        op1, v1 = oper_check(m1)
+        assert (op1.arguments[0] in [':', '~'])
+        if op1.arguments[0] == ':':
+            break
+        node = m1
 
-    if op1.arguments[0] == '~':
-        return tilde(new_value, visit)
-    else:
-        new_value = visit(new_value)
-        return new_value
+    synt = v1.arguments[0]
+    for m2 in reversed(groups):
+        synt.arguments = synt.arguments + m2
+    return visit(m1)
 
 
 class Colon:
@@ -77,26 +84,39 @@ class Colon:
         return name, new_args
 
     def fn_if(self, node, args, visit):
-        condition, iftrue, *rest = args
-        # iftrue = args[1]
-        if len(rest) == 0:
-            iffalse = Canon(Meta(None, None), 'void')
-        else:
-            statement = rest[0]
+        # The elif clauses are gathered in a loop rather than by
+        # recursion, so that long chains don't blow the stack. args is
+        # kept reversed, as a stack, the arguments of each elif being
+        # pushed on it.
+        args = list(reversed(args))
+        branches = []
+        while True:
+            condition = args.pop()
+            iftrue = args.pop()
+            branches.append((node, condition, iftrue))
+            if not args:
+                iffalse = Canon(Meta(None, None), 'void')
+                break
+            statement = args.pop()
             word, subargs = self.extract_colon_spec(statement)
             if word == 'else':
                 assert len(subargs) == 1
-                assert len(rest) == 1
+                assert not args
                 iffalse = subargs[0]
+                break
             elif word == 'elif':
-                iffalse = self.fn_if(statement, subargs + rest[1:], visit)
+                node = statement
+                args.extend(reversed(subargs))
             else:
                 raise E['if/wrong_syntax']('Expected else or elif.')
 
-        return Canon(node.meta, 'if',
-                     visit(condition),
-                     visit(iftrue),
-                     visit(iffalse))
+        rval = visit(iffalse)
+        for node, condition, iftrue in reversed(branches):
+            rval = Canon(node.meta, 'if',
+                         visit(condition),
+                         visit(iftrue),
+                         rval)
+        return rval
 
     def fn_lambda(self, node, args, visit):
         arguments, body = args
@@ -112,6 +132,17 @@ colon = Colon()
 
 
 
+# The operators argument of StaticExpr for the standard syntax (see
+# also lower.Lower, which expands the same macros while converting the
+# phase 1 tree). function_operators become plain function applications
+# on a table of their operands.
+static_operators = dict({op: oper_as_function for op in function_operators},
+                        **{'.': dot,
+                           '..': dotdot,
+                           '~': tilde,
+                           ':': colon.process})
+
+
 class StaticExpr(CanonModifier):
 
     def __init__(self, operators):
@@ -128,6 +159,272 @@ class StaticExpr(CanonModifier):
 
 
 
+# Operators that ConstantFold may apply at compile time: their result
+# must only depend on their arguments, and they must have no side
+# effects. (range is pure, but would inline tables of any size.)
+pure_operators = {op: standard_builtins[op]
+                  for op in ['+', '-', '*', '/', '//', '%', '^',
+                             '<', '>', '=<', '>=', '==', '/=',
+                             '¬', '∧', '∨', '∈', '∉', '++',
+                             '__string_append', '__string_convert',
+                             'len', 'join', 'str']}
+
+# Symbols that ConstantFold replaces by their value.
+constant_symbols = {'true': True, 'false': False}
+
+def is_constant(node):
+    return (isinstance(node, Canon)
+            and (node.command in ('value', 'void')
+                 or (node.command == 'table'
+                     and all(map(is_constant, node.arguments)))))
+
+def constant_value(node):
+    if node.command == 'table':
+        return tuple(map(constant_value, node.arguments))
+    elif node.command == 'void':
+        return None
+    else:
+        return node.arguments[0]
+
+def constant_node(meta, value):
+    # Returns a node that evaluates to value, or None if value can't
+    # be written in a tree.
+    if value is None:
+        return Canon(meta, 'void')
+    elif isinstance(value, (bool, int, float, str)):
+        return Canon(meta, 'value', value)
+    elif isinstance(value, tuple):
+        items = [constant_node(meta, x) for x in value]
+        if all(x is not None for x in items):
+            return Canon(meta, 'table', *items)
+    return None
+
+def bound_names(node):
+    # Names that are assigned or that are parameters anywhere in node
+    names = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, Canon) or node.command == 'quote':
+            continue
+        if node.command == 'lambda':
+            names.update(node.arguments[0])
+        elif node.command == 'apply':
+            fn, arg = node.arguments
+            if (fn.command == 'symbol' and fn.arguments[0] in assignment_operators
+                and arg.command == 'table' and arg.arguments
+                and arg.arguments[0].command == 'symbol'):
+                names.add(arg.arguments[0].arguments[0])
+        stack.extend(node.arguments)
+    return names
+
+
+class ConstantFold(CanonModifier):
+    """
+    Evaluates the parts of a tree (once StaticExpr ran) that only
+    depend on constants:
+
+    * an application of a pure operator to constants (values, void
+      and tables of constants) becomes its result, e.g. 1 + 2 becomes
+      3, unless it raises an error, which is then left to happen at
+      run time;
+    * adjacent constant strings in a string, i.e. in the arguments of
+      __string_append, are joined;
+    * an if on a constant condition becomes the branch it selects;
+    * constant statements of a begin, except the last, are dropped.
+
+    operators: (default: pure_operators) maps operators to the
+        functions that compute them, which must be those the tree will
+        be evaluated with.
+
+    constants: (default: constant_symbols) maps symbols to their
+        values.
+
+    Names that are assigned or that are parameters anywhere in the
+    tree are left alone. fold finds them before visiting the tree,
+    so it should be used rather than visit.
+    """
+
+    def __init__(self, operators = None, constants = None):
+        self.operators = pure_operators if operators is None else operators
+        self.constants = constant_symbols if constants is None else constants
+        self.shadowed = set()
+
+    def fold(self, node):
+        self.shadowed = bound_names(node)
+        return self.visit(node)
+
+    def visit_symbol(self, node):
+        name = node.arguments[0]
+        if name in self.constants and name not in self.shadowed:
+            folded = constant_node(node.meta, self.constants[name])
+            if folded is not None:
+                return folded
+        return node
+
+    def visit_apply(self, node):
+        node.arguments = list(map(self.visit, node.arguments))
+        fn, arg = node.arguments
+        if (fn.command != 'symbol' or fn.arguments[0] not in self.operators
+            or fn.arguments[0] in self.shadowed):
+            return node
+        name = fn.arguments[0]
+        args = arg.arguments if arg.command == 'table' else [arg]
+        if all(map(is_constant, args)):
+            try:
+                value = self.operators[name](*map(constant_value, args))
+            except Exception:
+                return node
+            folded = constant_node(node.meta, value)
+            if folded is not None:
+                return folded
+            return node
+        if name == '__string_append':
+            pieces = []
+            for piece in args:
+                if (pieces and is_constant(piece) and is_constant(pieces[-1])
+                    and isinstance(constant_value(piece), str)
+                    and isinstance(constant_value(pieces[-1]), str)):
+                    pieces[-1] = Canon(pieces[-1].meta, 'value',
+                                       constant_value(pieces[-1]) + constant_value(piece))
+                else:
+                    pieces.append(piece)
+            arg.arguments = pieces
+        return node
+
+    def visit_begin(self, node):
+        statements = list(map(self.visit, node.arguments))
+        node.arguments = [x for x in statements[:-1] if not is_constant(x)] + statements[-1:]
+        return node
+
+    def visit_if(self, node):
+        # Chains of elifs are walked in a loop
+        chain = []
+        while isinstance(node, Canon) and node.command == 'if':
+            condition, iftrue, iffalse = node.arguments
+            condition = self.visit(condition)
+            if is_constant(condition):
+                node = iftrue if constant_value(condition) else iffalse
+            else:
+                chain.append((node, condition))
+                node = iffalse
+        rval = self.visit(node)
+        for node, condition in reversed(chain):
+            node.arguments = [condition, self.visit(node.arguments[1]), rval]
+            rval = node
+        return rval
+
+    def visit_switch(self, node):
+        subject, default, *cases = node.arguments
+        subject = self.visit(subject)
+        if is_constant(subject):
+            value = constant_value(subject)
+            for case in cases:
+                if case.arguments[0].arguments[0] == value:
+                    return self.visit(case.arguments[1])
+            return self.visit(default)
+        for case in cases:
+            case.arguments = [case.arguments[0], self.visit(case.arguments[1])]
+        node.arguments = [subject, self.visit(default)] + cases
+        return node
+
+    def visit_lambda(self, node):
+        parameters, body = node.arguments
+        node.arguments = [parameters, self.visit(body)]
+        return node
+
+
+class SwitchTable(CanonModifier):
+    """
+    Turns the chains of ifs that compare the same variable to
+    constants, i.e.
+
+        if (x == c1): a ~ elif (x == c2): b ~ ... ~ else: z
+
+    (the constant may also be on the left of ==) into switch nodes:
+
+        (switch (symbol x) z (table (value c1) a) (table (value c2) b) ...)
+
+    which the evaluators dispatch in constant time, through a
+    dictionary from the constants to the branches. Only the first
+    branch for a given constant is kept, since the others can't be
+    taken. Other ifs of the chain are left as they are.
+
+    min_cases: (default: 4) the smallest number of consecutive
+        comparisons that is turned into a switch.
+
+    As with ConstantFold, tabulate should be used rather than visit,
+    so that a tree that binds == is left alone.
+    """
+
+    def __init__(self, min_cases = 4):
+        self.min_cases = min_cases
+        self.shadowed = set()
+
+    def tabulate(self, node):
+        self.shadowed = bound_names(node)
+        return self.visit(node)
+
+    def case(self, condition):
+        # Returns (symbol node, value node) if condition compares a
+        # variable to a constant, None otherwise.
+        if (condition.command != 'apply' or '==' in self.shadowed
+            or condition.arguments[0].command != 'symbol'
+            or condition.arguments[0].arguments[0] != '=='
+            or condition.arguments[1].command != 'table'
+            or len(condition.arguments[1].arguments) != 2):
+            return None
+        a, b = condition.arguments[1].arguments
+        if a.command == 'value' and b.command == 'symbol':
+            a, b = b, a
+        if a.command == 'symbol' and b.command == 'value':
+            return a, b
+        return None
+
+    def visit_if(self, node):
+        # Splits the chain of elifs into runs of comparisons of the
+        # same variable, walking it in a loop.
+        runs = []
+        while isinstance(node, Canon) and node.command == 'if':
+            case = self.case(node.arguments[0])
+            name = case and case[0].arguments[0]
+            if name is not None and runs and runs[-1][0] == name:
+                runs[-1][1].append((node, case))
+            else:
+                runs.append((name, [(node, case)]))
+            node = node.arguments[2]
+        rval = self.visit(node)
+        for name, run in reversed(runs):
+            if name is not None and len(run) >= self.min_cases:
+                cases = []
+                seen = {}
+                for node, (subject, value) in run:
+                    if seen.setdefault(value.arguments[0], node) is node:
+                        cases.append(Canon(node.meta, 'table', value,
+                                           self.visit(node.arguments[1])))
+                first = run[0][0]
+                rval = Canon(first.meta, 'switch', run[0][1][0], rval, *cases)
+            else:
+                for node, case in reversed(run):
+                    condition, iftrue, iffalse = node.arguments
+                    node.arguments = [self.visit(condition), self.visit(iftrue), rval]
+                    rval = node
+        return rval
+
+    def visit_switch(self, node):
+        subject, default, *cases = node.arguments
+        for case in cases:
+            case.arguments = [case.arguments[0], self.visit(case.arguments[1])]
+        node.arguments = [subject, self.visit(default)] + cases
+        return node
+
+    def visit_lambda(self, node):
+        parameters, body = node.arguments
+        node.arguments = [parameters, self.visit(body)]
+        return node
+
+
+
 def htmlify(x):
     s = str(x)
     for orig, repl in [(" ", "&nbsp;"),
@@ -240,59 +537,211 @@ class PrettyPrinter:
         return rval
                     
                     
-def union_all(seq):
-    rval = set()
-    for s in seq:
-        rval.update(s)
-    return rval
-
 class FreeVariables(CanonVisitor):
-
-    def __init__(self):
+    """
+    Free variable and scope analysis. Maps each node to the set of
+    the variables it reads that are not bound within it, i.e. that
+    are neither parameters nor locals of a lambda that contains the
+    read (as in ClosureCompiler, a name assigned in a lambda is local
+    to it). The target of an assignment is not a read, and quoted
+    code reads nothing.
+
+    Sets are bitsets: each variable name gets an integer id (see
+    id and names), and a set is an int with the bits of its variables
+    set, so that a union is a single |, and nodes without variables
+    share the same 0. bitset returns the bitset of a node, visit
+    (or free) its set of names.
+
+    Results are memoized by node, or, if a CanonTable is given, by
+    structure, so that identical subexpressions are only analyzed
+    once. The tree is walked with an explicit stack, so that it can
+    be as deep as needed.
+    """
+
+    def __init__(self, table = None):
+        self.table = table
         self.mapping = {}
-
-    def assign(self, node, s):
-        self.mapping[node] = s
-        return s
-
-    def visit(self, node):
-        if node in self.mapping:
-            return self.mapping[node]
-        rval = super().visit(node)
-        self.mapping[node] = rval
+        # bitsets of the variables assigned by the nodes (outside of
+        # nested lambdas), and of the variables bound by the lambdas
+        self.assigned = {}
+        self.bound = {}
+        self.ids = {}
+        self.variables = []
+
+    def id(self, name):
+        try:
+            return self.ids[name]
+        except KeyError:
+            i = self.ids[name] = len(self.variables)
+            self.variables.append(name)
+            return i
+
+    def bits(self, names):
+        rval = 0
+        for name in names:
+            rval |= 1 << self.id(name)
         return rval
 
-    def visit_symbol(self, node):
-        return {node.arguments[0]}
-
-    def visit_value(self, node):
-        return set()
-
-    def visit_apply(self, node):
-        return union_all(map(self.visit, node.arguments))
+    def names(self, bits):
+        """
+        The set of the names in bits.
+        """
+        rval = set()
+        i = 0
+        while bits:
+            if bits & 1:
+                rval.add(self.variables[i])
+            bits >>= 1
+            i += 1
+        return rval
 
-    def visit_begin(self, node):
-        return union_all(map(self.visit, node.arguments))
+    def memo_key(self, node):
+        if self.table is not None and isinstance(node, Canon):
+            return self.table.key(node)
+        return node
 
-    def visit_table(self, node):
-        return union_all(map(self.visit, node.arguments))
+    def visit(self, node):
+        """
+        The set of the free variables of node.
+        """
+        return self.names(self.bitset(node))
+
+    free = visit
+
+    def locals(self, node):
+        """
+        The set of the names bound by the lambda node: its parameters
+        and the names it assigns.
+        """
+        self.bitset(node)
+        return self.names(self.bound[self.memo_key(node)])
+
+    def assignment(self, node):
+        # The assigned symbol and the value node if node is an
+        # assignment, None otherwise.
+        fn, arg = node.arguments
+        if (isinstance(fn, Canon) and fn.command == 'symbol'
+            and fn.arguments[0] in assignment_operators
+            and isinstance(arg, Canon) and arg.command == 'table'
+            and len(arg.arguments) == 2
+            and isinstance(arg.arguments[0], Canon)
+            and arg.arguments[0].command == 'symbol'):
+            return arg.arguments
+        return None
+
+    def children(self, node):
+        command = node.command
+        if command in ('quote', 'syntax'):
+            return []
+        elif command == 'lambda':
+            return [node.arguments[1]]
+        elif command == 'apply':
+            assignment = self.assignment(node)
+            if assignment is not None:
+                return [assignment[1]]
+        return [x for x in node.arguments if isinstance(x, Canon)]
+
+    def bitset(self, node):
+        mapping = self.mapping
+        stack = [(node, False)]
+        while stack:
+            this, ready = stack.pop()
+            key = self.memo_key(this)
+            if key in mapping:
+                continue
+            if not ready:
+                stack.append((this, True))
+                for child in self.children(this):
+                    stack.append((child, False))
+                continue
+            if this.command == 'symbol':
+                mapping[key] = 1 << self.id(this.arguments[0])
+                self.assigned[key] = 0
+            elif this.command == 'lambda':
+                body = self.memo_key(this.arguments[1])
+                bound = self.bits(this.arguments[0]) | self.assigned[body]
+                self.bound[key] = bound
+                mapping[key] = mapping[body] & ~bound
+                self.assigned[key] = 0
+            else:
+                free = assigned = 0
+                for child in self.children(this):
+                    child = self.memo_key(child)
+                    free |= mapping[child]
+                    assigned |= self.assigned[child]
+                if this.command == 'apply':
+                    assignment = self.assignment(this)
+                    if assignment is not None:
+                        assigned |= 1 << self.id(assignment[0].arguments[0])
+                mapping[key] = free
+                self.assigned[key] = assigned
+        return mapping[self.memo_key(node)]
 
-    def visit_if(self, node):
-        return union_all(map(self.visit, node.arguments))
 
 
+# The passes CircuitMaker runs on a circuit before exporting it, in
+# order (see the methods of the same name).
+circuit_passes = ['inline', 'merge_constants', 'share_subcircuits', 'eliminate_dead']
 
 class CircuitMaker(CanonVisitor):
-
-    def __init__(self, inputs, constants):
+    """
+    Makes a CircuitSpec out of a Canon tree (once StaticExpr ran).
+
+    inputs: the names of the input ports of the circuit, the only
+        free variables the tree may use besides the constants.
+
+    constants: maps symbols to their values. A function must be a
+        gate spec, (gate, input port names, output port name).
+
+    passes: (default: circuit_passes) the names of the optimization
+        passes to run on the circuit before it is exported. Gates are
+        assumed to be functions of their inputs, so that gates that
+        compute the same thing can be shared.
+
+    inline_limit: (default: 8) the circuits of the lambdas that have
+        at most this many gates are inlined where they are applied.
+
+    The circuit is built as a graph of integers, and only gets names
+    when it is exported (see create). Gate i is self.operators[i]
+    (None for the ports of the circuit), and an endpoint is a pair
+    (gate, port), where port is a port name, or the index of an
+    output of a Distribute gate, or None for the ports of the circuit.
+    Edges are (source, target) pairs of endpoints, kept in insertion
+    order, with a map from each target to its source and from each
+    source to its targets, so that they can be removed and rewired in
+    constant time. Each output has at most one target: a value that
+    is used more than once goes through a Distribute gate.
+    """
+
+    def __init__(self, inputs, constants, passes = None, inline_limit = 8):
         self.inputs = inputs
         self.constants = constants
+        self.passes = circuit_passes if passes is None else passes
+        self.inline_limit = inline_limit
         self.id = 0
-        self.operators = {}
-        self.connections = []
+        # Gate i: operator, name prefix (the whole name for the
+        # ports) and number
+        self.operators = []
+        self.prefixes = []
+        self.numbers = []
+        # Distribute gates: number of outputs in use
+        self.fanout = {}
+        # Constant gates: their value
+        self.values = {}
+        # Applications of lambdas: the CircuitMaker of the lambda
+        self.subcircuits = {}
+        self.removed = set()
+        # Edges (a dictionary used as an ordered set) and adjacency;
+        # fanin maps each gate to its connected input ports
+        self.edges = {}
+        self.sources = {}
+        self.targets = {}
+        self.fanin = {}
         self.referrers = {}
+        self.out = None
+        self.report = []
         for inp in inputs:
-            self.create_referrer(inp, inp)
+            self.create_referrer(inp, (self.create_port(inp), None))
 
         # self.env_uses = 0
         # self.n_err = 1
@@ -301,56 +750,362 @@ class CircuitMaker(CanonVisitor):
         self.id += 1
         return self.id
 
+    #############
+    ### GRAPH ###
+    #############
+
     def create_operator(self, prefix, operator):
-        name = "{pfx}{id}".format(prefix = prefix,
-                                  id = self.nextid())
-        self.operators[name] = operator
-        return name
+        self.operators.append(operator)
+        self.prefixes.append(prefix)
+        self.numbers.append(self.nextid())
+        return len(self.operators) - 1
+
+    def create_port(self, name):
+        self.operators.append(None)
+        self.prefixes.append(name)
+        self.numbers.append(None)
+        return len(self.operators) - 1
+
+    def connect(self, source, target):
+        self.edges[(source, target)] = None
+        self.sources[target] = source
+        self.targets.setdefault(source, {})[target] = None
+        self.fanin.setdefault(target[0], {})[target[1]] = None
+
+    def disconnect(self, source, target):
+        del self.edges[(source, target)]
+        del self.sources[target]
+        del self.targets[source][target]
+        del self.fanin[target[0]][target[1]]
+
+    def target(self, source):
+        # The target of source, or None if it is not connected
+        for target in self.targets.get(source, ()):
+            return target
+        return None
+
+    def outputs(self, gate):
+        if self.operators[gate] is Distribute:
+            return [(gate, i) for i in range(self.fanout[gate])]
+        return [(gate, 'out')]
+
+    def collapse(self, distr):
+        # A Distribute gate with a single output is a wire: its source
+        # is connected to its target directly.
+        i = (distr, 'input')
+        r = (distr, 0)
+        src = self.sources[i]
+        targ, = self.targets[r]
+        self.disconnect(src, i)
+        self.disconnect(r, targ)
+        self.connect(src, targ)
+        self.removed.add(distr)
 
     def create_constant(self, ct):
-        return self.create_operator('ct', Constant(ct))
+        gate = self.create_operator('ct', Constant(ct))
+        self.values[gate] = ct
+        return gate
 
     def create_referrer(self, sym, anchor):
-        distr = self.create_operator('distr', [Distribute, 0])
-        self.connections.append((anchor, distr + '.input'))
+        distr = self.create_operator('distr', Distribute)
+        self.fanout[distr] = 0
+        self.connect(anchor, (distr, 'input'))
         self.referrers[sym] = distr
-        # return distr
 
     def dup_symbol(self, sym):
         if sym not in self.referrers:
             if sym in self.constants:
-                name = self.create_constant(self.constants[sym])
-                self.create_referrer(sym, name + ".out")
-                # distr = self.create_operator([Distribute, 0])
-                # self.connections.append(name + '.out',
-                #                         distr + '.in')
-                # self.referrers[sym] = distr
+                gate = self.create_constant(self.constants[sym])
+                self.create_referrer(sym, (gate, 'out'))
             else:
                 raise E['free_variable'](
                     'There is no support for free variables at the moment.')
 
-        distr_name = self.referrers[sym]
-        distributor = self.operators[distr_name]
-        n = distributor[1]
-        distributor[1] += 1
-        return "{d}.o{n}".format(d = distr_name, n = n)
+        distr = self.referrers[sym]
+        n = self.fanout[distr]
+        self.fanout[distr] += 1
+        return (distr, n)
+
+    def fork(self, source):
+        # Returns a new output that carries the same value as source,
+        # putting a Distribute gate after source if there is none.
+        gate = source[0]
+        if self.operators[gate] is not Distribute:
+            target = self.target(source)
+            if target is None:
+                return source
+            if self.operators[target[0]] is Distribute:
+                gate = target[0]
+            else:
+                distr = self.create_operator('distr', Distribute)
+                self.disconnect(source, target)
+                self.connect(source, (distr, 'input'))
+                self.connect((distr, 0), target)
+                self.fanout[distr] = 1
+                gate = distr
+        n = self.fanout[gate]
+        self.fanout[gate] += 1
+        return (gate, n)
+
+    def release(self, source):
+        # source, an output of a Distribute gate, lost its target: the
+        # last output takes its place. Returns the new fanout.
+        distr, n = source
+        last = self.fanout[distr] - 1
+        if n != last:
+            target = self.target((distr, last))
+            if target is not None:
+                self.disconnect((distr, last), target)
+                self.connect(source, target)
+        self.fanout[distr] = last
+        return last
+
+    def share(self, keep, dup):
+        # The target of the output dup is fed by keep instead, which
+        # carries the same value.
+        target = self.target(dup)
+        if target is not None:
+            self.disconnect(dup, target)
+            self.connect(self.fork(keep), target)
+
+    def prune(self, gate):
+        # Removes gate, whose outputs have no targets, then the gates
+        # that were only used by it, and so on.
+        stack = [gate]
+        while stack:
+            gate = stack.pop()
+            if gate in self.removed:
+                continue
+            for port in list(self.fanin.get(gate, ())):
+                source = self.sources[(gate, port)]
+                self.disconnect(source, (gate, port))
+                src = source[0]
+                if self.operators[src] is None:
+                    continue
+                elif self.operators[src] is Distribute:
+                    fanout = self.release(source)
+                    if fanout == 1:
+                        self.collapse(src)
+                    elif fanout == 0:
+                        stack.append(src)
+                elif self.target(source) is None:
+                    stack.append(src)
+            self.removed.add(gate)
+
+    def live(self):
+        # The gates from which out can be reached, in topological order
+        order = []
+        seen = set()
+        stack = [(self.out, False)]
+        while stack:
+            gate, ready = stack.pop()
+            if ready:
+                order.append(gate)
+                continue
+            if gate in seen:
+                continue
+            seen.add(gate)
+            stack.append((gate, True))
+            for port in self.fanin.get(gate, ()):
+                stack.append((self.sources[(gate, port)][0], False))
+        return order
+
+    def count(self):
+        """
+        Returns the number of gates and the number of edges of the
+        circuit, counting those of the circuits of the lambdas it
+        applies rather than the gates that apply them.
+        """
+        gates = 0
+        edges = len(self.edges)
+        for gate, operator in enumerate(self.operators):
+            if operator is None or gate in self.removed:
+                continue
+            maker = self.subcircuits.get(gate)
+            if maker is None:
+                gates += 1
+            else:
+                g, e = maker.count()
+                gates += g
+                edges += e
+        return gates, edges
+
+    ##############
+    ### PASSES ###
+    ##############
+
+    def optimize(self):
+        """
+        Runs the passes on the circuit. Returns the report, a list of
+        (pass, gates, edges), the first entry being ('initial', ...),
+        with the counts (see count) after each pass.
+        """
+        self.report = [('initial',) + self.count()]
+        for name in self.passes:
+            getattr(self, name)()
+            self.report.append((name,) + self.count())
+        return self.report
+
+    def eliminate_dead(self):
+        # Removes the gates from which out cannot be reached.
+        live = set(self.live())
+        dead = [gate for gate, operator in enumerate(self.operators)
+                if operator is not None
+                and gate not in self.removed
+                and gate not in live]
+        for gate in dead:
+            for port in list(self.fanin.get(gate, ())):
+                source = self.sources[(gate, port)]
+                self.disconnect(source, (gate, port))
+                if (source[0] in live
+                    and self.operators[source[0]] is Distribute
+                    and self.release(source) == 1):
+                    self.collapse(source[0])
+            for source in self.outputs(gate):
+                target = self.target(source)
+                if target is not None:
+                    self.disconnect(source, target)
+            self.removed.add(gate)
+            self.subcircuits.pop(gate, None)
+
+    def merge_constants(self):
+        # Constants of the same value are merged, when that doesn't
+        # add gates: either one of them already goes to a Distribute
+        # gate, or there are at least three of them.
+        groups = {}
+        for gate, value in self.values.items():
+            target = self.target((gate, 'out'))
+            if (gate in self.removed or target is None
+                or self.fanout.get(target[0]) == 0):
+                continue
+            try:
+                groups.setdefault((type(value), value), []).append(gate)
+            except TypeError:
+                pass
+        for group in groups.values():
+            keep = group[0]
+            for gate in group:
+                if self.operators[self.target((gate, 'out'))[0]] is Distribute:
+                    keep = gate
+                    break
+            else:
+                if len(group) < 3:
+                    continue
+            for gate in group:
+                if gate != keep:
+                    self.share((keep, 'out'), (gate, 'out'))
+                    self.prune(gate)
+
+    def value(self, source):
+        # A key for the value carried by source: Distribute gates are
+        # seen through, and constants are keyed by their value.
+        while self.operators[source[0]] is Distribute:
+            source = self.sources[(source[0], 'input')]
+        gate = source[0]
+        if gate in self.values:
+            value = self.values[gate]
+            try:
+                hash(value)
+                return ('ct', type(value), value)
+            except TypeError:
+                pass
+        return source
+
+    def share_subcircuits(self):
+        # Gates that apply the same operator to the same values compute
+        # the same value: the first one seen, in topological order, is
+        # used in place of the others, which are then pruned along
+        # with whatever only they used.
+        seen = {}
+        for gate in self.live():
+            operator = self.operators[gate]
+            if (operator is None or operator is Distribute
+                or gate in self.values or gate in self.removed):
+                continue
+            key = (id(operator),
+                   tuple(sorted((port, self.value(self.sources[(gate, port)]))
+                                for port in self.fanin.get(gate, ()))))
+            keep = seen.setdefault(key, gate)
+            if keep != gate:
+                self.share((keep, 'out'), (gate, 'out'))
+                self.prune(gate)
+
+    def inline(self):
+        # Applications of lambdas whose circuits are small are replaced
+        # by a copy of the gates of the circuit.
+        for gate, maker in list(self.subcircuits.items()):
+            if (self.target((gate, 'out')) is not None
+                and maker.count()[0] <= self.inline_limit):
+                self.splice(gate, maker)
+
+    def splice(self, gate, maker):
+        result = self.target((gate, 'out'))
+        self.disconnect((gate, 'out'), result)
+
+        # Copy the gates
+        ids = {}
+        for inner, operator in enumerate(maker.operators):
+            if operator is None or inner in maker.removed:
+                continue
+            new = ids[inner] = self.create_operator(maker.prefixes[inner], operator)
+            if inner in maker.fanout:
+                self.fanout[new] = maker.fanout[inner]
+            if inner in maker.values:
+                self.values[new] = maker.values[inner]
+            if inner in maker.subcircuits:
+                self.subcircuits[new] = maker.subcircuits[inner]
+
+        # Copy the edges: those from the input ports of the circuit
+        # come from the arguments, the one to out goes to the result
+        for source, target in maker.edges:
+            if source[0] in ids:
+                source = (ids[source[0]], source[1])
+            else:
+                argument = (gate, maker.prefixes[source[0]])
+                if argument not in self.sources:
+                    continue
+                source = self.sources[argument]
+                self.disconnect(source, argument)
+            if target[0] in ids:
+                target = (ids[target[0]], target[1])
+            else:
+                target = result
+            self.connect(source, target)
+
+        # The arguments that the circuit doesn't use, one at a time,
+        # as releasing one may rewire the others
+        while self.fanin.get(gate):
+            port = next(iter(self.fanin[gate]))
+            source = self.sources[(gate, port)]
+            self.disconnect(source, (gate, port))
+            src = source[0]
+            if self.operators[src] is None:
+                continue
+            elif self.operators[src] is Distribute:
+                fanout = self.release(source)
+                if fanout == 1:
+                    self.collapse(src)
+                elif fanout == 0:
+                    self.prune(src)
+            else:
+                self.prune(src)
+        self.removed.add(gate)
+        del self.subcircuits[gate]
+
+    ################
+    ### VISITORS ###
+    ################
 
     def visit_value(self, node):
-        name = self.create_constant(node.arguments[0])
-        return dict(output = name+".out")
+        gate = self.create_constant(node.arguments[0])
+        return dict(output = (gate, 'out'))
 
     def visit_symbol(self, node):
-        targ = self.dup_symbol(node.arguments[0])
-        return dict(output = targ)
-
-    def create_operator(self, prefix, operator):
-        name = "{prefix}{id}".format(prefix = prefix,
-                                     id = self.nextid())
-        self.operators[name] = operator
-        return name
+        return dict(output = self.dup_symbol(node.arguments[0]))
 
     def visit_apply(self, node):
         fn = node.arguments[0]
+        maker = None
         if fn.command == 'symbol':
             sym = fn.arguments[0]
             if sym not in self.constants:
@@ -359,64 +1114,88 @@ class CircuitMaker(CanonVisitor):
         else:
             fn = self.visit(fn)
             gate, input_names, out_name = fn['gate']
-        gate_name = self.create_operator(gate.name, gate)
+            maker = fn.get('maker')
+        gate_id = self.create_operator(gate.name, gate)
+        if maker is not None:
+            self.subcircuits[gate_id] = maker
 
         args = map(self.visit, node.arguments[1].arguments)
 
         for portmap, port_name in zip(args, input_names):
-            # self.connections.append((gate_name + "." + port_name,
-            #                          portmap['output']))
-            self.connections.append((portmap['output'],
-                                     gate_name + "." + port_name))
-        return dict(output = gate_name+".out")
+            self.connect(portmap['output'], (gate_id, port_name))
+        return dict(output = (gate_id, 'out'))
 
     def visit_if(self, node):
         cond, iftrue, iffalse = map(self.visit, node.arguments)
-        name = self.create_operator('if', IfThenElse)
-        self.connections += [(cond['output'], '{name}.cond'.format(name = name)),
-                             (iftrue['output'], '{name}.iftrue'.format(name = name)),
-                             (iffalse['output'], '{name}.iffalse'.format(name = name))]
-        return dict(output = name+'.out')
+        gate = self.create_operator('if', IfThenElse)
+        self.connect(cond['output'], (gate, 'cond'))
+        self.connect(iftrue['output'], (gate, 'iftrue'))
+        self.connect(iffalse['output'], (gate, 'iffalse'))
+        return dict(output = (gate, 'out'))
 
     def visit_void(self, node):
-        name = self.create_constant(None)
-        return dict(output = name+".out")
+        gate = self.create_constant(None)
+        return dict(output = (gate, 'out'))
 
     def visit_lambda(self, node):
         parameters, body = node.arguments
-        cm = CircuitMaker(parameters, self.constants)
+        cm = CircuitMaker(parameters, self.constants,
+                          self.passes, self.inline_limit)
         circ = cm.create('circ{id}'.format(id = self.nextid()),
                          body)
-        return dict(gate = (circ, parameters, 'out'))
+        return dict(gate = (circ, parameters, 'out'), maker = cm)
+
+    ##############
+    ### EXPORT ###
+    ##############
+
+    def gate_name(self, gate):
+        if self.numbers[gate] is None:
+            return self.prefixes[gate]
+        return "%s%s" % (self.prefixes[gate], self.numbers[gate])
+
+    def endpoint_name(self, endpoint):
+        gate, port = endpoint
+        if port is None:
+            return self.gate_name(gate)
+        elif isinstance(port, int):
+            return "%s.o%s" % (self.gate_name(gate), port)
+        else:
+            return "%s.%s" % (self.gate_name(gate), port)
 
     def create(self, name, node):
-
-        def make_incomplete(k, op):
-            if isinstance(op, list):
-                constructor, n = op
-                if constructor is Distribute and n == 1:
-                    i = '{k}.input'.format(k = k)
-                    r = '{k}.o0'.format(k = k)
-                    src = rconnd[i]
-                    targ = connd[r]
-                    self.connections.remove((src, i))
-                    self.connections.remove((r, targ))
-                    self.connections.append((src, targ))
-                return constructor(n)
-            else:
-                return op
-
         result = self.visit(node)
-        connd = dict(self.connections)
-        rconnd = {y: x for x, y in self.connections}
-
-        ports = self.inputs + ['out']
-        gates = {k: make_incomplete(k, op)
-                 for k, op in self.operators.items()}
-        self.connections.append(('out', result['output']))
-        connections = self.connections
+        self.out = self.create_port('out')
+        self.connect(result['output'], (self.out, None))
+
+        for distr, n in list(self.fanout.items()):
+            if n == 1:
+                self.collapse(distr)
+
+        self.optimize()
+        return self.export(name)
+
+    def export(self, name):
+        """
+        Returns the CircuitSpec for the circuit, naming its gates and
+        endpoints.
+        """
+        gates = {}
+        for gate, operator in enumerate(self.operators):
+            if operator is None or gate in self.removed:
+                continue
+            if operator is Distribute:
+                operator = Distribute(self.fanout[gate])
+            gates[self.gate_name(gate)] = operator
+        # The output of the circuit is connected last, as out -> result
+        connections = [(self.endpoint_name(source), self.endpoint_name(target))
+                       for source, target in self.edges
+                       if target[0] != self.out]
+        connections += [(self.endpoint_name(target), self.endpoint_name(source))
+                        for source, target in self.edges
+                        if target[0] == self.out]
         return CircuitSpec(name = name,
-                           ports = ports,
+                           ports = self.inputs + ['out'],
                            gates = gates,
                            connections = connections)
 
@@ -0,0 +1,278 @@
+
+from ..parse.generic import ast
+from ..parse.generic.parse import Convert3
+from ..tools.err import Exc
+
+
+__all__ = ['Lower', 'lower', 'function_operators', 'standard_macros']
+
+
+# Lowers a phase 1 tree (Parser.parse1) directly to the tree that
+# evaluate.StaticExpr(static_operators) makes out of a phase 3 tree,
+# in a single walk:
+#
+# * the "," chains and the brackets become items as in Convert2, but
+#   without rebuilding the phase 1 tree;
+# * the applications of the operators that are macros are recognized
+#   on the phase 1 tree and expanded right away, so that the
+#   apply(symbol, syntax(begin ...)) nodes that Convert3 would make
+#   for them, and that StaticExpr would then take apart, are never
+#   made;
+# * everything else is converted as in Convert3.
+#
+# The macros are found through dispatch tables: standard_macros maps
+# each operator to the method that expands it, and colon_macros maps
+# the keyword on the left of ":" to the method that expands that form
+# (if, lambda). The result is the same as that of the three passes, up
+# to the error raised for malformed macros.
+
+# Operators that become plain function applications on a table of
+# their operands.
+function_operators = ['+', '-', '*', '/', '//', '%', '^',
+                      '<', '>', '=<', '>=', '==', '/=',
+                      '¬', '∧', '∨', '∈', '∉', '++',
+                      '=', '←']
+
+standard_macros = dict({op: 'function' for op in function_operators},
+                       **{'.': 'quote',
+                          '..': 'syntax',
+                          '~': 'tilde',
+                          ':': 'colon'})
+
+colon_macros = {'if': 'if',
+                'lambda': 'lambda'}
+
+juxtaposition = ('_', '__')
+
+
+def _collapse(node):
+    # The operands of a chain of applications of the same operator,
+    # e.g. [a, b, c] for ((a, b), c), walked in a loop so that long
+    # sequences don't blow the stack.
+    operator = node.operator
+    chain = [node]
+    a = node.children[0]
+    while isinstance(a, ast.OpApply) and a.operator == operator:
+        chain.append(a)
+        a = a.children[0]
+    children = [a]
+    for link in reversed(chain):
+        children.extend(link.children[1:])
+    return children
+
+def _unwrap(node):
+    # (x) is x
+    while (isinstance(node, ast.Bracketed) and node.type == 'P'
+           and not isinstance(node.expression, ast.Void)
+           and not (isinstance(node.expression, ast.OpApply)
+                    and node.expression.operator == ast.Infix(","))):
+        node = node.expression
+    return node
+
+
+class Lower(Convert3):
+    """
+    Lowers phase 1 trees to Canon trees with the operator macros
+    expanded (see above).
+
+    macros: (default: standard_macros) maps operators to the kind of
+        macro they are, i.e. the name of the method that expands them,
+        minus the "macro_" prefix.
+
+    keywords: (default: colon_macros) maps the keywords that can be
+        on the left of ":" to the name of the method that expands
+        them, minus the "colon_" prefix.
+
+    table: if given (an ast.CanonTable), the nodes are hash-consed
+        with it, as with Convert3.
+    """
+
+    def __init__(self, macros = None, keywords = None, table = None):
+        super().__init__(table)
+        self.macros = {op: getattr(self, 'macro_' + kind)
+                       for op, kind in (standard_macros if macros is None
+                                        else macros).items()}
+        self.keywords = {word: getattr(self, 'colon_' + kind)
+                         for word, kind in (colon_macros if keywords is None
+                                            else keywords).items()}
+
+    def meta(self, location):
+        return ast.Meta(location = location, nest = None)
+
+    def lower(self, tree):
+        """
+        Lowers tree, the result of Parser.parse1.
+        """
+        return self.visit(ast.Bracketed(tree.location, "P", tree))
+
+    ##################
+    ### CONVERSION ###
+    ##################
+
+    def visit_Bracketed(self, node):
+        expr = node.expression
+        if isinstance(expr, ast.OpApply) and expr.operator == ast.Infix(","):
+            items = _collapse(expr)
+        elif isinstance(expr, ast.Void):
+            items = []
+        else:
+            items = [expr]
+        if node.type == 'P':
+            return self.visit(ast.Sequence(node.location, items))
+        if node.type == 'T':
+            return self.visit(ast.Table(node.location, items))
+        if node.type == 'C':
+            return self.visit(ast.Code(node.location, items))
+        raise Exception("Not handled: %s - %s" % (node, node.type))
+
+    def visit_Void(self, node):
+        return self.visit(None)
+
+    def visit_OpApply(self, node):
+        op = node.operator.op
+        macro = self.macros.get(op)
+        if macro is not None:
+            return macro(node)
+        if node.operator == ast.Infix(","):
+            node = ast.OpApply(node.operator, *_collapse(node),
+                               location = node.location)
+        return super().visit_OpApply(node)
+
+    ##############
+    ### MACROS ###
+    ##############
+
+    def macro_function(self, node):
+        # a + b => apply(symbol +, table(a, b))
+        if node.operator == ast.Infix(","):
+            return self.make_function(node, list(map(self.visit, _collapse(node))))
+        # a + b + c is nested to the left: walk down in a loop
+        chain = [node]
+        a = node.children[0]
+        while isinstance(a, ast.OpApply) and a.operator == node.operator:
+            chain.append(a)
+            a = a.children[0]
+        rval = self.visit(a)
+        for link in reversed(chain):
+            rval = self.make_function(link, [rval] + list(map(self.visit, link.children[1:])))
+        return rval
+
+    def make_function(self, node, operands):
+        # operands are already lowered
+        return self.canon(self.meta(node.location), 'apply',
+                          self.canon(self.meta(node.operator.location),
+                                     'symbol', node.operator.op),
+                          self.canon(self.meta(node.location), 'table',
+                                     *operands))
+
+    def macro_quote(self, node):
+        # a.b => quote(b)
+        return self.canon(self.meta(node.location), 'quote',
+                          self.visit(node.children[-1]))
+
+    def macro_syntax(self, node):
+        # a..b => syntax(b)
+        return self.canon(self.meta(node.location), 'syntax',
+                          self.visit(node.children[-1]))
+
+    def macro_tilde(self, node):
+        # (a: b) ~ (c: d) ~ ... is (a: b) with the clauses c: d, ...
+        # appended to it, so (if x: y) ~ (else: z) is an if with an
+        # else clause.
+        clauses = []
+        while isinstance(node, ast.OpApply) and node.operator.op == '~':
+            left, right = node.children
+            clauses.append(right)
+            node = _unwrap(left)
+        if not (isinstance(node, ast.OpApply) and node.operator.op == ':'):
+            raise Exc('lower/bad_tilde')(
+                "The left side of ~ must be a clause of the form a: b")
+        clauses.reverse()
+        return self.macro_colon(node, clauses)
+
+    def macro_colon(self, node, clauses = ()):
+        word, args = self.colon_spec(node)
+        try:
+            expand = self.keywords[word]
+        except KeyError:
+            raise Exc('lower/unknown_keyword')(
+                "Unknown keyword before ':': {word}", word = word)
+        return expand(node, args + list(clauses))
+
+    def colon_spec(self, node):
+        # For "word: body" returns (word, [body]), and for
+        # "word x: body", (word, [x, body]). The arguments are
+        # phase 1 nodes.
+        node = _unwrap(node)
+        if not (isinstance(node, ast.OpApply) and node.operator.op == ':'):
+            raise Exc('lower/bad_clause')("Expected a clause of the form a: b")
+        head, body = node.children
+        head = _unwrap(head)
+        if isinstance(head, ast.Identifier):
+            return head.id, [body]
+        if isinstance(head, ast.OpApply) and head.operator.op in juxtaposition:
+            word = _unwrap(head.children[0])
+            if isinstance(word, ast.Identifier):
+                return word.id, [head.children[1], body]
+        raise Exc('lower/bad_clause')("Expected a keyword before ':'")
+
+    def colon_if(self, node, args):
+        # The elif clauses are gathered in a loop, args being kept
+        # reversed, as a stack (see evaluate.Colon.fn_if).
+        args = list(reversed(args))
+        branches = []
+        while True:
+            if len(args) < 2:
+                raise Exc('if/wrong_syntax')('Expected a condition and a body.')
+            condition = args.pop()
+            iftrue = args.pop()
+            branches.append((node, condition, iftrue))
+            if not args:
+                rval = self.visit(None)
+                break
+            statement = _unwrap(args.pop())
+            word, subargs = self.colon_spec(statement)
+            if word == 'else':
+                if len(subargs) != 1 or args:
+                    raise Exc('if/wrong_syntax')('else must be the last clause.')
+                rval = self.visit(subargs[0])
+                break
+            elif word == 'elif':
+                node = statement
+                args.extend(reversed(subargs))
+            else:
+                raise Exc('if/wrong_syntax')('Expected else or elif.')
+        for node, condition, iftrue in reversed(branches):
+            rval = self.canon(self.meta(node.location), 'if',
+                              self.visit(condition),
+                              self.visit(iftrue),
+                              rval)
+        return rval
+
+    def colon_lambda(self, node, args):
+        if len(args) != 2:
+            raise Exc('lambda/wrong_syntax')('Expected lambda [parameters]: body.')
+        arguments, body = args
+        arguments = self.visit(arguments)
+        parameters = []
+        if arguments.command in ('table', 'begin', 'void'):
+            for arg in arguments.arguments:
+                if arg.command != 'symbol':
+                    break
+                parameters.append(arg.arguments[0])
+            else:
+                return self.canon(self.meta(node.location), 'lambda',
+                                  parameters,
+                                  self.visit(body))
+        raise Exc('lambda/wrong_syntax')('The parameters of lambda must be symbols.')
+
+
+def lower(code, parser = None, table = None):
+    """
+    Parses code (already decoded) with parser (default: the standard
+    parser) and lowers it with Lower. This is equivalent to
+    evaluate.StaticExpr(static_operators).visit(parser.parse(code)).
+    """
+    if parser is None:
+        from ..parse import parser
+    return Lower(table = table).lower(parser.parse1(code))
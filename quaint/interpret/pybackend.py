@@ -0,0 +1,405 @@
+
+import ast as pyast
+
+from ..parse.generic.ast import Canon, CanonTable
+from ..tools.err import Exc
+from .closures import standard_builtins, assignment_target, assigned_names
+
+
+__all__ = ['PythonCompiler', 'mangle']
+
+
+# Lowers Canon trees, once they went through StaticExpr (see
+# evaluate.static_operators), to Python code:
+#
+# * symbol: a Python variable (see mangle)
+# * value, void: a constant
+# * apply: a call, an operator for the standard arithmetic and
+#   comparison operators, or an assignment expression (:=) for
+#   assignments
+# * table: a tuple
+# * if: a conditional expression, or for a long chain of elifs, a
+#   def of flat "if condition: return value" statements, placed like
+#   the def of a lambda and called where the chain is, since nested
+#   conditional expressions (or elif statements) exhaust Python's
+#   compiler stack after a few hundred levels
+# * switch (see evaluate.SwitchTable): a lookup of the index of the
+#   case in a dictionary, then a balanced tree of conditional
+#   expressions on that index
+# * begin: statements, or a tuple of which the last element is taken
+#   when it appears within an expression
+# * lambda: a def, placed right before the statement that contains
+#   the lambda
+# * quote: the symbol's name, or the quoted node
+#
+# The top level is a module, run in a namespace that holds the
+# builtins and the globals. Lambdas are Python functions, so
+# variables follow Python's scoping rules, which are those of
+# ClosureCompiler: a name assigned in a lambda is local to it. Unlike
+# ClosureCompiler, reading an unbound variable raises NameError (or
+# UnboundLocalError) and calling a function with the wrong number of
+# arguments raises TypeError, as in Python.
+#
+# Code objects are cached by structure (see CanonTable), so that
+# compiling the same program again, e.g. after reparsing it, only
+# costs the lowering of the tree to a key.
+
+RESULT = "__quaint_result__"
+
+# Operators that are compiled to Python's own when applied to two
+# arguments, as long as they are bound to the standard builtins (see
+# PythonCompiler's inline argument). The builtin - negates its second
+# argument when the first is void, so it is only inlined when its
+# first argument is void, a value or a variable (see expr_apply).
+binary_operators = {
+    '+': pyast.Add, '-': pyast.Sub, '*': pyast.Mult, '/': pyast.Div,
+    '//': pyast.FloorDiv, '%': pyast.Mod, '^': pyast.Pow, '++': pyast.Add,
+    }
+comparison_operators = {
+    '<': pyast.Lt, '>': pyast.Gt, '=<': pyast.LtE, '>=': pyast.GtE,
+    '==': pyast.Eq, '/=': pyast.NotEq,
+    }
+
+# Chains of ifs with more branches than this are compiled to a def
+CHAIN_LIMIT = 32
+
+
+def mangle(name):
+    """
+    Returns the Python identifier for the quaint variable name. Names
+    get a prefix, so they never clash with Python's builtins or with
+    the compiler's own names, and characters that can't be in Python
+    identifiers are escaped, e.g. "+" becomes "q_x2b_".
+    """
+    return "q_" + "".join(c if c.isalnum() and c.isascii() or c == '_'
+                          else "x%x_" % ord(c)
+                          for c in name)
+
+
+def _name(id, store = False):
+    return pyast.Name(id = id, ctx = pyast.Store() if store else pyast.Load())
+
+
+class PythonCompiler:
+    """
+    Compiles Canon trees into Python code objects (see above).
+
+    builtins: (default: closures.standard_builtins) a dictionary of
+        the initial globals.
+
+    table: (default: a new one) the CanonTable used to key the cache
+        of code objects.
+
+    inline: (default: True) compile the arithmetic and comparison
+        operators to Python's operators rather than to calls, where
+        they are bound to the standard builtins at the time the code
+        is compiled (and not rebound by it).
+
+    The globals persist from one compiled tree to the next, like with
+    ClosureCompiler.
+    """
+
+    def __init__(self, builtins = None, table = None, inline = True):
+        self.namespace = {"__builtins__": {}}
+        for name, value in (standard_builtins if builtins is None else builtins).items():
+            self.define(name, value)
+        self.table = CanonTable() if table is None else table
+        self.cache = {}
+        self.inline = inline
+        self.lambdas = 0
+        self.switches = 0
+        self.chains = 0
+        self.scopes = []
+        self.inlined = set()
+
+    def define(self, name, value):
+        self.namespace[mangle(name)] = value
+
+    def standard_operators(self):
+        # The operators that can be inlined, as they are currently bound
+        # to the standard builtins.
+        if not self.inline:
+            return frozenset()
+        return frozenset(op for op in list(binary_operators) + list(comparison_operators)
+                         if self.namespace.get(mangle(op)) is standard_builtins[op])
+
+    def lookup(self, name):
+        try:
+            return self.namespace[mangle(name)]
+        except KeyError:
+            raise Exc('eval/unbound')("Unbound variable: {name}", name = name)
+
+    ################
+    ### LOWERING ###
+    ################
+
+    def lower(self, node):
+        """
+        Returns the Python module (an ast.Module) for node. Running it
+        leaves the value of node in the namespace, under RESULT.
+        """
+        self.lambdas = 0
+        self.switches = 0
+        self.chains = 0
+        self.scopes = []
+        self.inlined = self.standard_operators() - set(assigned_names(node))
+        if isinstance(node, Canon) and node.all[1] == 'begin':
+            statements = node.all[2:]
+        else:
+            statements = [node]
+        body = []
+        for statement in statements:
+            prelude = []
+            value = self.expr(statement, prelude)
+            body.extend(prelude)
+            body.append(pyast.Assign(targets = [_name(RESULT, True)], value = value))
+        if not body:
+            body.append(pyast.Assign(targets = [_name(RESULT, True)],
+                                     value = pyast.Constant(None)))
+        module = pyast.Module(body = body, type_ignores = [])
+        return pyast.fix_missing_locations(module)
+
+    def expr(self, node, prelude):
+        # Returns the Python expression for node. Definitions it needs
+        # are appended to prelude, the statements that must run before
+        # the one that contains the expression.
+        if not isinstance(node, Canon):
+            raise Exc('compile/not_canon')("Cannot compile {node}", node = node)
+        command = node.all[1]
+        try:
+            method = getattr(self, 'expr_' + command)
+        except AttributeError:
+            raise Exc('compile/unknown_command')(
+                "Cannot compile {command} nodes (did StaticExpr run?)",
+                command = command)
+        return method(node, prelude)
+
+    def expr_symbol(self, node, prelude):
+        return _name(mangle(node.all[2]))
+
+    def expr_value(self, node, prelude):
+        value = node.all[2]
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return pyast.Constant(value)
+        raise Exc('compile/bad_value')("Cannot compile the value {value}", value = value)
+
+    def expr_void(self, node, prelude):
+        return pyast.Constant(None)
+
+    def expr_quote(self, node, prelude):
+        quoted = node.all[2]
+        if isinstance(quoted, Canon) and quoted.all[1] == 'symbol':
+            return pyast.Constant(quoted.all[2])
+        # Structurally equal quotes are interchangeable, so the first
+        # one seen stands for all those that share its code.
+        name = "__quaint_quote_%s" % self.table.key(quoted)
+        self.namespace.setdefault(name, quoted)
+        return _name(name)
+
+    def expr_apply(self, node, prelude):
+        fn, arg = node.all[2:]
+        name = assignment_target(node)
+        if name is not None:
+            return pyast.NamedExpr(target = _name(mangle(name), True),
+                                   value = self.expr(arg.all[3], prelude))
+        if isinstance(arg, Canon) and arg.all[1] == 'table':
+            args = [self.expr(x, prelude) for x in arg.all[2:]]
+        else:
+            args = [self.expr(arg, prelude)]
+        if (len(args) == 2 and fn.all[1] == 'symbol' and fn.all[2] in self.inlined
+            and not any(fn.all[2] in scope for scope in self.scopes)):
+            op = fn.all[2]
+            if op in comparison_operators:
+                return pyast.Compare(left = args[0],
+                                     ops = [comparison_operators[op]()],
+                                     comparators = [args[1]])
+            elif op != '-':
+                return pyast.BinOp(left = args[0], op = binary_operators[op](), right = args[1])
+            # The builtin - negates its second argument when the first
+            # is void: -x is applied to (void, x)
+            left = arg.all[2]
+            if left.all[1] == 'void':
+                return pyast.UnaryOp(op = pyast.USub(), operand = args[1])
+            elif left.all[1] == 'value' and left.all[2] is not None:
+                return pyast.BinOp(left = args[0], op = pyast.Sub(), right = args[1])
+            elif left.all[1] == 'symbol':
+                # Reading the variable twice has no effect, and it is
+                # still read before the second argument is evaluated.
+                return pyast.IfExp(test = pyast.Compare(left = args[0],
+                                                        ops = [pyast.Is()],
+                                                        comparators = [pyast.Constant(None)]),
+                                   body = pyast.UnaryOp(op = pyast.USub(), operand = args[1]),
+                                   orelse = pyast.BinOp(left = self.expr(left, prelude),
+                                                        op = pyast.Sub(),
+                                                        right = args[1]))
+        return pyast.Call(func = self.expr(fn, prelude), args = args, keywords = [])
+
+    def expr_table(self, node, prelude):
+        return pyast.Tuple(elts = [self.expr(x, prelude) for x in node.all[2:]],
+                           ctx = pyast.Load())
+
+    def expr_if(self, node, prelude):
+        # The chain of elifs is walked in a loop, so that long chains
+        # don't blow the stack (see above).
+        chain = node
+        branches = []
+        while isinstance(node, Canon) and node.all[1] == 'if':
+            condition, iftrue, node = node.all[2:]
+            branches.append((condition, iftrue))
+        if len(branches) > CHAIN_LIMIT:
+            return self.chain(chain, branches, node, prelude)
+        branches = [(self.expr(condition, prelude), self.expr(iftrue, prelude))
+                    for condition, iftrue in branches]
+        rval = self.expr(node, prelude)
+        for condition, iftrue in reversed(branches):
+            rval = pyast.IfExp(test = condition, body = iftrue, orelse = rval)
+        return rval
+
+    def chain(self, node, branches, iffalse, prelude):
+        # Compiles the chain of ifs node to a def, see expr_if
+        code = []
+        # The variables assigned in the chain belong to the enclosing
+        # scope
+        names = sorted(set(map(mangle, assigned_names(node))))
+        if names and self.scopes:
+            code.append(pyast.Nonlocal(names = names))
+            # nonlocal needs the names to be bound in the enclosing
+            # def, which they may only be in the chain
+            prelude.append(pyast.If(test = pyast.Constant(False),
+                                    body = [pyast.Assign(targets = [_name(name, True)],
+                                                         value = pyast.Constant(None))
+                                            for name in names],
+                                    orelse = []))
+        elif names:
+            code.append(pyast.Global(names = names))
+        for condition, iftrue in branches:
+            inner = []
+            test = self.expr(condition, inner)
+            value = self.expr(iftrue, inner)
+            code.extend(inner)
+            code.append(pyast.If(test = test, body = [pyast.Return(value = value)],
+                                 orelse = []))
+        inner = []
+        value = self.expr(iffalse, inner)
+        code.extend(inner)
+        code.append(pyast.Return(value = value))
+        self.chains += 1
+        name = "__quaint_chain_%s" % self.chains
+        arguments = pyast.arguments(posonlyargs = [], args = [], kwonlyargs = [],
+                                    kw_defaults = [], defaults = [])
+        prelude.append(pyast.FunctionDef(name = name, args = arguments, body = code,
+                                         decorator_list = [], returns = None,
+                                         type_comment = None))
+        return pyast.Call(func = _name(name), args = [], keywords = [])
+
+    def expr_switch(self, node, prelude):
+        subject, default, *cases = node.all[2:]
+        indices = {}
+        bodies = []
+        for case in cases:
+            value, body = case.all[2:]
+            if value.all[2] not in indices:
+                indices[value.all[2]] = len(bodies)
+                bodies.append(self.expr(body, prelude))
+        bodies.append(self.expr(default, prelude))
+        subject = self.expr(subject, prelude)
+        if len(bodies) == 1:
+            return pyast.Subscript(value = pyast.Tuple(elts = [subject, bodies[0]],
+                                                       ctx = pyast.Load()),
+                                   slice = pyast.Constant(-1),
+                                   ctx = pyast.Load())
+        table = "__quaint_switch_%s" % self.table.key(node)
+        self.namespace.setdefault(table, indices)
+        self.switches += 1
+        index = "__quaint_case_%s" % self.switches
+        lookup = pyast.NamedExpr(
+            target = _name(index, True),
+            value = pyast.Call(func = pyast.Attribute(value = _name(table),
+                                                      attr = 'get',
+                                                      ctx = pyast.Load()),
+                               args = [subject, pyast.Constant(len(bodies) - 1)],
+                               keywords = []))
+        def select(lo, hi, first):
+            # The expression for bodies[lo:hi]. The first comparison
+            # looks the index up.
+            if hi - lo == 1:
+                return bodies[lo]
+            mid = (lo + hi) // 2
+            return pyast.IfExp(test = pyast.Compare(left = lookup if first else _name(index),
+                                                    ops = [pyast.Lt()],
+                                                    comparators = [pyast.Constant(mid)]),
+                               body = select(lo, mid, False),
+                               orelse = select(mid, hi, False))
+        return select(0, len(bodies), True)
+
+    def expr_begin(self, node, prelude):
+        items = [self.expr(x, prelude) for x in node.all[2:]]
+        if not items:
+            return pyast.Constant(None)
+        elif len(items) == 1:
+            return items[0]
+        return pyast.Subscript(value = pyast.Tuple(elts = items, ctx = pyast.Load()),
+                               slice = pyast.Constant(-1),
+                               ctx = pyast.Load())
+
+    def expr_lambda(self, node, prelude):
+        parameters, body = node.all[2:]
+        if isinstance(body, Canon) and body.all[1] == 'begin':
+            statements = body.all[2:] or [None]
+        else:
+            statements = [body]
+        # local names shadow the operators
+        self.scopes.append(set(parameters) | set(assigned_names(body)))
+        code = []
+        for i, statement in enumerate(statements):
+            inner = []
+            value = (pyast.Constant(None) if statement is None
+                     else self.expr(statement, inner))
+            code.extend(inner)
+            if i == len(statements) - 1:
+                code.append(pyast.Return(value = value))
+            else:
+                code.append(pyast.Expr(value = value))
+        self.scopes.pop()
+        self.lambdas += 1
+        name = "__quaint_lambda_%s" % self.lambdas
+        arguments = pyast.arguments(posonlyargs = [],
+                                    args = [pyast.arg(arg = mangle(p)) for p in parameters],
+                                    kwonlyargs = [], kw_defaults = [], defaults = [])
+        prelude.append(pyast.FunctionDef(name = name, args = arguments, body = code,
+                                         decorator_list = [], returns = None,
+                                         type_comment = None))
+        return _name(name)
+
+    #################
+    ### COMPILING ###
+    #################
+
+    def source(self, node):
+        """
+        Returns the Python source code for node, for inspection.
+        """
+        return pyast.unparse(self.lower(node))
+
+    def compile(self, node):
+        """
+        Returns the code object for node, from the cache if a tree of
+        the same structure was compiled before.
+        """
+        # The code depends on which operators are inlined
+        key = ((self.table.key(node), self.standard_operators())
+               if isinstance(node, Canon) else None)
+        code = self.cache.get(key)
+        if code is None:
+            code = compile(self.lower(node), "<quaint>", "exec")
+            if key is not None:
+                self.cache[key] = code
+        return code
+
+    def run(self, node):
+        """
+        Compiles and runs node in the namespace, and returns its
+        value.
+        """
+        exec(self.compile(node), self.namespace)
+        return self.namespace.pop(RESULT)
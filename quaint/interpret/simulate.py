@@ -0,0 +1,484 @@
+
+from colonel.core import Distribute, IfThenElse
+
+from ..tools.err import Exc
+from .closures import standard_builtins, assignment_operators
+from .lower import function_operators
+from .pybackend import mangle
+
+
+__all__ = ['Circuit', 'Simulation', 'Function', 'function_gates']
+
+
+# Simulates the circuits made by evaluate.CircuitMaker. A circuit is
+# compiled from the maker's graph of integers (see Circuit), so that
+# running it involves no lookup of gates or ports by name:
+#
+# * every value is a slot in a list: slot 0 holds None (for the inputs
+#   that are not connected), then come the input ports of the circuit,
+#   then the outputs of the gates. Distribute gates only copy their
+#   input, so their outputs are the slot of their source;
+# * the gates are ordered topologically, by a worklist of the gates
+#   whose inputs are all ready, and each one is compiled to an entry
+#   (kind, function, operand slots, result slot) of a schedule. A
+#   circuit with a cycle is rejected;
+# * Constant gates fill their slot once, when the circuit is compiled.
+#
+# As in the interpreter, only the branch of an IfThenElse gate that is
+# taken is evaluated: the gates that only feed one branch are placed
+# in the schedule between a SELECT entry, which jumps over the branch
+# if the condition is false, and a JUMP entry, which jumps over the
+# other branch, before the IF entry that forwards the value. The
+# schedule of "if c: a ~ else: b" is thus
+#
+#   ...c... SELECT(c) ...a... JUMP ...b... IF(c, a, b)
+#
+# A gate that feeds the branches of different gates (e.g. one that
+# share_subcircuits merged) is evaluated as soon as any of them may
+# need it, so it may be evaluated when it isn't needed. Such gates, and
+# those that depend on them, catch exceptions: the error becomes a
+# Failure value, which propagates through the gates that use it, and is
+# only raised if it reaches the output of the circuit.
+#
+# A circuit can be run on one input vector (Circuit.run), on many of
+# them at once (Circuit.run_batch: each gate then computes a column of
+# values, one per vector, so that going through the schedule is paid
+# once per batch, the vectors being split between the branches of each
+# IfThenElse) or on a stream of vectors (Simulation: only the gates
+# whose inputs changed since the last vector are evaluated).
+
+CALL, IF, CIRCUIT, SELECT, JUMP, TRY = range(6)
+
+
+class Failure:
+    """
+    The value of a gate that raised error while it was evaluated
+    without being known to be needed.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _attempt(kind, fn, operands):
+    # Evaluates a gate that may see failures or fail
+    if kind is IF:
+        cond, iftrue, iffalse = operands
+        if isinstance(cond, Failure):
+            return cond
+        return iftrue if cond else iffalse
+    for x in operands:
+        if isinstance(x, Failure):
+            return x
+    try:
+        return fn(*operands) if kind is CALL else fn.run(operands)
+    except Exception as e:
+        return Failure(e)
+
+
+def _result(value):
+    if isinstance(value, Failure):
+        raise value.error
+    return value
+
+
+class Function:
+    """
+    A gate that applies fn to the values on its inputs, in the order
+    of inputs (their port names), and puts the result on its output,
+    out.
+    """
+
+    def __init__(self, name, fn, inputs = ('a', 'b')):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+
+    def spec(self):
+        """
+        The gate spec for CircuitMaker's constants.
+        """
+        return (self, self.inputs, 'out')
+
+
+def function_gates(builtins = None):
+    """
+    Returns constants for CircuitMaker that map the operators of
+    lower.function_operators (but the assignments) to Function gates
+    applying the builtins (default: closures.standard_builtins).
+    """
+    if builtins is None:
+        builtins = standard_builtins
+    return {op: Function(mangle(op), builtins[op]).spec()
+            for op in function_operators
+            if op not in assignment_operators and op in builtins}
+
+
+class Circuit:
+    """
+    The compiled form of the circuit made by maker, an
+    evaluate.CircuitMaker on which create was called (see above).
+
+    The gates must be Constant, Distribute, IfThenElse or Function
+    gates, or applications of the circuits of lambdas, which are
+    compiled as well.
+
+    ports: the names of the inputs of the circuit, in the order of the
+        input vectors.
+
+    gates: the number of gates that are evaluated when all of them
+        are needed.
+    """
+
+    def __init__(self, maker, compiled = None):
+        # compiled maps the makers of lambdas to their Circuit
+        self.compiled = {} if compiled is None else compiled
+        self.ports = list(maker.inputs)
+        ops = maker.operators
+        slots = {}
+        initial = [None]
+        for gate, operator in enumerate(ops):
+            if gate in maker.removed or gate == maker.out or operator is Distribute:
+                continue
+            slots[gate] = len(initial)
+            initial.append(maker.values.get(gate))
+
+        def slot(target):
+            # The slot of the value on the input target
+            source = maker.sources.get(target)
+            while source is not None and ops[source[0]] is Distribute:
+                source = maker.sources.get((source[0], 'input'))
+            return 0 if source is None else slots[source[0]]
+
+        self.inputs = [slots[gate] for gate, operator in enumerate(ops)
+                       if operator is None and gate != maker.out]
+        self.output = slot((maker.out, None))
+
+        entries = {}
+        for gate, i in slots.items():
+            operator = ops[gate]
+            if operator is None or gate in maker.values:
+                continue
+            if gate in maker.subcircuits:
+                inner = maker.subcircuits[gate]
+                if inner not in self.compiled:
+                    self.compiled[inner] = Circuit(inner, self.compiled)
+                kind, fn = CIRCUIT, self.compiled[inner]
+                ports = fn.ports
+            elif operator is IfThenElse:
+                kind, fn = IF, None
+                ports = ['cond', 'iftrue', 'iffalse']
+            elif isinstance(operator, Function):
+                kind, fn = CALL, operator.fn
+                ports = operator.inputs
+            else:
+                raise Exc('simulate/unknown_gate')(
+                    "Cannot simulate the gate {gate}", gate = maker.gate_name(gate))
+            entries[i] = (kind, fn, tuple(slot((gate, port)) for port in ports), i)
+
+        self.initial = initial
+        self.gates = len(entries)
+        order = self.sort(entries)
+        self.schedule = self.layout(entries, order)
+
+        # For the propagation of events: the entries that read each
+        # slot
+        self.consumers = [[] for x in initial]
+        for r, (kind, fn, args, out) in enumerate(self.schedule):
+            if kind is not SELECT:
+                for i in set(args):
+                    self.consumers[i].append(r)
+
+        # For batches: the slots each branch reads from outside of it
+        self.free = {}
+        for r, (kind, fn, args, out) in enumerate(self.schedule):
+            if kind is SELECT:
+                join = self.schedule[fn - 1][1]
+                c, t, f = self.schedule[join][2]
+                self.free[r] = (self.reads(r + 1, fn - 1, t),
+                                self.reads(fn, join, f))
+
+    def sort(self, entries):
+        # Topological order: a worklist of the gates whose operands
+        # are all ready
+        waiting = {}
+        consumers = {}
+        for i, entry in entries.items():
+            operands = set(entry[2])
+            waiting[i] = sum(1 for j in operands if j in entries)
+            for j in operands:
+                consumers.setdefault(j, []).append(i)
+        ready = [i for i, n in waiting.items() if n == 0]
+        ready.reverse()
+        order = []
+        while ready:
+            i = ready.pop()
+            order.append(i)
+            for j in consumers.get(i, ()):
+                waiting[j] -= 1
+                if waiting[j] == 0:
+                    ready.append(j)
+        if len(order) < len(entries):
+            raise Exc('simulate/cycle')("The circuit has a cycle")
+        return order
+
+    def layout(self, entries, order):
+        # Places each gate in the innermost branch that contains all
+        # of its uses (see above), and returns the schedule.
+
+        # Contexts are None (always evaluated) or (gate, branch), the
+        # branch being True or False. A context's parent is the
+        # context of its gate.
+        owner = {}
+        depth = {None: 0}
+        def parent(context):
+            return owner[context[0]]
+        def common(a, b):
+            while depth[a] > depth[b]:
+                a = parent(a)
+            while depth[b] > depth[a]:
+                b = parent(b)
+            while a != b:
+                a, b = parent(a), parent(b)
+            return a
+
+        # Consumers come after their operands: in reverse order, all
+        # the uses of a gate are known when it is reached. A use is
+        # (context, exact), exact meaning that the user is evaluated
+        # only when it is needed.
+        uses = {self.output: [(None, True)]}
+        exact = {}
+        for i in reversed(order):
+            contexts = uses.get(i, ())
+            if not contexts:
+                # Not used: evaluated, but its errors are ignored
+                owner[i], exact[i] = None, False
+            else:
+                context = contexts[0][0]
+                for other, x in contexts[1:]:
+                    context = common(context, other)
+                owner[i] = context
+                exact[i] = any(x and other == context for other, x in contexts)
+            kind, fn, args, out = entries[i]
+            if kind is IF:
+                c, t, f = args
+                depth[(i, True)] = depth[(i, False)] = depth[owner[i]] + 1
+                for j in set(args):
+                    if j == c or (j == t and j == f):
+                        use = owner[i]
+                    else:
+                        use = (i, j == t)
+                    uses.setdefault(j, []).append((use, exact[i]))
+            else:
+                for j in set(args):
+                    uses.setdefault(j, []).append((owner[i], exact[i]))
+
+        # Gates that may see or raise a failure
+        tainted = set()
+        for i in order:
+            if not exact[i] or any(j in tainted for j in entries[i][2]):
+                tainted.add(i)
+
+        blocks = {}
+        for i in order:
+            blocks.setdefault(owner[i], []).append(i)
+
+        # Lay the blocks out, with a stack of actions rather than
+        # recursively, as ifs can be nested deeply
+        schedule = []
+        positions = {}
+        actions = [('block', None)]
+        while actions:
+            action, arg = actions.pop()
+            if action == 'block':
+                actions.extend(('gate', i) for i in reversed(blocks.get(arg, ())))
+                continue
+            entry = entries[arg]
+            if arg in tainted:
+                entry = (TRY, entry, entry[2], entry[3])
+            if action == 'gate' and entries[arg][0] is IF:
+                actions.extend([('join', arg), ('block', (arg, False)), ('jump', arg),
+                                ('block', (arg, True)), ('select', arg)])
+            elif action == 'gate' or action == 'join':
+                if action == 'join':
+                    select, jump = positions[arg]
+                    schedule[select] = (SELECT, jump + 1, entries[arg][2][:1], None)
+                    schedule[jump] = (JUMP, len(schedule), (), None)
+                schedule.append(entry)
+            else:
+                # placeholders for select and jump
+                positions.setdefault(arg, []).append(len(schedule))
+                schedule.append(None)
+        return schedule
+
+    def reads(self, start, end, result):
+        # The slots read by the entries in schedule[start:end], or the
+        # slot result, that are not written there
+        reads = {result}
+        writes = set()
+        for kind, fn, args, out in self.schedule[start:end]:
+            reads.update(args)
+            writes.add(out)
+        return reads - writes
+
+    def evaluate(self, values):
+        # Runs the schedule on values
+        schedule = self.schedule
+        n = len(schedule)
+        r = 0
+        while r < n:
+            kind, fn, args, out = schedule[r]
+            r += 1
+            if kind is CALL:
+                values[out] = fn(*[values[i] for i in args])
+            elif kind is SELECT:
+                if not values[args[0]]:
+                    r = fn
+            elif kind is JUMP:
+                r = fn
+            elif kind is IF:
+                c, t, f = args
+                values[out] = values[t] if values[c] else values[f]
+            elif kind is TRY:
+                values[out] = _attempt(fn[0], fn[1], [values[i] for i in args])
+            else:
+                values[out] = fn.run([values[i] for i in args])
+
+    def run(self, vector):
+        """
+        Returns the output of the circuit for vector, the values of
+        its inputs (see ports).
+        """
+        values = list(self.initial)
+        for i, value in zip(self.inputs, vector):
+            values[i] = value
+        self.evaluate(values)
+        return _result(values[self.output])
+
+    def run_batch(self, vectors):
+        """
+        Returns the list of the outputs of the circuit for each of the
+        input vectors.
+        """
+        n = len(vectors)
+        if n == 0:
+            return []
+        columns = [[value] * n for value in self.initial]
+        for i, column in zip(self.inputs, zip(*vectors)):
+            columns[i] = column
+        self.evaluate_batch(columns, 0, len(self.schedule), n)
+        return [_result(value) for value in columns[self.output]]
+
+    def evaluate_batch(self, columns, r, end, n):
+        # Runs schedule[r:end] on columns of n values. columns is a
+        # list, or for a branch, a dictionary of the slots it uses.
+        schedule = self.schedule
+        while r < end:
+            kind, fn, args, out = schedule[r]
+            if kind is CALL:
+                columns[out] = list(map(fn, *[columns[i] for i in args]))
+            elif kind is SELECT:
+                # The rows are split between the two branches
+                jump = fn - 1
+                join = schedule[jump][1]
+                entry = schedule[join]
+                c, t, f = entry[2]
+                out = entry[3]
+                cond = columns[c]
+                rows = [k for k, x in enumerate(cond) if x]
+                if len(rows) == n:
+                    self.evaluate_batch(columns, r + 1, jump, n)
+                    result = columns[t]
+                elif not rows:
+                    self.evaluate_batch(columns, fn, join, n)
+                    result = columns[f]
+                else:
+                    others = [k for k, x in enumerate(cond) if not x]
+                    result = [None] * n
+                    for rows, start, stop, free, slot in ((rows, r + 1, jump, self.free[r][0], t),
+                                                          (others, fn, join, self.free[r][1], f)):
+                        branch = {i: [columns[i][k] for k in rows] for i in free}
+                        self.evaluate_batch(branch, start, stop, len(rows))
+                        for k, value in zip(rows, branch[slot]):
+                            result[k] = value
+                if entry[0] is TRY:
+                    result = [x if isinstance(x, Failure) else value
+                              for x, value in zip(cond, result)]
+                columns[out] = result
+                r = join
+            elif kind is TRY:
+                kind, fn = fn[0], fn[1]
+                columns[out] = [_attempt(kind, fn, operands)
+                                for operands in zip(*[columns[i] for i in args])]
+            else:
+                columns[out] = fn.run_batch(list(zip(*[columns[i] for i in args])))
+            r += 1
+
+
+def _same(a, b):
+    return a is b or (type(a) is type(b) and a == b)
+
+
+class Simulation:
+    """
+    The state of circuit, a Circuit, as a stream of input vectors is
+    fed to it (see update).
+    """
+
+    def __init__(self, circuit):
+        self.circuit = circuit
+        self.values = list(circuit.initial)
+        # The entries of the schedule that must be evaluated, all of
+        # them at first. SELECT and JUMP entries are always visited.
+        self.dirty = bytearray([1]) * len(circuit.schedule)
+        self.evaluated = 0
+
+    def update(self, vector):
+        """
+        Sets the inputs of the circuit to vector and returns its
+        output. Only the gates whose inputs changed are evaluated: a
+        change marks the entries that read the value as dirty, and the
+        dirty entries are swept in the order of the schedule. The
+        entries of a branch that isn't taken stay dirty until it is.
+        """
+        circuit = self.circuit
+        values = self.values
+        dirty = self.dirty
+        consumers = circuit.consumers
+        schedule = circuit.schedule
+        for i, value in zip(circuit.inputs, vector):
+            if not _same(values[i], value):
+                values[i] = value
+                for r in consumers[i]:
+                    dirty[r] = 1
+        find = dirty.find
+        evaluated = 0
+        r = find(1)
+        while r >= 0:
+            kind, fn, args, out = schedule[r]
+            if kind is SELECT:
+                r = find(1, r + 1 if values[args[0]] else fn)
+                continue
+            elif kind is JUMP:
+                r = find(1, fn)
+                continue
+            dirty[r] = 0
+            evaluated += 1
+            if kind is CALL:
+                value = fn(*[values[i] for i in args])
+            elif kind is IF:
+                c, t, f = args
+                value = values[t] if values[c] else values[f]
+            elif kind is TRY:
+                value = _attempt(fn[0], fn[1], [values[i] for i in args])
+            else:
+                value = fn.run([values[i] for i in args])
+            old = values[out]
+            # _same, inlined
+            if not (old is value or (type(old) is type(value) and old == value)):
+                values[out] = value
+                for q in consumers[out]:
+                    dirty[q] = 1
+            r = find(1, r + 1)
+        self.evaluated += evaluated
+        return _result(values[circuit.output])
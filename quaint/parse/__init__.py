@@ -1,17 +1,17 @@
 
 from .standard import \
-    parser, expression, \
-    encode, decode, \
+    parser, expression, classifier, \
+    encode, decode, decode_buffer, decode_file, \
     characters, codec, operators
 
 from .generic import \
-    ast, \
+    ast, serialize, \
     ASTNode, Identifier, Numeral, Bracketed, StringVI, \
     RawOperator, Indent, OperatorBlock, RawExpr, \
     Operator, Prefix, Infix, Postfix, mkop, \
     OpApply, Void, \
-    Codec, \
+    Codec, CharClassifier, \
     QuaintSyntaxError, \
     Location, merge_locations, merge_node_locations, \
     OperatorGroup, FOperatorGroup, OpOrder, \
-    Parser
+    Parser, Tokenizer
@@ -7,14 +7,20 @@ from .ast import \
 
 from .codec import Codec
 
+from .charclass import CharClassifier
+
 from .error import QuaintSyntaxError
 
 from .location import \
     Location, merge_locations, merge_node_locations, \
-    lineno, col, linecol
+    LineIndex, line_index, lineno, col, linecol
 
 from .op import \
     OperatorGroup, FOperatorGroup, OpOrder
 
 from .parse import Parser
 
+from .tokens import Tokenizer
+
+from . import serialize
+
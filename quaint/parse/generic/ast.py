@@ -1,5 +1,6 @@
 
 import re
+from itertools import count
 from . import pyparsing as P
 from .location import merge_locations
 from .error import QuaintSyntaxError
@@ -329,6 +330,10 @@ def convert_html(x):
 
 class Canon(ASTNode):
 
+    # Structural id, set by the CanonTable that saw the node (see
+    # CanonTable.key)
+    sid = None
+
     meta = property(lambda self: self.all[0])
     command = property(lambda self: self.all[1])
     arguments = property(lambda self: self.all[2:],
@@ -407,6 +412,145 @@ class Canon(ASTNode):
         return self.str_plain()
 
 
+# Structural ids are unique across all tables, so that a node keyed by
+# one table is never mistaken for another table's.
+_sids = count(1)
+
+class CanonTable:
+    """
+    Hash-consing for Canon trees.
+
+    Each distinct structure (command and arguments, regardless of the
+    meta information, e.g. locations) gets a structural id, which is
+    cached on the nodes (node.sid). Two nodes keyed by the same table
+    have the same structural id if and only if they are structurally
+    equal, so analyses can memoize on it (see key).
+
+    Besides, the nodes made with make (or passed through intern) that
+    have no location, nor any descendant with a location, are shared:
+    there is a single instance of each such structure, e.g. for the
+    many (void) and (symbol __string_convert) nodes.
+
+    Shared nodes must not be modified in place, and a keyed node must
+    not be modified once its structural id is used. Transformations
+    like StaticExpr should work on a tree made without a table (or on
+    a copy), and pass the result through intern.
+
+    A table keeps every distinct structure it has seen, and the shared
+    nodes, for as long as it lives. Tables are therefore meant to be
+    made for one compilation (e.g. a parse3 and the passes over its
+    result) and dropped afterwards. A table must not outlive an in
+    place modification of a tree keyed with it: the sid cached on the
+    modified node would be stale.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.sids = set()
+        self.shared = {}
+
+    def leaf_key(self, x):
+        if isinstance(x, Canon):
+            return self.key(x)
+        elif isinstance(x, (list, tuple)):
+            return (type(x), tuple(map(self.leaf_key, x)))
+        else:
+            return (type(x), x)
+
+    def assign(self, node):
+        # The children must have their ids already.
+        key = (node.all[1],) + tuple(arg.sid if isinstance(arg, Canon)
+                                     else self.leaf_key(arg)
+                                     for arg in node.all[2:])
+        sid = self.ids.get(key)
+        if sid is None:
+            sid = self.ids[key] = next(_sids)
+            self.sids.add(sid)
+        node.sid = sid
+        return sid
+
+    def key(self, node):
+        """
+        Returns the structural id of node, computing it (and those of
+        its descendants) if this table did not see it before. This
+        walks the tree with an explicit stack, and stops at nodes that
+        already have an id, so keying a tree again is cheap.
+        """
+        if node.sid in self.sids:
+            return node.sid
+        stack = [(node, False)]
+        while stack:
+            this, ready = stack.pop()
+            if ready:
+                self.assign(this)
+            elif this.sid not in self.sids:
+                stack.append((this, True))
+                for arg in this.all[2:]:
+                    if isinstance(arg, Canon):
+                        stack.append((arg, False))
+        return node.sid
+
+    def equal(self, a, b):
+        """
+        True if the Canon trees a and b are structurally equal.
+        """
+        return self.key(a) == self.key(b)
+
+    def location_free(self, node):
+        # True if node has no location and its Canon children are
+        # shared (which implies that they have no location either).
+        if node.all[0].location is not None:
+            return False
+        shared = self.shared
+        for arg in node.all[2:]:
+            if isinstance(arg, Canon) and shared.get(arg.sid) is not arg:
+                return False
+        return True
+
+    def make(self, meta, command, *arguments):
+        """
+        Same as Canon(meta, command, *arguments), except that it
+        returns the shared instance of the node if it has no location
+        (see the class documentation). The arguments should have been
+        made with make as well.
+        """
+        node = Canon(meta, command, *arguments)
+        sid = self.key(node)
+        if self.location_free(node):
+            return self.shared.setdefault(sid, node)
+        return node
+
+    def intern(self, tree):
+        """
+        Keys all the nodes of tree and replaces its location-free
+        subtrees by their shared instances. The nodes are modified in
+        place, and the new root is returned (it is only different from
+        tree if tree is location-free).
+        """
+        if not isinstance(tree, Canon):
+            return tree
+        self.key(tree)
+        shared = self.shared
+        replacements = {}
+        stack = [(tree, False)]
+        while stack:
+            node, ready = stack.pop()
+            if not ready:
+                stack.append((node, True))
+                for arg in node.all[2:]:
+                    if isinstance(arg, Canon):
+                        stack.append((arg, False))
+                continue
+            args = node.all
+            for i in range(2, len(args)):
+                arg = args[i]
+                if isinstance(arg, Canon):
+                    args[i] = replacements.get(id(arg), arg)
+            if self.location_free(node):
+                replacements[id(node)] = shared.setdefault(node.sid, node)
+        return replacements.get(id(tree), tree)
+
+
 # #########################
 # ### PHASE 3 AST NODES ###
 # #########################
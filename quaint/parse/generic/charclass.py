@@ -0,0 +1,76 @@
+
+__all__ = ['CharClassifier',
+           'ID_LEAD', 'ID', 'OP1', 'OP2', 'LIST_SEP', 'VALID', 'REJECT']
+
+
+# Category flags. A character may belong to several categories, e.g.
+# every ID_LEAD character is also an ID character. A character that
+# is not VALID is not allowed in source code (outside of strings).
+ID_LEAD  = 1   # first character of an identifier
+ID       = 2   # second+ character of an identifier
+OP1      = 4   # class 1 operator character (scope builders)
+OP2      = 8   # class 2 operator character (standard)
+LIST_SEP = 16  # list separator
+VALID    = 32  # valid source code character
+REJECT   = 64  # rejected for being too similar to another character
+
+
+class CharClassifier:
+    """
+    Maps each character to a set of category flags (ID_LEAD, ID,
+    OP1, OP2, LIST_SEP, VALID, REJECT), ORed together, in a single
+    lookup.
+
+    character_classes: a module or object with the same fields as
+        quaint.parse.standard.characters (id_lead, id, op, list_sep,
+        valid, reject).
+
+    Flags for the Basic Multilingual Plane are stored in a bytearray
+    indexed by code point. The few characters outside of it that
+    belong to a category are stored in a dictionary.
+    """
+
+    def __init__(self, character_classes):
+        self.table = bytearray(0x10000)
+        self.astral = {}
+
+        cc = character_classes
+        op1, op2 = cc.op
+        for flag, chars in ((ID_LEAD, cc.id_lead),
+                            (ID, cc.id),
+                            (OP1, op1),
+                            (OP2, op2),
+                            (LIST_SEP, cc.list_sep),
+                            (VALID, cc.valid),
+                            (REJECT, cc.reject)):
+            for c in chars:
+                self.add(c, flag)
+
+    def add(self, chars, flag):
+        # Some entries hold several characters (e.g. '\\"' in valid,
+        # or digraphs that failed to decode when the codec is
+        # changed): each of them gets the flag, as they would in
+        # "".join(entries).
+        for c in chars:
+            point = ord(c)
+            if point < 0x10000:
+                self.table[point] |= flag
+            else:
+                self.astral[point] = self.astral.get(point, 0) | flag
+
+    def category(self, c):
+        point = ord(c)
+        if point < 0x10000:
+            return self.table[point]
+        return self.astral.get(point, 0)
+
+    def __getitem__(self, c):
+        return self.category(c)
+
+    def chars(self, flag):
+        """
+        Returns a string of all characters that have the given flag,
+        in code point order.
+        """
+        return "".join([chr(i) for i, f in enumerate(self.table) if f & flag]
+                       + [chr(i) for i, f in sorted(self.astral.items()) if f & flag])
@@ -1,4 +1,6 @@
 
+import mmap
+import os
 import re
 
 __all__ = ["Codec"]
@@ -97,6 +99,8 @@ class Codec:
                                   self.idchars,
                                   re.escape(self.delim_end)))
         self.decode_regexp = re.compile(decode_regexp_expr)
+        # Same thing, but to run directly over ASCII bytes (see decode_buffer)
+        self.decode_regexp_bytes = re.compile(decode_regexp_expr.encode("ascii"))
 
         # A map of {character: [possible_encodings]}, not used by this
         # package except for the emacs mode so far.
@@ -115,6 +119,61 @@ class Codec:
         text = self.decode_regexp.sub(self.__get_unicode, text)
         return text
 
+    def decode_buffer(self, buffer, write, chunk_size = 1 << 16):
+        """
+        Decodes an encoded UTF-8 buffer (bytes, memoryview, mmap...)
+        and passes the result to write in pieces of roughly chunk_size
+        characters. The buffer is never converted to a str as a
+        whole, so this works on inputs much larger than memory when
+        given a mmap (see decode_file).
+        """
+        pieces = []
+        size = 0
+        for piece in self.__decode_pieces(buffer, chunk_size):
+            pieces.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                write("".join(pieces))
+                pieces = []
+                size = 0
+        if pieces:
+            write("".join(pieces))
+
+    def __decode_pieces(self, buffer, chunk_size):
+        # The decoded pieces of buffer: the runs of text between the
+        # escapes, cut into pieces of about chunk_size bytes, and the
+        # characters the escapes stand for. The escapes are ASCII.
+        pos = 0
+        for m in self.decode_regexp_bytes.finditer(buffer):
+            start, end = m.span()
+            yield from self.__decode_run(buffer, pos, start, chunk_size)
+            di, id = m.groups()
+            yield self.__lookup(None if di is None else str(di, "ascii"),
+                                None if id is None else str(id, "ascii"))
+            pos = end
+        yield from self.__decode_run(buffer, pos, len(buffer), chunk_size)
+
+    def __decode_run(self, buffer, start, end, chunk_size):
+        while start < end:
+            stop = min(start + chunk_size, end)
+            # Don't cut a UTF-8 sequence: skip its continuation bytes
+            while stop < end and 0x80 <= buffer[stop] < 0xC0:
+                stop += 1
+            yield str(buffer[start:stop], "utf-8")
+            start = stop
+
+    def decode_file(self, path, write, chunk_size = 1 << 16):
+        """
+        Decodes the file at path through a read-only mmap and passes
+        the result to write in pieces (see decode_buffer).
+        """
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                # mmap refuses empty files
+                return
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as buffer:
+                self.decode_buffer(buffer, write, chunk_size)
+
     def encode(self, text):
         res = []
         previous = None
@@ -171,6 +230,9 @@ class Codec:
     def __get_unicode(self, m):
         # applies on a match object, it should be from self.decode_regexp_expr
         di, id = m.groups() # we get groups 1 and 2
+        return self.__lookup(di, id)
+
+    def __lookup(self, di, id):
         if di is not None:
             # group 1 matches some digraph from the list of digraphs
             # if the match is from decode_regexp_expr we know it's a valid digraph
@@ -1,9 +1,10 @@
 
-from functools import reduce
-from . import pyparsing as P
+from bisect import bisect_right
+from functools import reduce, lru_cache
 
 
 __all__ = ['Location', 'merge_locations', 'merge_node_locations',
+           'LineIndex', 'line_index',
            'lineno', 'col', 'linecol']
 
 
@@ -74,21 +75,95 @@ class Location(object):
     def __str__(self):
         return self.ref()
 
+class LineIndex(object):
+    """
+    Line index of some source code: the position at which each line
+    starts. Converting a position to a line and column is a binary
+    search, and the extent of any range of lines can be computed
+    without splitting the source.
+
+    Use line_index(source) rather than instantiating this directly,
+    so that the index is built once per source.
+
+    Lines are numbered from 1, like columns. A newline character
+    counts as column 0 of the line that it starts.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        starts = [0]
+        i = source.find('\n')
+        while i != -1:
+            starts.append(i + 1)
+            i = source.find('\n', i + 1)
+        self.nlines = len(starts)
+        # sentinel: where the line after the last one would start
+        starts.append(len(source) + 1)
+        self.starts = starts
+
+    def lineno(self, pos):
+        if pos < len(self.source) and self.source[pos] == '\n':
+            pos += 1
+        return bisect_right(self.starts, pos, 0, self.nlines)
+
+    def col(self, pos):
+        return pos - self.starts[self.lineno(pos) - 1] + 1
+
+    def linecol(self, start, end, promote_zerolength = False):
+        end -= 1 # end position is now inclusive
+        l1 = self.lineno(start)
+        c1 = start - self.starts[l1 - 1] + 1
+        if start > end:
+            return ((l1, c1), (l1, c1) if promote_zerolength else None)
+        l2 = self.lineno(end)
+        c2 = end - self.starts[l2 - 1] + 1
+        return ((l1, c1), (l2, c2))
+
+    def line_of(self, pos):
+        """
+        Line that contains the position pos. Unlike lineno, a newline
+        counts as part of the line it ends.
+        """
+        return bisect_right(self.starts, pos, 0, self.nlines)
+
+    def line_start(self, line):
+        """
+        Position of the first character of the given line.
+        """
+        return self.starts[line - 1]
+
+    def text_length(self, first, last):
+        """
+        Total length of lines first to last (inclusive), not counting
+        the newlines. The range is clipped to the lines that exist.
+        This is the same as sum(map(len, lines[first-1:last])) if
+        lines = source.split('\\n'), for first >= 1 and last >= 0.
+        """
+        a = min(max(first - 1, 0), self.nlines)
+        b = min(max(last, 0), self.nlines)
+        if b <= a:
+            return 0
+        starts = self.starts
+        return (starts[b] - b) - (starts[a] - a)
+
+
+@lru_cache(maxsize = 16)
+def line_index(source):
+    """
+    Returns the LineIndex of source. The last few indexes are cached,
+    so e.g. highlighting many errors in the same file only indexes it
+    once.
+    """
+    return LineIndex(source)
+
 def lineno(start, source):
-    x = P.lineno(start, source)
-    return x + (source[start] == '\n')
+    return line_index(source).lineno(start)
 
 def col(start, source):
-    x = P.col(start, source)
-    return x - (source[start] == '\n')
+    return line_index(source).col(start)
 
 def linecol(source, start, end, promote_zerolength = False):
-    end -= 1 # end position is now inclusive
-    l1, c1 = lineno(start, source), col(start, source)
-    if start > end:
-        return ((l1, c1), (l1, c1) if promote_zerolength else None)
-    l2, c2 = lineno(end, source), col(end, source)
-    return ((l1, c1), (l2, c2))
+    return line_index(source).linecol(start, end, promote_zerolength)
 
 def merge_locations(locations):
     """
@@ -2,7 +2,9 @@
 from functools import reduce
 
 from . import ast, location, pyparsing as P
+from .charclass import CharClassifier, ID_LEAD, ID, OP1, OP2, VALID, REJECT
 from .error import QuaintSyntaxError
+from .tokens import Tokenizer
 
 ###############
 ### HELPERS ###
@@ -24,6 +26,30 @@ Star = lambda *args, **kwargs: P.ZeroOrMore(*args, **kwargs).leaveWhitespace()
 Plus = lambda *args, **kwargs: P.OneOrMore(*args, **kwargs).leaveWhitespace()
 FW = lambda: P.Forward().leaveWhitespace()
 
+
+class InvalidChar(P.Token):
+    """
+    Matches one character that is not VALID according to a
+    CharClassifier. This is N1(valid), but with a table lookup
+    instead of a scan of the string of valid characters.
+    """
+    def __init__(self, classifier):
+        super().__init__()
+        self.classifier = classifier
+        self.skipWhitespace = False
+        self.name = "invalid character"
+        self.errmsg = "Expected " + self.name
+        self.mayReturnEmpty = False
+        self.mayIndexError = False
+
+    def parseImpl(self, instring, loc, doActions = True):
+        if loc >= len(instring) or self.classifier.category(instring[loc]) & VALID:
+            exc = self.myException
+            exc.loc = loc
+            exc.pstr = instring
+            raise exc.with_traceback(None)
+        return loc + 1, instring[loc]
+
 def compute_length(tokens):
     """
     """
@@ -44,7 +70,8 @@ def auto_location(f):
     to f. Use this to wrap functions for use as parse actions.
     """
     def f2(self, s, loc, tokens):
-        l = location.Location(s, (loc, loc + compute_length(tokens)), tokens)
+        l = location.Location(s, (loc, loc + compute_length(tokens)),
+                              tokens if self.keep_tokens else None)
         return f(self, l, [t for t in tokens if not isinstance(t, Suppressor)])
     return f2
 
@@ -57,6 +84,21 @@ def make_juxtaposition(loc):
 def is_whitespace(op):
     return op.op in ('_', '__')
 
+def error_spans(err):
+    """
+    Returns the spans of the locations of all nodes mentioned in a
+    QuaintSyntaxError, in order.
+    """
+    spans = []
+    def collect(x):
+        if isinstance(x, (list, tuple)):
+            for y in x:
+                collect(y)
+        elif getattr(x, 'location', None) is not None:
+            spans.append(tuple(x.location.span))
+    collect(err.info)
+    return spans
+
 
 ##############
 ### PARSER ###
@@ -64,9 +106,20 @@ def is_whitespace(op):
 
 class Parser:
 
+    radix_marks = "rR"
+    exponent_marks = "eE"
+
     def __init__(self, character_classes, operator_roles):
 
         self.character_classes = character_classes
+        self.classifier = CharClassifier(character_classes)
+        # When this is a list, syntax errors are recorded in it and
+        # parsing goes on (see parse_with_errors)
+        self.errors = None
+        self.error_keys = None
+        # Whether Locations keep the tokens they were made from (see
+        # check)
+        self.keep_tokens = True
         self.operator_roles = operator_roles
         self.string_translations = character_classes.string_translations
         self.xso, self.xsc = character_classes.ext_str
@@ -87,15 +140,17 @@ class Parser:
 
         ### Identifier ###
         self.identifier = W(
-            "".join(character_classes.id_lead),
-            "".join(character_classes.id)).setParseAction(self.handler_identifier)
+            self.classifier.chars(ID_LEAD),
+            self.classifier.chars(ID)).setParseAction(self.handler_identifier)
 
         ### Numerals ###
-        _num = W(P.nums, P.nums + "_")
-        _alphanum = W(P.alphanums + "_")
-        _exponent = A1('eE') + (O("-") + _num).setParseAction(lambda tokens: "".join(tokens))
+        # The Tokenizer builds its patterns from num_digits,
+        # num_alphanums, radix_marks and exponent_marks
+        _num = self.num_digits = W(P.nums, P.nums + "_")
+        _alphanum = self.num_alphanums = W(P.alphanums + "_")
+        _exponent = A1(self.exponent_marks) + (O("-") + _num).setParseAction(lambda tokens: "".join(tokens))
 
-        self.num_radix = (G(_num + A1("rR"))
+        self.num_radix = (G(_num + A1(self.radix_marks))
                           + G(O(_alphanum))
                           + G(O("." + O(_alphanum)))).setParseAction(self.handler_num_radix)
         self.num_decimal = ((G(_num)
@@ -157,8 +212,8 @@ class Parser:
                      | self.string)
 
         ### Operators ###
-        self.class_1_op = W("".join(character_classes.op[0])).setParseAction(self.handler_op)
-        self.class_2_op = W("".join(character_classes.op[1])).setParseAction(self.handler_op)
+        self.class_1_op = W(self.classifier.chars(OP1)).setParseAction(self.handler_op)
+        self.class_2_op = W(self.classifier.chars(OP2)).setParseAction(self.handler_op)
         self.list_separator = A1(character_classes.list_sep).setParseAction(self.handler_op)
 
         ### Whitespace ###
@@ -181,7 +236,8 @@ class Parser:
                              + self.op).setParseAction(self.handler_op_block)
 
 
-        self.invalid = N1(character_classes.valid).setParseAction(self.handler_invalid)
+        self.invalid = InvalidChar(self.classifier).leaveWhitespace() \
+            .setParseAction(self.handler_invalid)
 
         ### Expression ###
         self.expression << Star(Suppr(self.comment)
@@ -191,6 +247,8 @@ class Parser:
                                 | self.indent
                                 | self.invalid).setParseAction(self.handler_raw_expr)
 
+        self.tokenizer = Tokenizer(self)
+
 
 
     ################
@@ -312,16 +370,51 @@ class Parser:
         return self.postprocess(e)
 
     def handler_invalid(self, s, loc, tokens):
-        rejections = self.character_classes.reject
         char = tokens[0]
         token = ast.ASTNode(location.Location(s, (loc, loc + 1), tokens))
         if char == '\t':
-            raise QuaintSyntaxError('no_tabs', token)
-        elif char in rejections:
-            repl = rejections[char]
-            raise QuaintSyntaxError('ambiguous_character', char, repl, token)
+            err = QuaintSyntaxError('no_tabs', token)
+        elif self.classifier.category(char) & REJECT:
+            repl = self.character_classes.reject[char]
+            err = QuaintSyntaxError('ambiguous_character', char, repl, token)
         else:
-            raise QuaintSyntaxError('bad_character', char, token)
+            err = QuaintSyntaxError('bad_character', char, token)
+        self.error(err)
+        # recovering: the character is skipped
+        return Suppressor(tokens)
+
+
+    ######################
+    ### ERROR RECOVERY ###
+    ######################
+
+    def error(self, err):
+        """
+        Raises err, or records it if errors are being collected.
+        """
+        if self.errors is None:
+            raise err
+        # pyparsing may backtrack over the same text several times,
+        # so the same error can come up more than once.
+        key = (err.kind, tuple(error_spans(err)))
+        if key not in self.error_keys:
+            self.error_keys.add(key)
+            self.errors.append(err)
+
+    def statement(self, expr):
+        """
+        Builds the expression for one statement, i.e. one element of a
+        sequence. This is where we resynchronize after an error: if
+        errors are being collected, a statement that cannot be built
+        is replaced by a Void node and the next one is parsed as usual.
+        """
+        if self.errors is None:
+            return self.cleanup_opblocks(expr)
+        try:
+            return self.cleanup_opblocks(expr)
+        except QuaintSyntaxError as err:
+            self.error(err)
+            return ast.Void(expr.location)
 
 
     ######################
@@ -378,8 +471,8 @@ class Parser:
 
         new_tokens = [
             (separator,
-             self.cleanup_opblocks(ast.RawExpr(location.merge_node_locations(token_list),
-                                               token_list)))
+             self.statement(ast.RawExpr(location.merge_node_locations(token_list),
+                                        token_list)))
             for separator, token_list in zip(separators, tokens)
             if token_list]
 
@@ -695,13 +788,24 @@ class Parser:
             if not partials:
                 break
 
-        def transform(x):
-            if isinstance(x, tuple):
-                op, left, right = x
-                return ast.OpApply(op, transform(left), transform(right))
-            return x
-
-        return transform(x)
+        # We turn the (op, left, right) tuples into OpApply nodes
+        # with an explicit stack, so that long chains of operators
+        # (e.g. thousands of ~ elif clauses) don't blow the stack.
+        stack = [(x, False)]
+        done = []
+        while stack:
+            x, ready = stack.pop()
+            if not isinstance(x, tuple):
+                done.append(x)
+            elif ready:
+                right = done.pop()
+                left = done.pop()
+                done.append(ast.OpApply(x[0], left, right))
+            else:
+                stack.append((x, True))
+                stack.append((x[2], False))
+                stack.append((x[1], False))
+        return done[0]
     
 
     #############
@@ -716,13 +820,70 @@ class Parser:
         e = Convert2().visit(ast.Bracketed(e.location, "P", e))
         return e
 
-    def parse3(self, code):
+    def parse3(self, code, table = None):
+        """
+        Parses code down to a Canon tree. If table (an ast.CanonTable)
+        is given, the nodes are hash-consed with it.
+        """
         e = self.parse2(code)
-        e = Convert3().visit(e)
+        e = Convert3(table).visit(e)
         return e
 
-    def parse(self, code):
-        return self.parse3(code)
+    def parse(self, code, table = None):
+        return self.parse3(code, table)
+
+    def parse_with_errors(self, code, phase = 2):
+        """
+        Parses code up to the given phase (1 or 2), but instead of
+        stopping at the first syntax error, records it and carries on:
+        invalid characters are skipped, and statements that cannot be
+        parsed are replaced by Void nodes (the next statement, or the
+        end of the bracket that contains it, starts afresh).
+
+        Returns (tree, errors), where errors is a list of
+        QuaintSyntaxErrors, in the order they appear in the code.
+        """
+        if phase not in (1, 2):
+            raise ValueError("phase must be 1 or 2, not %s" % phase)
+        # The errors of an enclosing call are put back afterwards, so
+        # that nested calls do not mix them up.
+        saved = self.errors, self.error_keys
+        errors = self.errors = []
+        self.error_keys = set()
+        try:
+            e = self.parse1(code) if phase == 1 else self.parse2(code)
+        finally:
+            self.errors, self.error_keys = saved
+        errors.sort(key = lambda err: (error_spans(err) or [(len(code), 0)])[0])
+        return e, errors
+
+    def check(self, code):
+        """
+        Checks the syntax of code and returns the list of syntax
+        errors found (empty if there are none), like
+        parse_with_errors. This goes through the same lexing, fixity
+        and priority checks as parse, but stops at phase 1 and does
+        not record the tokens in the Locations, which merging them
+        would otherwise spend most of its time concatenating.
+        """
+        saved = self.keep_tokens
+        self.keep_tokens = False
+        try:
+            tree, errors = self.parse_with_errors(code, phase = 1)
+        finally:
+            self.keep_tokens = saved
+        return errors
+
+    def tokens(self, code):
+        """
+        Yields the lexical tokens of code as (kind, start, end) tuples,
+        lazily and without parsing it (see Tokenizer for the possible
+        kinds). This never fails: characters that cannot be lexed are
+        reported as "invalid" tokens. Operator fixities are guessed
+        from the whitespace around them and may differ from what parse
+        would find.
+        """
+        return self.tokenizer(code)
 
     # def parse(self, code):
     #     return self.expression.parseWithTabs().parseString(code)[0]
@@ -737,14 +898,27 @@ class Convert2(ast.ASTVisitor):
     def visit_OpApply(self, node):
         # operator = self.visit(node.operator)
         operator = node.operator
-        children = map(self.visit, node.children)
+        # A chain of applications of the same operator is nested to the
+        # left, e.g. a sequence of n statements is a chain of n - 1 ","
+        # applications, and an if with n elif clauses, a chain of n "~"
+        # applications. We walk down the chain in a loop rather than
+        # recursively, so that long files don't blow the stack.
+        chain = [node]
+        a = node.children[0]
+        while isinstance(a, ast.OpApply) and a.operator == operator:
+            chain.append(a)
+            a = a.children[0]
+        first = self.visit(a)
         if self.do_collapse(operator):
-            a, *b = children
-            if isinstance(a, ast.OpApply) and a.operator == operator:
-                return ast.OpApply(operator, *(a.children + b), location = node.location)
-            else:
-                return ast.OpApply(operator, a, *b, location = node.location)
-        return ast.OpApply(operator, *children, location = node.location)
+            children = [first]
+            for link in reversed(chain):
+                children.extend(map(self.visit, link.children[1:]))
+            return ast.OpApply(operator, *children, location = node.location)
+        for link in reversed(chain):
+            first = ast.OpApply(link.operator, first,
+                                *map(self.visit, link.children[1:]),
+                                location = link.location)
+        return first
 
     def visit_Bracketed(self, node):
         expr = self.visit(node.expression)
@@ -787,40 +961,66 @@ class Convert2(ast.ASTVisitor):
 
 class Convert3(ast.ASTVisitor):
 
-    def __init__(self):
+    def __init__(self, table = None):
         self.nest = [0]
         self.nest_idx = 0
+        # With a CanonTable, identical location-free subtrees are
+        # shared and every node gets its structural id
+        self.canon = ast.Canon if table is None else table.make
 
     def visit_OpApply(self, node):
-        self.nest_idx += 1
-        self.nest.append(self.nest_idx)
+        # Chains of applications of the same operator (e.g. f x y, or
+        # the ~ clauses of an if) are walked in a loop, as in Convert2.
+        chain = [node]
+        a = node.children[0]
+        while isinstance(a, ast.OpApply) and a.operator == node.operator:
+            chain.append(a)
+            a = a.children[0]
+        for link in chain:
+            self.nest_idx += 1
+            self.nest.append(self.nest_idx)
+        rval = self.visit(a)
+        for link in reversed(chain):
+            rval = self.make_apply(link, rval)
+            self.nest.pop()
+        return rval
+
+    def make_apply(self, node, first):
+        # Converts the OpApply node, given its first operand, already
+        # converted.
         operator = node.operator
         if operator.op in ("__", "_"):
-            fn = self.visit(node.children[0])
             arg = self.visit(node.children[1])
-            loc = location.merge_locations([fn.meta.location, arg.meta.location])
-            rval = ast.Canon(ast.Meta(location = loc,
-                                      nest = None),
-                             'apply', fn, arg)
+            loc = location.merge_locations([first.meta.location, arg.meta.location])
+            return self.canon(ast.Meta(location = loc,
+                                       nest = None),
+                              'apply', first, arg)
+        app = self.canon(ast.Meta(location = operator.location,
+                                  nest = list(self.nest)),
+                         'symbol',
+                         operator.op)
+        self.nest_idx += 1
+        self.nest.append(self.nest_idx)
+        items = [first] + [self.visit(item) for item in node.children[1:]]
+        if len(items) == 1:
+            operands = items[0]
         else:
-            app = ast.Canon(ast.Meta(location = operator.location,
-                                     nest = list(self.nest)),
-                            'symbol',
-                            operator.op)
-            rval = ast.Canon(ast.Meta(location = node.location,
-                                      nest = None),
-                             'apply',
-                             app,
-                             ast.Canon(ast.Meta(location = node.location,
-                                                nest = None),
-                                       'syntax',
-                                       self.visit(ast.Sequence(node.location,
-                                                               node.children))))
+            operands = self.canon(ast.Meta(location = node.location,
+                                           nest = list(self.nest)),
+                                  'begin',
+                                  *items)
         self.nest.pop()
-        return rval
+        return self.canon(ast.Meta(location = node.location,
+                                   nest = None),
+                          'apply',
+                          app,
+                          self.canon(ast.Meta(location = node.location,
+                                              nest = None),
+                                     'syntax',
+                                     operands))
 
     def visit_NoneType(self, node):
-        return ast.Canon(ast.Meta(None, None), "void")
+        return self.canon(ast.Meta(None, None), "void")
 
     def visit_Sequence(self, node):
         if len(node.items) == 0:
@@ -830,11 +1030,11 @@ class Convert3(ast.ASTVisitor):
         if len(node.items) == 1:
             rval = self.visit(node.items[0])
         else:
-            rval = ast.Canon(ast.Meta(location = node.location,
-                                      nest = list(self.nest)),
-                             'begin',
-                             *[self.visit(item)
-                               for item in node.items])
+            rval = self.canon(ast.Meta(location = node.location,
+                                       nest = list(self.nest)),
+                              'begin',
+                              *[self.visit(item)
+                                for item in node.items])
 
         self.nest.pop()
         return rval
@@ -842,11 +1042,11 @@ class Convert3(ast.ASTVisitor):
     def visit_Table(self, node):
         self.nest_idx += 1
         self.nest.append(self.nest_idx)
-        rval = ast.Canon(ast.Meta(location = node.location,
-                                  nest = list(self.nest)),
-                         'table',
-                         *[self.visit(item)
-                           for item in node.items])
+        rval = self.canon(ast.Meta(location = node.location,
+                                   nest = list(self.nest)),
+                          'table',
+                          *[self.visit(item)
+                            for item in node.items])
 
         self.nest.pop()
         return rval
@@ -854,7 +1054,7 @@ class Convert3(ast.ASTVisitor):
     def visit_Code(self, node):
         self.nest_idx += 1
         self.nest.append(self.nest_idx)
-        rval = ast.Canon(ast.Meta(location = node.location,
+        rval = self.canon(ast.Meta(location = node.location,
                                   nest = list(self.nest)),
                          'syntax',
                          self.visit(ast.Sequence(node.location,
@@ -863,14 +1063,14 @@ class Convert3(ast.ASTVisitor):
         return rval
 
     def visit_Identifier(self, node):
-        return ast.Canon(ast.Meta(location = node.location,
+        return self.canon(ast.Meta(location = node.location,
                                   nest = list(self.nest)),
                          'symbol',
                          node.id)
 
     def visit_Numeral(self, node):
         ndig = len(node.digits)
-        return ast.Canon(ast.Meta(location = node.location,
+        return self.canon(ast.Meta(location = node.location,
                                   nest = None),
                          'value',
                          sum(v * node.radix**(ndig - i - 1)
@@ -881,14 +1081,14 @@ class Convert3(ast.ASTVisitor):
         items = []
         for item in node.items:
             if isinstance(item, str):
-                items.append(ast.Canon(ast.Meta(location = None,
+                items.append(self.canon(ast.Meta(location = None,
                                                 nest = None),
                                        'value', item))
             else:
-                item = ast.Canon(ast.Meta(location = item.location,
+                item = self.canon(ast.Meta(location = item.location,
                                           nest = None),
                                  'apply',
-                                 ast.Canon(ast.Meta(location = None,
+                                 self.canon(ast.Meta(location = None,
                                                     nest = None),
                                            'symbol', '__string_convert'),
                                  self.visit(item))
@@ -896,13 +1096,13 @@ class Convert3(ast.ASTVisitor):
         if len(items) == 1:
             return items[0]
         else:
-            return ast.Canon(ast.Meta(location = node.location,
+            return self.canon(ast.Meta(location = node.location,
                                       nest = None),
                              'apply',
-                             ast.Canon(ast.Meta(location = None,
+                             self.canon(ast.Meta(location = None,
                                                 nest = None),
                                        'symbol', '__string_append'),
-                             ast.Canon(ast.Meta(location = node.location,
+                             self.canon(ast.Meta(location = node.location,
                                                 nest = None),
                                        'table',
                                        *items))
@@ -28,6 +28,10 @@
 #   caused me grief: basically, if you give a method to setParseAction,
 #   it messes up the number of arguments because of the self. Or so I
 #   figured. Who cares. It's not there anymore.
+# - the preallocated exceptions (self.myException) are raised with
+#   their traceback cleared. Raising the same exception object over
+#   and over in Python 3 chains every new traceback onto the old one,
+#   which made parsing quadratic in the size of the source.
 
 __doc__ = \
 """
@@ -1003,7 +1007,7 @@ class ParserElement(object):
             else:
                 # catch and re-raise exception from here, clears out pyparsing internal stack trace
                 exc = sys.exc_info()[1]
-                raise exc
+                raise exc.with_traceback(None)
         else:
             return tokens
 
@@ -1048,7 +1052,7 @@ class ParserElement(object):
             else:
                 # catch and re-raise exception from here, clears out pyparsing internal stack trace
                 exc = sys.exc_info()[1]
-                raise exc
+                raise exc.with_traceback(None)
 
     def transformString( self, instring ):
         """Extension to C{scanString}, to modify matching text with modified tokens that may
@@ -1081,7 +1085,7 @@ class ParserElement(object):
             else:
                 # catch and re-raise exception from here, clears out pyparsing internal stack trace
                 exc = sys.exc_info()[1]
-                raise exc
+                raise exc.with_traceback(None)
 
     def searchString( self, instring, maxMatches=_MAX_INT ):
         """Another extension to C{scanString}, simplifying the access to the tokens found
@@ -1096,7 +1100,7 @@ class ParserElement(object):
             else:
                 # catch and re-raise exception from here, clears out pyparsing internal stack trace
                 exc = sys.exc_info()[1]
-                raise exc
+                raise exc.with_traceback(None)
 
     def __add__(self, other ):
         """Implementation of + operator - returns And"""
@@ -1373,7 +1377,7 @@ class ParserElement(object):
         except ParseBaseException:
             # catch and re-raise exception from here, clears out pyparsing internal stack trace
             exc = sys.exc_info()[1]
-            raise exc
+            raise exc.with_traceback(None)
 
     def getException(self):
         return ParseException("",0,self.errmsg,self)
@@ -1446,7 +1450,7 @@ class NoMatch(Token):
         exc = self.myException
         exc.loc = loc
         exc.pstr = instring
-        raise exc
+        raise exc.with_traceback(None)
 
 
 class Literal(Token):
@@ -1479,7 +1483,7 @@ class Literal(Token):
         exc = self.myException
         exc.loc = loc
         exc.pstr = instring
-        raise exc
+        raise exc.with_traceback(None)
 _L = Literal
 
 class Keyword(Token):
@@ -1530,7 +1534,7 @@ class Keyword(Token):
         exc = self.myException
         exc.loc = loc
         exc.pstr = instring
-        raise exc
+        raise exc.with_traceback(None)
 
     def copy(self):
         c = super(Keyword,self).copy()
@@ -1563,7 +1567,7 @@ class CaselessLiteral(Literal):
         exc = self.myException
         exc.loc = loc
         exc.pstr = instring
-        raise exc
+        raise exc.with_traceback(None)
 
 class CaselessKeyword(Keyword):
     def __init__( self, matchString, identChars=Keyword.DEFAULT_KEYWORD_CHARS ):
@@ -1577,7 +1581,7 @@ class CaselessKeyword(Keyword):
         exc = self.myException
         exc.loc = loc
         exc.pstr = instring
-        raise exc
+        raise exc.with_traceback(None)
 
 class Word(Token):
     """Token for matching words composed of allowed character sets.
@@ -1646,7 +1650,7 @@ class Word(Token):
                 exc = self.myException
                 exc.loc = loc
                 exc.pstr = instring
-                raise exc
+                raise exc.with_traceback(None)
 
             loc = result.end()
             return loc,result.group()
@@ -1656,7 +1660,7 @@ class Word(Token):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
         start = loc
         loc += 1
         instrlen = len(instring)
@@ -1680,7 +1684,7 @@ class Word(Token):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
 
         return loc, instring[start:loc]
 
@@ -1753,7 +1757,7 @@ class Regex(Token):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
 
         loc = result.end()
         d = result.groupdict()
@@ -1858,7 +1862,7 @@ class QuotedString(Token):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
 
         loc = result.end()
         ret = result.group()
@@ -1929,7 +1933,7 @@ class CharsNotIn(Token):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
 
         start = loc
         loc += 1
@@ -1944,7 +1948,7 @@ class CharsNotIn(Token):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
 
         return loc, instring[start:loc]
 
@@ -2002,7 +2006,7 @@ class White(Token):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
         start = loc
         loc += 1
         maxloc = start + self.maxLen
@@ -2015,7 +2019,7 @@ class White(Token):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
 
         return loc, instring[start:loc]
 
@@ -2072,7 +2076,7 @@ class LineStart(_PositionToken):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
         return loc, []
 
 class LineEnd(_PositionToken):
@@ -2092,14 +2096,14 @@ class LineEnd(_PositionToken):
                 exc = self.myException
                 exc.loc = loc
                 exc.pstr = instring
-                raise exc
+                raise exc.with_traceback(None)
         elif loc == len(instring):
             return loc+1, []
         else:
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
 
 class StringStart(_PositionToken):
     """Matches if current position is at the beginning of the parse string"""
@@ -2116,7 +2120,7 @@ class StringStart(_PositionToken):
                 exc = self.myException
                 exc.loc = loc
                 exc.pstr = instring
-                raise exc
+                raise exc.with_traceback(None)
         return loc, []
 
 class StringEnd(_PositionToken):
@@ -2132,7 +2136,7 @@ class StringEnd(_PositionToken):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
         elif loc == len(instring):
             return loc+1, []
         elif loc > len(instring):
@@ -2141,7 +2145,7 @@ class StringEnd(_PositionToken):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
 
 class WordStart(_PositionToken):
     """Matches if the current position is at the beginning of a Word, and
@@ -2162,7 +2166,7 @@ class WordStart(_PositionToken):
                 exc = self.myException
                 exc.loc = loc
                 exc.pstr = instring
-                raise exc
+                raise exc.with_traceback(None)
         return loc, []
 
 class WordEnd(_PositionToken):
@@ -2187,7 +2191,7 @@ class WordEnd(_PositionToken):
                 exc = self.myException
                 exc.loc = loc
                 exc.pstr = instring
-                raise exc
+                raise exc.with_traceback(None)
         return loc, []
 
 
@@ -2675,7 +2679,7 @@ class NotAny(ParseElementEnhance):
             exc = self.myException
             exc.loc = loc
             exc.pstr = instring
-            raise exc
+            raise exc.with_traceback(None)
         return loc, []
 
     def __str__( self ):
@@ -2867,7 +2871,7 @@ class SkipTo(ParseElementEnhance):
         exc = self.myException
         exc.loc = loc
         exc.pstr = instring
-        raise exc
+        raise exc.with_traceback(None)
 
 class Forward(ParseElementEnhance):
     """Forward declaration of an expression to be defined later -
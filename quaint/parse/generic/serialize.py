@@ -0,0 +1,509 @@
+
+import struct
+
+from . import ast
+from .location import Location
+
+
+__all__ = ['dumps', 'loads', 'dump', 'load', 'VERSION']
+
+
+# Binary format for syntax trees: phase 1 and 2 trees (OpApply,
+# Identifier, Numeral, StringVI, Bracketed, Void, Sequence, Table,
+# Code) and Canon trees (phase 3).
+#
+# A serialized tree is:
+#
+#   MAGIC, VERSION (one byte)
+#   the constant table: count, then each constant (see below)
+#   the number of bytes of the node stream, then the node stream
+#
+# All integers are unsigned varints (7 bits per byte, least
+# significant first, high bit set on all bytes but the last), except
+# where zigzag encoding is mentioned (for signed integers).
+#
+# The constant table holds every string (symbols, string pieces,
+# sources) and every number that appears in the tree, once each. A
+# constant is a tag (0: str, 1: int (zigzag), 2: float) followed by
+# the UTF-8 length and bytes, the varint, or the 8 bytes of a double.
+#
+# The node stream is made of varints only. Nodes are written in
+# postorder: a node's children come before it, so that the loader
+# can build the tree with a stack, popping the children of each node
+# as it comes, without recursing. Each node is its code (see NODE
+# CODES below) followed by its fields, then, for ASTNodes, by its
+# location:
+#
+#   0: no location
+#   1, source, start, length: a new location (source is the index of
+#      the source code in the constant table)
+#   k + 2: the same Location object as the k-th new location in the
+#      stream (Canon trees share many locations)
+#
+# The tokens of locations are not serialized (they are None once
+# loaded), nor are the nesting informations of Canon's Meta, which
+# Meta does not keep anyway.
+#
+# Any change to the format must bump VERSION: load refuses other
+# versions, so that stale caches are rebuilt rather than misread.
+
+MAGIC = b"QTREE"
+VERSION = 1
+
+# Constant tags
+C_STR = 0
+C_INT = 1
+C_FLOAT = 2
+
+# Node codes
+N_NONE = 0
+N_TRUE = 1
+N_FALSE = 2
+N_CONST = 3        # index
+N_CANON = 4        # command index, number of arguments, location
+N_IDENTIFIER = 5   # id index, location
+N_NUMERAL = 6      # radix, exp (zigzag), number of digits, digits, location
+N_STRINGVI = 7     # number of items, location
+N_BRACKETED = 8    # type index, location
+N_OPAPPLY = 9      # number of children, location (operator comes first)
+N_OPERATOR = 10    # kind (0: prefix, 1: infix, 2: postfix, 3: other), op index,
+                   # [fixity index if kind is 3], location
+N_VOID = 11        # location
+N_SEQUENCE = 12    # number of items, location
+N_TABLE = 13
+N_CODE = 14
+
+_seq_codes = {ast.Sequence: N_SEQUENCE, ast.Table: N_TABLE, ast.Code: N_CODE}
+_seq_classes = {N_SEQUENCE: ast.Sequence, N_TABLE: ast.Table, N_CODE: ast.Code}
+
+_fixities = {ast.Prefix: 0, ast.Infix: 1, ast.Postfix: 2}
+_fixity_classes = (ast.Prefix, ast.Infix, ast.Postfix)
+
+_float = struct.Struct("<d")
+
+
+def _varint(n, out):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+def _unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+##############
+### WRITER ###
+##############
+
+class _Writer:
+
+    def __init__(self):
+        self.constants = {}
+        self.locations = {}
+        self.stream = bytearray()
+
+    def constant(self, value):
+        key = (type(value), value)
+        try:
+            return self.constants[key]
+        except KeyError:
+            i = self.constants[key] = len(self.constants)
+            return i
+
+    def location(self, location):
+        out = self.stream
+        if location is None:
+            out.append(0)
+            return
+        i = self.locations.get(id(location))
+        if i is not None:
+            _varint(i + 2, out)
+            return
+        # keyed by id, so the location must stay alive: it does, since
+        # the tree it belongs to is being written
+        self.locations[id(location)] = len(self.locations)
+        out.append(1)
+        _varint(self.constant(location.source), out)
+        _varint(location.start, out)
+        _varint(location.end - location.start, out)
+
+    def children(self, node):
+        # Returns the children of node, in the order they must be
+        # written (before node itself).
+        if isinstance(node, ast.Canon):
+            return node.all[2:]
+        elif isinstance(node, ast.OpApply):
+            return [node.operator] + node.children
+        elif isinstance(node, ast.StringVI):
+            return node.items
+        elif isinstance(node, ast.Bracketed):
+            return [node.expression]
+        elif isinstance(node, ast._Seq):
+            return node.items
+        else:
+            return ()
+
+    def write_node(self, node):
+        out = self.stream
+        t = type(node)
+        if node is None:
+            out.append(N_NONE)
+        elif node is True:
+            out.append(N_TRUE)
+        elif node is False:
+            out.append(N_FALSE)
+        elif t is str or t is int or t is float:
+            out.append(N_CONST)
+            _varint(self.constant(node), out)
+        elif t is ast.Canon:
+            out.append(N_CANON)
+            _varint(self.constant(node.all[1]), out)
+            _varint(len(node.all) - 2, out)
+            self.location(node.all[0].location)
+        elif t is ast.Identifier:
+            out.append(N_IDENTIFIER)
+            _varint(self.constant(node.id), out)
+            self.location(node.location)
+        elif t is ast.OpApply:
+            out.append(N_OPAPPLY)
+            _varint(len(node.children), out)
+            self.location(node.location)
+        elif t in _fixities or t is ast.Operator:
+            out.append(N_OPERATOR)
+            kind = _fixities.get(t, 3)
+            out.append(kind)
+            _varint(self.constant(node.op), out)
+            if kind == 3:
+                _varint(self.constant(node.fixity), out)
+            self.location(node.location)
+        elif t is ast.Numeral:
+            out.append(N_NUMERAL)
+            _varint(node.radix, out)
+            _varint(_zigzag(node.exp), out)
+            _varint(len(node.digits), out)
+            for d in node.digits:
+                _varint(d, out)
+            self.location(node.location)
+        elif t is ast.StringVI:
+            out.append(N_STRINGVI)
+            _varint(len(node.items), out)
+            self.location(node.location)
+        elif t is ast.Bracketed:
+            out.append(N_BRACKETED)
+            _varint(self.constant(node.type), out)
+            self.location(node.location)
+        elif t is ast.Void:
+            out.append(N_VOID)
+            self.location(node.location)
+        elif t in _seq_codes:
+            out.append(_seq_codes[t])
+            _varint(len(node.items), out)
+            self.location(node.location)
+        else:
+            raise TypeError("Cannot serialize %s" % t.__name__)
+
+    def write(self, tree):
+        # Postorder walk with an explicit stack, so that deep trees
+        # don't hit the recursion limit.
+        stack = [(tree, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                self.write_node(node)
+            else:
+                stack.append((node, True))
+                children = self.children(node)
+                for child in reversed(children):
+                    stack.append((child, False))
+
+    def getvalue(self):
+        out = bytearray(MAGIC)
+        out.append(VERSION)
+        _varint(len(self.constants), out)
+        # dicts keep insertion order, which is the order of the indexes
+        for (t, value) in self.constants:
+            if t is str:
+                out.append(C_STR)
+                data = value.encode("utf-8", "surrogatepass")
+                _varint(len(data), out)
+                out += data
+            elif t is int:
+                out.append(C_INT)
+                _varint(_zigzag(value), out)
+            else:
+                out.append(C_FLOAT)
+                out += _float.pack(value)
+        _varint(len(self.stream), out)
+        out += self.stream
+        return bytes(out)
+
+
+def dumps(tree):
+    """
+    Returns the serialization of tree (a phase 1 or 2 tree, or a
+    Canon tree) as bytes. The source code the locations point to is
+    included. Raises TypeError if the tree contains something that
+    cannot be serialized.
+    """
+    writer = _Writer()
+    writer.write(tree)
+    return writer.getvalue()
+
+
+def dump(tree, file):
+    """
+    Writes the serialization of tree to file, opened in binary mode.
+    """
+    file.write(dumps(tree))
+
+
+##############
+### LOADER ###
+##############
+
+def _read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def _decode_varints(data, start, end):
+    # All the varints in data[start:end], as a list. Most of them fit
+    # in one byte, in which case this is just a copy.
+    chunk = data[start:end]
+    if max(chunk, default = 0) < 0x80:
+        return list(chunk)
+    results = []
+    append = results.append
+    value = 0
+    shift = 0
+    for b in chunk:
+        if b < 0x80:
+            append(value | (b << shift))
+            value = 0
+            shift = 0
+        else:
+            value |= (b & 0x7f) << shift
+            shift += 7
+    if shift:
+        raise ValueError("Truncated tree data")
+    return results
+
+def _read_header(data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a serialized tree")
+    pos = len(MAGIC)
+    if data[pos] != VERSION:
+        raise ValueError("Unsupported tree format version %s (expected %s)"
+                         % (data[pos], VERSION))
+    pos += 1
+    count, pos = _read_varint(data, pos)
+    constants = []
+    append = constants.append
+    for i in range(count):
+        tag = data[pos]
+        pos += 1
+        if tag == C_STR:
+            n, pos = _read_varint(data, pos)
+            append(data[pos:pos + n].decode("utf-8", "surrogatepass"))
+            pos += n
+        elif tag == C_INT:
+            n, pos = _read_varint(data, pos)
+            append(_unzigzag(n))
+        elif tag == C_FLOAT:
+            append(_float.unpack_from(data, pos)[0])
+            pos += 8
+        else:
+            raise ValueError("Bad constant tag: %s" % tag)
+    size, pos = _read_varint(data, pos)
+    if pos + size != len(data):
+        raise ValueError("Truncated tree data")
+    return constants, pos
+
+
+def loads(data):
+    """
+    Rebuilds the tree serialized in data (bytes, as returned by
+    dumps). Raises ValueError if data is not a serialized tree, or
+    was serialized with another version of the format.
+    """
+    data = memoryview(data) if not isinstance(data, bytes) else data
+    constants, pos = _read_header(data)
+    ints = _decode_varints(data, pos, len(data))
+
+    Canon = ast.Canon
+    Meta = ast.Meta
+    new = object.__new__
+    Identifier = ast.Identifier
+    Numeral = ast.Numeral
+    OpApply = ast.OpApply
+
+    locations = []
+    stack = []
+    push = stack.append
+    n = len(ints)
+    i = 0
+    try:
+        while i < n:
+            code = ints[i]
+            i += 1
+
+            # Each branch reads its fields, pops its children, reads
+            # the location, then pushes the node. The location is
+            # read inline, since this is what most of the time goes
+            # into.
+
+            if code == N_CANON:
+                command = constants[ints[i]]
+                nargs = ints[i + 1]
+                i += 2
+                if nargs:
+                    arguments = stack[-nargs:]
+                    del stack[-nargs:]
+                else:
+                    arguments = []
+                tag = ints[i]
+                if tag == 0:
+                    location = None
+                    i += 1
+                elif tag == 1:
+                    start = ints[i + 2]
+                    location = Location(constants[ints[i + 1]], (start, start + ints[i + 3]), None)
+                    locations.append(location)
+                    i += 4
+                else:
+                    location = locations[tag - 2]
+                    i += 1
+                node = new(Canon)
+                meta = new(Meta)
+                meta.location = location
+                node.all = [meta, command] + arguments
+                push(node)
+                continue
+
+            elif code == N_CONST:
+                push(constants[ints[i]])
+                i += 1
+                continue
+
+            elif code == N_NONE:
+                push(None)
+                continue
+
+            elif code == N_TRUE:
+                push(True)
+                continue
+
+            elif code == N_FALSE:
+                push(False)
+                continue
+
+            elif code == N_IDENTIFIER:
+                node = new(Identifier)
+                node.id = constants[ints[i]]
+                i += 1
+
+            elif code == N_OPAPPLY:
+                nchildren = ints[i]
+                i += 1
+                node = new(OpApply)
+                if nchildren:
+                    node.children = stack[-nchildren:]
+                    del stack[-nchildren:]
+                else:
+                    node.children = []
+                node.operator = stack.pop()
+
+            elif code == N_OPERATOR:
+                kind = ints[i]
+                op = constants[ints[i + 1]]
+                i += 2
+                if kind == 3:
+                    node = new(ast.Operator)
+                    node.fixity = constants[ints[i]]
+                    i += 1
+                else:
+                    cls = _fixity_classes[kind]
+                    node = new(cls)
+                    node.fixity = cls.__name__.lower()
+                node.op = op
+
+            elif code == N_NUMERAL:
+                node = new(Numeral)
+                node.radix = ints[i]
+                node.exp = _unzigzag(ints[i + 1])
+                ndigits = ints[i + 2]
+                i += 3
+                node.digits = ints[i:i + ndigits]
+                i += ndigits
+
+            elif code == N_STRINGVI:
+                nitems = ints[i]
+                i += 1
+                node = new(ast.StringVI)
+                if nitems:
+                    node.items = stack[-nitems:]
+                    del stack[-nitems:]
+                else:
+                    node.items = []
+
+            elif code == N_BRACKETED:
+                node = new(ast.Bracketed)
+                node.type = constants[ints[i]]
+                i += 1
+                node.expression = stack.pop()
+
+            elif code == N_VOID:
+                node = new(ast.Void)
+
+            elif code in _seq_classes:
+                nitems = ints[i]
+                i += 1
+                node = new(_seq_classes[code])
+                if nitems:
+                    node.items = stack[-nitems:]
+                    del stack[-nitems:]
+                else:
+                    node.items = []
+
+            else:
+                raise ValueError("Bad node code: %s" % code)
+
+            tag = ints[i]
+            if tag == 0:
+                location = None
+                i += 1
+            elif tag == 1:
+                start = ints[i + 2]
+                location = Location(constants[ints[i + 1]], (start, start + ints[i + 3]), None)
+                locations.append(location)
+                i += 4
+            else:
+                location = locations[tag - 2]
+                i += 1
+            node.location = location
+            push(node)
+
+    except IndexError:
+        raise ValueError("Truncated or corrupt tree data")
+
+    if len(stack) != 1:
+        raise ValueError("Corrupt tree data: %s roots" % len(stack))
+    return stack[0]
+
+
+def load(file):
+    """
+    Reads a tree serialized with dump from file, opened in binary
+    mode.
+    """
+    return loads(file.read())
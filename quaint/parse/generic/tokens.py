@@ -0,0 +1,290 @@
+
+import re
+
+from .charclass import ID_LEAD, OP1, OP2, LIST_SEP
+
+
+__all__ = ['Tokenizer']
+
+
+# Kinds of raw tokens that start or end a unit (an operand).
+_unit = ('identifier', 'numeral', 'string')
+
+
+class Tokenizer:
+    """
+    Splits source code into a stream of classified tokens, following
+    the lexical rules of Parser, but without building any tree. This
+    is meant for tools that only need to know what is where, e.g. to
+    color source code.
+
+    The tokens are (kind, start, end) tuples, where kind is one of:
+
+    * "identifier", "numeral", "string" (strings and characters,
+      including what is interpolated in them)
+    * "prefix", "infix", "postfix": operators, including list
+      separators, with their fixity
+    * "bracket": opening and closing brackets
+    * "comment"
+    * "indent": line breaks and the indentation that follows
+    * "invalid": characters that are not allowed in source code
+
+    Whitespace between tokens is not reported.
+
+    parser: the Parser whose lexical rules are followed.
+
+    The fixity of operators is guessed from their surroundings and
+    from the whitespace around them, the way Parser does it, but
+    without taking the roles of the operators into account, so it is
+    approximate. Likewise, an operator alone in brackets, e.g. (+), is
+    reported as an identifier, since this is what it is parsed as.
+    """
+
+    def __init__(self, parser):
+        cc = parser.character_classes
+        self.classifier = parser.classifier
+        self.escape = cc.escape
+        self.unquote = cc.unquote
+        self.xso, self.xsc = cc.ext_str
+
+        # The patterns are built from the Words of the parser's
+        # grammar, so that both lex the same way.
+        def chars(w, body = False):
+            return "[%s]" % re.escape(w.bodyCharsOrig if body else w.initCharsOrig)
+
+        def word(w):
+            return "%s%s*" % (chars(w), chars(w, True))
+
+        self.re_identifier = re.compile(word(parser.identifier))
+        self.re_op1 = re.compile(word(parser.class_1_op))
+        self.re_op2 = re.compile(word(parser.class_2_op))
+        _num = word(parser.num_digits)
+        _alphanum = "%s*" % chars(parser.num_alphanums)
+        _exp = "(?:[%s]-?%s)?" % (re.escape(parser.exponent_marks), _num)
+        self.re_numeral = re.compile(
+            "%(num)s[%(radix)s]%(alnum)s(?:\\.%(alnum)s)?"
+            "|%(num)s(?:\\.(?:%(num)s)?)?%(exp)s"
+            "|\\.%(num)s%(exp)s" % dict(num = _num, alnum = _alphanum, exp = _exp,
+                                        radix = re.escape(parser.radix_marks)))
+        self.re_space = re.compile(" *\\\\ *\n *| +")
+        self.re_indent = re.compile("(?:\n *)+")
+        self.re_comment_line = re.compile(";;[^\n]*")
+        self.re_comment_nested = re.compile(";\\(|\\);")
+
+    ###########
+    ### RAW ###
+    ###########
+
+    def raw_tokens(self, code, pos = 0):
+        """
+        Yields (kind, start, end) for each lexical token of code from
+        pos onwards, where kind is as described in the class
+        documentation, except that operators are "op", list separators
+        are "separator", whitespace is "space", and brackets are "open"
+        and "close".
+        """
+        category = self.classifier.category
+        n = len(code)
+        while pos < n:
+            c = code[pos]
+
+            if c == ' ' or c == '\\':
+                m = self.re_space.match(code, pos)
+                if m:
+                    yield ('space', pos, m.end())
+                    pos = m.end()
+                    continue
+
+            elif c == '\n':
+                end = self.re_indent.match(code, pos).end()
+                yield ('indent', pos, end)
+                pos = end
+                continue
+
+            elif c == ';' and code.startswith(';;', pos):
+                end = self.re_comment_line.match(code, pos).end()
+                yield ('comment', pos, end)
+                pos = end
+                continue
+
+            elif c == ';' and code.startswith(';(', pos):
+                end = self.skip_comment(code, pos)
+                yield ('comment', pos, end)
+                pos = end
+                continue
+
+            elif c in '([{':
+                yield ('open', pos, pos + 1)
+                pos += 1
+                continue
+
+            elif c in ')]}':
+                yield ('close', pos, pos + 1)
+                pos += 1
+                continue
+
+            elif c == '"' or c == self.xso:
+                end = self.skip_string(code, pos)
+                yield ('string', pos, end)
+                pos = end
+                continue
+
+            elif c == "'":
+                end = pos + 1
+                if end < n:
+                    end += 2 if code[end] == self.escape else 1
+                yield ('string', pos, min(end, n))
+                pos = end
+                continue
+
+            m = self.re_numeral.match(code, pos)
+            if m and m.end() > pos:
+                yield ('numeral', pos, m.end())
+                pos = m.end()
+                continue
+
+            flags = category(c)
+            if flags & ID_LEAD:
+                end = self.re_identifier.match(code, pos).end()
+                yield ('identifier', pos, end)
+            elif flags & LIST_SEP:
+                end = pos + 1
+                yield ('separator', pos, end)
+            elif flags & OP1:
+                end = self.re_op1.match(code, pos).end()
+                yield ('op', pos, end)
+            elif flags & OP2:
+                end = self.re_op2.match(code, pos).end()
+                yield ('op', pos, end)
+            else:
+                # includes valid characters that cannot be here, like
+                # a closing extended string delimiter
+                end = pos + 1
+                yield ('invalid', pos, end)
+            pos = end
+
+    def skip_comment(self, code, pos):
+        depth = 0
+        for m in self.re_comment_nested.finditer(code, pos):
+            depth += 1 if m.group() == ';(' else -1
+            if depth == 0:
+                return m.end()
+        return len(code)
+
+    def skip_string(self, code, pos):
+        """
+        Returns the position right after the string that starts at
+        pos, or the end of code if it is not terminated.
+        """
+        n = len(code)
+        if code[pos] == '"':
+            close, depth = '"', None
+        else:
+            close, depth = self.xsc, 1
+        pos += 1
+        while pos < n:
+            c = code[pos]
+            if c == self.escape:
+                pos += 2
+            elif c == self.unquote and pos + 1 < n and code[pos + 1] in '([{':
+                pos = self.skip_bracketed(code, pos + 1)
+            elif depth is None:
+                if c == '"':
+                    if code.startswith('""', pos):
+                        pos += 2
+                    else:
+                        return pos + 1
+                else:
+                    pos += 1
+            else:
+                if c == self.xso:
+                    depth += 1
+                elif c == close:
+                    depth -= 1
+                    if depth == 0:
+                        return pos + 1
+                pos += 1
+        return n
+
+    def skip_bracketed(self, code, pos):
+        depth = 0
+        for kind, start, end in self.raw_tokens(code, pos):
+            if kind == 'open':
+                depth += 1
+            elif kind == 'close':
+                depth -= 1
+                if depth == 0:
+                    return end
+        return len(code)
+
+    ##############
+    ### FIXITY ###
+    ##############
+
+    def __call__(self, code):
+        """
+        Yields the tokens of code (see the class documentation).
+        """
+        # Operators are held back until the next operand (or lack
+        # thereof) is seen, since that determines their fixity.
+        pending = []
+        before = False
+        for token in self.raw_tokens(code):
+            kind = token[0]
+            if kind in ('op', 'space', 'comment'):
+                pending.append(token)
+                continue
+            after = kind in _unit or kind == 'open'
+            if pending:
+                yield from self.resolve(pending, before, after)
+                pending = []
+            if kind == 'open':
+                yield ('bracket',) + token[1:]
+                before = False
+            elif kind == 'close':
+                yield ('bracket',) + token[1:]
+                before = True
+            elif kind == 'separator':
+                yield ('infix',) + token[1:]
+                before = False
+            else:
+                yield token
+                before = kind in _unit
+        if pending:
+            yield from self.resolve(pending, before, False)
+
+    def resolve(self, pending, before, after):
+        ops = [i for i, token in enumerate(pending) if token[0] == 'op']
+        if not ops:
+            fixities = {}
+        elif not before and not after:
+            fixities = dict.fromkeys(ops, 'identifier' if len(ops) == 1 else 'prefix')
+        elif not before:
+            fixities = dict.fromkeys(ops, 'prefix')
+        elif not after:
+            fixities = dict.fromkeys(ops, 'postfix')
+        else:
+            # Between two operands. Operators before the first space
+            # are postfix, operators after the last space are prefix,
+            # and the first operator in between is infix. If there is
+            # no space, the first operator is infix.
+            spaces = [i for i, token in enumerate(pending) if token[0] == 'space']
+            first = spaces[0] if spaces else -1
+            last = spaces[-1] if spaces else len(pending)
+            fixities = {}
+            infix = False
+            for i in ops:
+                if i < first:
+                    fixities[i] = 'postfix'
+                elif i > last:
+                    fixities[i] = 'prefix'
+                elif not infix:
+                    fixities[i] = 'infix'
+                    infix = True
+                else:
+                    fixities[i] = 'prefix'
+        for i, token in enumerate(pending):
+            if token[0] == 'op':
+                yield (fixities[i],) + token[1:]
+            elif token[0] == 'comment':
+                yield token
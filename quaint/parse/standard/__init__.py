@@ -1,6 +1,6 @@
 
-from .parse import parser, expression
-from .codec import codec, encode, decode
+from .parse import parser, expression, classifier
+from .codec import codec, encode, decode, decode_buffer, decode_file
 from .operators import \
     is_assignment, is_custom, \
     op_groups, op_order
@@ -5,7 +5,7 @@ __all__ = ['delim', 'delim_start', 'delim_end',
            'digraphs',
            'annotated_identifiers', 'identifiers',
 
-           'codec', 'encode', 'decode']
+           'codec', 'encode', 'decode', 'decode_buffer', 'decode_file']
 
 # delim = r"\\"
 delim = r"``"
@@ -362,3 +362,5 @@ codec = Codec(delim, digraphs, identifiers, idchars)
 
 encode = codec.encode
 decode = codec.decode
+decode_buffer = codec.decode_buffer
+decode_file = codec.decode_file
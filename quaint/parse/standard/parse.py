@@ -2,7 +2,8 @@
 from ..generic import parse
 from . import characters, operators
 
-__all__ = ['parser', 'expression']
+__all__ = ['parser', 'expression', 'classifier']
 
 parser = parse.Parser(characters, operators)
 expression = parser.expression
+classifier = parser.classifier
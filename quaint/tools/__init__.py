@@ -3,5 +3,6 @@ from .utils import \
     attrdict, KW, dmerge, dmergei, \
     namedlist, NamedList
 from .err import Exc
+from .bulk import process_tree, BulkReport
 # from .logstruct import LL, LAD, LADLL
 
@@ -0,0 +1,262 @@
+
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+
+__all__ = ['walk_tree', 'write_atomic', 'is_stale', 'process_tree', 'BulkReport']
+
+
+###############
+### HELPERS ###
+###############
+
+def walk_tree(source, destination):
+    """
+    Yields (source_path, destination_path) for each regular file
+    under the source directory. The destination path mirrors the
+    relative position of the file under the destination directory.
+    Files are produced in a deterministic (sorted) order. If the
+    destination is inside the source directory, it is not walked, so
+    that outputs are not processed as sources.
+    """
+    skip = os.path.realpath(destination)
+    for root, dirs, files in os.walk(source):
+        dirs[:] = sorted(d for d in dirs
+                         if os.path.realpath(os.path.join(root, d)) != skip)
+        rel = os.path.relpath(root, source)
+        for name in sorted(files):
+            yield (os.path.join(root, name),
+                   os.path.normpath(os.path.join(destination, rel, name)))
+
+
+def digest(data, key = None):
+    h = hashlib.sha1(data)
+    if key is not None:
+        h.update(key.encode("utf-8"))
+    return h.hexdigest()
+
+
+def _umask():
+    # The only way to read the umask is to set it.
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+def write_atomic(path, data):
+    """
+    Writes the bytes in data to path. The data is first written to a
+    temporary file in the same directory, which is then renamed over
+    path, so readers never see a partially written file.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok = True)
+    fd, tmp = tempfile.mkstemp(dir = directory, prefix = ".quaint-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # mkstemp creates the file readable by its owner only, give it
+        # the permissions it would have had if it had been open()ed.
+        os.chmod(tmp, 0o666 & ~_umask())
+        os.replace(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def is_stale(source, destination):
+    """
+    True if destination does not exist or is older than source.
+    """
+    try:
+        return os.stat(destination).st_mtime < os.stat(source).st_mtime
+    except OSError:
+        return True
+
+
+# Name of the file, at the root of the destination directory, in which
+# process_tree records the hash of each source (see the key argument).
+MANIFEST = ".quaint-manifest"
+
+def load_manifest(destination):
+    try:
+        with open(os.path.join(destination, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(destination, manifest):
+    write_atomic(os.path.join(destination, MANIFEST),
+                 json.dumps(manifest, indent = 0, sort_keys = True).encode("utf-8"))
+
+
+##############
+### WORKER ###
+##############
+
+# The transformation is sent once to each worker process when the pool
+# starts, rather than once per file, so anything expensive it holds
+# (e.g. a Codec and its compiled regular expressions) is built a
+# single time per worker.
+_transform = None
+_key = None
+_relative = False
+
+def _init_worker(transform, key, relative):
+    global _transform, _key, _relative
+    _transform = transform
+    _key = key
+    _relative = relative
+
+def _process_file(task):
+    # Returns (status, relative path, source hash, bytes in, bytes
+    # out). In case of failure, the error message takes the place of
+    # the hash.
+    source, destination, rel, expected = task
+    with open(source, "rb") as f:
+        data = f.read()
+    h = digest(data, _key) if _key is not None else None
+    if h is not None and h == expected and os.path.exists(destination):
+        return ('skipped', rel, h, len(data), 0)
+    try:
+        text = data.decode("utf-8")
+        result = _transform(text, rel) if _relative else _transform(text)
+        result = result.encode("utf-8")
+    except Exception as e:
+        return ('failed', rel, "%s: %s" % (type(e).__name__, e), len(data), 0)
+    try:
+        with open(destination, "rb") as f:
+            unchanged = digest(f.read()) == digest(result)
+    except OSError:
+        unchanged = False
+    if unchanged:
+        # Same contents: don't rewrite, but bump the timestamp so that
+        # the mtime check skips the file next time.
+        os.utime(destination)
+        return ('unchanged', rel, h, len(data), len(result))
+    write_atomic(destination, result)
+    return ('written', rel, h, len(data), len(result))
+
+
+##############
+### REPORT ###
+##############
+
+class BulkReport:
+    """
+    Summary of a process_tree run. counts maps each status ('written',
+    'unchanged', 'skipped', 'failed') to a number of files. errors is
+    a list of (path, message) pairs for the files that failed, path
+    being relative to the source directory.
+    """
+
+    def __init__(self):
+        self.counts = dict(written = 0, unchanged = 0, skipped = 0, failed = 0)
+        self.errors = []
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.elapsed = 0.0
+
+    def add(self, status, bytes_in = 0, bytes_out = 0):
+        self.counts[status] += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+    def __str__(self):
+        total = sum(self.counts.values())
+        processed = total - self.counts['skipped']
+        elapsed = max(self.elapsed, 1e-9)
+        failed = (", %i failed" % self.counts['failed']) if self.counts['failed'] else ""
+        return ("%i files (%i written, %i unchanged, %i skipped%s) in %.2fs: "
+                "%.1f files/s, %.2f MB/s"
+                % (total,
+                   self.counts['written'],
+                   self.counts['unchanged'],
+                   self.counts['skipped'],
+                   failed,
+                   self.elapsed,
+                   processed / elapsed,
+                   self.bytes_in / elapsed / 1e6))
+
+
+###############
+### PROCESS ###
+###############
+
+def process_tree(transform, source, destination, jobs = None, force = False,
+                 rename = None, key = None, relative = False):
+    """
+    Applies transform to every file under the source directory and
+    writes the results at the same relative paths under the
+    destination directory. Returns a BulkReport. Files for which
+    transform raises an exception are reported as failed, the others
+    are still processed.
+
+    transform :: str -> str: must be picklable (a module-level
+        function or a bound method of a picklable object). It is
+        shipped once to each worker process.
+
+    jobs :: int: number of worker processes (default: number of CPUs).
+
+    force :: Boolean: (default: False) process all files. Otherwise,
+        files whose destination is at least as recent as the source
+        are skipped without being read, and destinations whose
+        contents would not change are left untouched.
+
+    rename :: str -> str: (default: None) function applied to each
+        destination path, e.g. to change its extension.
+
+    key :: str: (default: None) description of everything besides the
+        source that the output depends on (e.g. the transform's
+        settings). If given, the hash of each source along with the
+        key is recorded in a manifest in the destination directory,
+        and instead of comparing timestamps, files whose hash did not
+        change since the last run are skipped.
+
+    relative :: Boolean: (default: False) call transform with the path
+        of the file, relative to the source directory, as a second
+        argument.
+    """
+    report = BulkReport()
+    start = time.time()
+
+    if key is not None:
+        previous = load_manifest(destination)
+        # rebuilt from scratch, so entries for removed files go away
+        manifest = {}
+    else:
+        manifest = None
+
+    todo = []
+    for src, dest in walk_tree(source, destination):
+        if rename is not None:
+            dest = rename(dest)
+        rel = os.path.relpath(src, source)
+        if key is not None:
+            todo.append((src, dest, rel, None if force else previous.get(rel)))
+        elif force or is_stale(src, dest):
+            todo.append((src, dest, rel, None))
+        else:
+            report.add('skipped')
+
+    if todo:
+        pool = multiprocessing.Pool(jobs, _init_worker, (transform, key, relative))
+        try:
+            for status, rel, h, bytes_in, bytes_out in \
+                    pool.imap_unordered(_process_file, todo, chunksize = 8):
+                report.add(status, bytes_in, bytes_out)
+                if status == 'failed':
+                    report.errors.append((rel, h))
+                elif manifest is not None:
+                    manifest[rel] = h
+        finally:
+            pool.close()
+            pool.join()
+            if manifest is not None:
+                save_manifest(destination, manifest)
+
+    report.elapsed = time.time() - start
+    return report